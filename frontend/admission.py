@@ -0,0 +1,185 @@
+"""
+Admission control for `ask_data_insights` calls.
+
+A global limit caps how many toolbox calls run at once and a per-user limit
+stops one user from taking every slot. Requests over the limits wait in
+per-user FIFO queues that are served round-robin, so a user with many
+queued questions does not delay everyone else. Waiters are told their queue
+position as it changes, and new requests are shed once the backlog reaches
+`max_queue`.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from logger import logger
+import config
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed because the queue is full."""
+
+
+class _Waiter:
+    __slots__ = ("user_id", "future", "moved")
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.moved = asyncio.Event()
+
+
+class AdmissionController:
+    """Global and per-user concurrency limits with fair (round-robin) queueing."""
+
+    def __init__(self, max_concurrent: int = 16, max_per_user: int = 2, max_queue: int = 100):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_user = max(1, max_per_user)
+        self.max_queue = max(0, max_queue)
+        self._active = 0
+        self._active_per_user: Dict[str, int] = {}
+        # Users with queued requests, in round-robin order
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._counters = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    # --- Public API ---
+
+    async def acquire(self, user_id: str, on_position: Optional[PositionCallback] = None):
+        """
+        Waits for a slot; every acquire must be paired with a release.
+        `on_position(n)` is awaited with the 1-based queue position whenever it changes.
+        Raises AdmissionRejected if the request is shed.
+        """
+        if not self._queues and self._can_admit(user_id):
+            self._admit(user_id)
+            return
+
+        if self.queue_depth() >= self.max_queue:
+            self._counters["rejected"] += 1
+            logger.warning("Admission queue is full (%d waiting); shedding request.", self.queue_depth(), extra={"user": user_id})
+            raise AdmissionRejected("Too many questions are waiting to be answered.")
+
+        waiter = _Waiter(user_id)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._counters["queued"] += 1
+        self._dispatch()
+
+        try:
+            last_position = None
+            while not waiter.future.done():
+                waiter.moved.clear()
+                position = self._position(waiter)
+                if on_position is not None and position != last_position:
+                    last_position = position
+                    await on_position(position)
+                if waiter.future.done():
+                    break
+                moved = asyncio.ensure_future(waiter.moved.wait())
+                try:
+                    await asyncio.wait({waiter.future, moved}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    moved.cancel()
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(user_id) # Admitted just as we were cancelled
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+            raise
+
+    def try_reserve(self, user_id: str) -> Optional[Callable[[], None]]:
+        """
+        Takes a slot for `user_id` only if one is free now and nobody is waiting, e.g. for a
+        hedged duplicate of a call in progress. Returns the slot's release, or None.
+        """
+        if self._queues or not self._can_admit(user_id):
+            return None
+        self._admit(user_id)
+        return lambda: self.release(user_id)
+
+    def release(self, user_id: str):
+        """Frees a slot held by `user_id` and admits the next waiters."""
+        self._active -= 1
+        remaining = self._active_per_user.get(user_id, 0) - 1
+        if remaining > 0:
+            self._active_per_user[user_id] = remaining
+        else:
+            self._active_per_user.pop(user_id, None)
+        self._dispatch()
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        snapshot = dict(self._counters)
+        snapshot["active"] = self._active
+        snapshot["waiting"] = self.queue_depth()
+        return snapshot
+
+    # --- Internals ---
+
+    def _can_admit(self, user_id: str) -> bool:
+        return self._active < self.max_concurrent and self._active_per_user.get(user_id, 0) < self.max_per_user
+
+    def _admit(self, user_id: str):
+        self._active += 1
+        self._active_per_user[user_id] = self._active_per_user.get(user_id, 0) + 1
+        self._counters["admitted"] += 1
+
+    def _dispatch(self):
+        """Admits queued waiters round-robin across users while slots are free."""
+        admitted_any = True
+        while admitted_any and self._active < self.max_concurrent:
+            admitted_any = False
+            for user_id in list(self._queues):
+                if self._active >= self.max_concurrent:
+                    break
+                if not self._can_admit(user_id):
+                    continue
+                queue = self._queues[user_id]
+                waiter = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(user_id) # This user goes to the back of the rotation
+                else:
+                    del self._queues[user_id]
+                self._admit(user_id)
+                waiter.future.set_result(None)
+                admitted_any = True
+
+        for queue in self._queues.values():
+            for waiter in queue:
+                waiter.moved.set()
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del self._queues[waiter.user_id]
+        self._dispatch()
+
+    def _position(self, waiter: _Waiter) -> int:
+        """Estimated 1-based position of `waiter` under round-robin service."""
+        rank = self._queues[waiter.user_id].index(waiter)
+        position = rank + 1
+        seen_own = False
+        for user_id, queue in self._queues.items():
+            if user_id == waiter.user_id:
+                seen_own = True
+                continue
+            # Each round serves one request per user; users earlier in the rotation go first
+            position += min(len(queue), rank if seen_own else rank + 1)
+        return position
+
+
+admission = AdmissionController(
+    max_concurrent=config.ADMISSION_MAX_CONCURRENT,
+    max_per_user=config.ADMISSION_MAX_PER_USER,
+    max_queue=config.ADMISSION_MAX_QUEUE,
+)
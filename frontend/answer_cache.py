@@ -0,0 +1,198 @@
+"""
+Answer cache for repeated analytics questions.
+
+Raw `ask_data_insights` responses are cached under a key built from the
+normalized question, the conversation context and the completed-period
+bucket. The bucket follows the date rules in `tools.yaml`: monthly and
+quarterly answers only change when a month closes, while yearly answers run
+to the current date and so change every day.
+
+Entries live in an in-memory LRU with a TTL, backed by a local SQLite file
+so cached answers survive restarts.
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Optional
+
+from executors import run_blocking
+from logger import logger
+import config
+
+# Questions mentioning these run up to the current date (year-to-date rule).
+_DAILY_PERIOD_PATTERN = re.compile(r"\b(year|years|yearly|annual|annually|ytd|fy|today|yesterday|week|weekly|daily)\b")
+
+
+def normalize_question(question: str) -> str:
+    """Lowercases the question and collapses whitespace and trailing punctuation."""
+    normalized = re.sub(r"\s+", " ", (question or "").strip().lower())
+    return normalized.rstrip(" ?.!")
+
+
+def period_bucket(question: str, today: Optional[date] = None) -> str:
+    """Returns the completed-period bucket an answer to `question` depends on."""
+    today = today or date.today()
+    if _DAILY_PERIOD_PATTERN.search(normalize_question(question)):
+        return f"D{today.isoformat()}"
+
+    # Monthly and quarterly answers end at the last fully completed month.
+    year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    return f"M{year:04d}-{month:02d}"
+
+
+class AnswerCache:
+    """LRU + TTL cache of raw tool responses with a SQLite persistent tier."""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 6 * 3600, db_path: Optional[str] = None, enabled: bool = True):
+        self.enabled = enabled
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_path = db_path if enabled else None # Opened on first use, so importing this module touches no files
+        self._puts_since_prune = 0
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+
+    def _database(self):
+        """Returns the SQLite connection, opening it on first use. Call with the lock held."""
+        if self._db is None and self._db_path:
+            db_path, self._db_path = self._db_path, None
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+            except sqlite3.Error as e:
+                logger.warning("Answer cache database %s is unavailable; using memory only: %s", db_path, e)
+                self._db = None
+        return self._db
+
+    @staticmethod
+    def make_key(question: str, context: str = "", today: Optional[date] = None) -> str:
+        """Builds the cache key for a question asked after `context`."""
+        parts = [
+            normalize_question(question),
+            re.sub(r"\s+", " ", context or "").strip(),
+            period_bucket(question, today),
+        ]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for `key`, or None on a miss."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return value
+                del self._entries[key]
+                self._counters["expired"] += 1
+
+            value = self._get_from_db(key, now)
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+
+            self._counters["disk_hits"] += 1
+            self._store_in_memory(key, value[0], value[1])
+            return value[0]
+
+    def put(self, key: str, value: str):
+        """Caches `value` under `key` in memory and on disk."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._store_in_memory(key, value, now)
+            self._counters["puts"] += 1
+            db = self._database()
+            if db is None:
+                return
+            try:
+                db.execute("INSERT OR REPLACE INTO answers (key, value, created_at) VALUES (?, ?, ?)", (key, value, now))
+                self._puts_since_prune += 1
+                if self._puts_since_prune >= 100:
+                    db.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+                    self._puts_since_prune = 0
+            except sqlite3.Error as e:
+                logger.warning("Failed to persist cached answer: %s", e)
+
+    async def fetch(self, key: str) -> Optional[str]:
+        """Like get, but reads the SQLite tier on the blocking worker pool so the event loop stays responsive."""
+        if self._db is None and not self._db_path:
+            return self.get(key)
+        return await run_blocking(self.get, key)
+
+    async def save(self, key: str, value: str):
+        """Like put, but writes the SQLite tier on the blocking worker pool."""
+        if self._db is None and not self._db_path:
+            self.put(key, value)
+            return
+        await run_blocking(self.put, key, value)
+
+    def clear(self):
+        """Drops every cached answer, in memory and on disk."""
+        with self._lock:
+            self._entries.clear()
+            db = self._database()
+            if db is not None:
+                try:
+                    db.execute("DELETE FROM answers")
+                except sqlite3.Error as e:
+                    logger.warning("Failed to clear the answer cache database: %s", e)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns hit/miss counters and the current in-memory size."""
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot["entries"] = len(self._entries)
+        lookups = snapshot["memory_hits"] + snapshot["disk_hits"] + snapshot["misses"]
+        snapshot["hit_ratio"] = (snapshot["memory_hits"] + snapshot["disk_hits"]) / lookups if lookups else 0.0
+        return snapshot
+
+    def _store_in_memory(self, key: str, value: str, created_at: float):
+        self._entries[key] = (value, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _get_from_db(self, key: str, now: float) -> Optional[tuple]:
+        db = self._database()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT value, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Failed to read cached answer: %s", e)
+            return None
+        if row is None or now - row[1] >= self.ttl_seconds:
+            return None
+        return row
+
+
+answer_cache = AnswerCache(
+    max_entries=config.ANSWER_CACHE_MAX_ENTRIES,
+    ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS,
+    db_path=config.ANSWER_CACHE_DB_PATH,
+    enabled=config.ANSWER_CACHE_ENABLED,
+)
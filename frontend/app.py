@@ -1,16 +1,33 @@
 import os
 import json
-import io
-import pandas as pd
 import chainlit as cl
-from toolbox_core import ToolboxClient # type: ignore
 from logger import logger
+from log_writer import log_writer
+from toolbox_pool import toolbox_pool
+from answer_cache import answer_cache
+from context_builder import build_query_context, build_tool_params
+from streaming import stream_answer, streaming_gate, StreamingUnavailable
+from result_store import result_store, StoredResult
+from session_store import session_store
+from export import EXPORT_FORMATS, ExportError, get_export_backend, run_export
+from tracing import metrics, tracer, start_metrics_server
+from executors import worker_pools, run_blocking
+from admission import admission, AdmissionRejected
+from singleflight import singleflight, make_flight_key
+from prefetch import prefetcher
+from schema_cache import schema_cache, schema_for_question
+from charts import chart_cache, charts_available, infer_chart_spec
+from pagination import split_table, needs_paging
+from resilience import toolbox_caller, CircuitOpenError, DeadlineExceeded
 import config
 from utils import *
 
 # --- Load System Prompt on startup ---
 SYSTEM_INSTRUCTION = load_system_prompt(config.SYSTEM_PROMPT_FILE)
 
+# Charts need matplotlib, which only the CPU workers import
+CHARTS_ENABLED = config.CHARTS_ENABLED and charts_available()
+
 # -------- 1. The New Authentication Callback --------
 @cl.password_auth_callback
 def auth_callback(username: str, password: str):
@@ -41,15 +58,49 @@ def auth_callback(username: str, password: str):
     return None
 
 
+@cl.on_app_startup
+async def startup():
+    """Starts the log writer, loads the toolset, starts the CPU workers, the metrics endpoint and the prefetcher."""
+    log_writer.start()
+    metrics.register_collector("copilot_log_writer", log_writer.stats)
+    metrics.register_collector("copilot_answer_cache", answer_cache.stats)
+    metrics.register_collector("copilot_result_store", result_store.stats)
+    metrics.register_collector("copilot_session_store", session_store.stats)
+    metrics.register_collector("copilot_worker_pools", worker_pools.stats)
+    metrics.register_collector("copilot_admission", admission.stats)
+    metrics.register_collector("copilot_singleflight", singleflight.stats)
+    metrics.register_collector("copilot_prefetch", prefetcher.stats)
+    metrics.register_collector("copilot_toolbox", toolbox_caller.stats)
+    metrics.register_collector("copilot_streaming", streaming_gate.stats)
+    metrics.register_collector("copilot_schema_cache", schema_cache.stats)
+    metrics.register_collector("copilot_charts", chart_cache.stats)
+    if config.METRICS_PORT:
+        start_metrics_server(metrics, config.METRICS_PORT, config.METRICS_HOST)
+    await toolbox_pool.warm_up()
+    await schema_cache.warm_up()
+    await worker_pools.warm_up(preload=["result_store", "pandas", "charts"])
+    if CHARTS_ENABLED:
+        chart_cache.start_warm_up(worker_pools.process_workers)
+    if config.PREFETCH_ENABLED and answer_cache.enabled:
+        prefetcher.start(SYSTEM_INSTRUCTION)
+
+
+@cl.on_app_shutdown
+async def shutdown():
+    """Stops the prefetcher, closes the toolbox pool, flushes queued logs, stops the worker pools and closes the session store."""
+    await prefetcher.stop()
+    await schema_cache.close()
+    await toolbox_pool.close()
+    log_writer.stop()
+    worker_pools.shutdown()
+    session_store.close()
+
+
 @cl.on_chat_start
 async def start_chat():
     """Initializes the chat session."""
-    client = ToolboxClient(config.TOOLBOX_URL)
-    cl.user_session.set("client", client)
-
-    # --- Initialize an empty history for the user's session ---
-    cl.user_session.set("history", [])
-    
+    # The history lives in the session store under the thread ID, so a chat
+    # that reconnects (possibly to another worker) keeps its context.
     await cl.Message(
         author="Orion",
         content=""" ***Welcome to Orion - The Nostradamus Copilot*** 
@@ -67,180 +118,299 @@ async def start_chat():
 @cl.on_message
 async def main(message: cl.Message):
     """Handles the main logic for processing a user's message."""
-    client: ToolboxClient = cl.user_session.get("client")
-
     user_query = message.content
     thinking_message = cl.Message(author="Orion", content="Processing your query...")
-    await thinking_message.send()
-
-    # --- Retrieve history and build the context string ---
-    history = cl.user_session.get("history")
-    
-    context_parts = []
-    for q, a in history:
-        context_parts.append(f"Previous Question: {q}")
-        context_parts.append(f"Previous Answer: {a}")
-    
-    context_parts.append(f"Current Question: {user_query}")
-    
-    # Combine everything into one system-context-aware query
-    full_query_with_context = f"{SYSTEM_INSTRUCTION}\n\n" + "\n\n".join(context_parts)
+    # The placeholder message becomes the answer, so its ID identifies the interaction
+    interaction_id = thinking_message.id
+
+    with tracer.interaction(interaction_id) as trace:
+        with tracer.span("send_placeholder"):
+            await thinking_message.send()
+
+        # --- Retrieve history and build the token-budgeted context ---
+        thread_id = cl.context.session.thread_id
+        history = await session_store.load_history(thread_id)
+
+        # --- Only the tables and columns relevant to the question go out ---
+        with tracer.span("select_schema"):
+            schema = await schema_for_question(user_query, history)
+
+        with tracer.span("build_context"):
+            query_context = build_query_context(
+                SYSTEM_INSTRUCTION,
+                history,
+                user_query,
+                token_budget=config.CONTEXT_TOKEN_BUDGET,
+                recent_turns=config.CONTEXT_RECENT_TURNS,
+                schema_text=schema.text,
+            )
+        full_query_with_context = query_context.prompt
+        logger.info("Prompt token usage: %s", query_context.usage, extra={"interaction_id": interaction_id})
 
-    try:
-        toolset_list = await client.load_toolset(config.TOOLSET_NAME)
-        
-        if not toolset_list:
-            await cl.Message(author="Error", content=f"Toolset '{config.TOOLSET_NAME}' is empty or could not be loaded.").send()
-            return
+        try:
+            # --- Serve repeated questions from the answer cache ---
+            with tracer.span("answer_cache_get"):
+                cache_key = answer_cache.make_key(user_query, query_context.history_text)
+                response_string = await answer_cache.fetch(cache_key)
+            from_cache = response_string is not None
+            trace.attributes["answer_cache"] = "hit" if from_cache else "miss"
+
+            if not from_cache:
+                with tracer.span("load_toolset"):
+                    toolset_list = await toolbox_pool.get_toolset()
+
+                if not toolset_list:
+                    trace.attributes["outcome"] = "error"
+                    await cl.Message(author="Error", content=f"Toolset '{config.TOOLSET_NAME}' is empty or could not be loaded.").send()
+                    return
+
+                ask_data_insights_tool = toolset_list[0]
+                tool_params = build_tool_params(full_query_with_context, schema.table_references, temperature=0.0)
+
+                user = cl.user_session.get("user")
+                user_id = user.identifier if user else "anonymous"
+
+                # The shared call runs without this session, so it only publishes what to show (see show_event)
+                async def call_ask_data_insights(publish) -> str:
+                    # --- Wait for a free toolbox slot (global and per-user limits) ---
+                    queued = False
+
+                    async def publish_queue_position(position: int):
+                        nonlocal queued
+                        queued = True
+                        publish(("queued", position))
+
+                    # One attempt of the tool call; it returns a single string containing multiple JSON objects
+                    async def attempt(claim) -> str:
+                        if streaming_gate.is_open():
+                            try:
+                                return await stream_answer(
+                                    lambda token: publish(("token", token)), ask_data_insights_tool.__name__, tool_params, claim=claim,
+                                    max_table_chars=config.TABLE_PAGING_MIN_BYTES,
+                                )
+                            except StreamingUnavailable as e:
+                                streaming_gate.record_unavailable(e)
+
+                        return await ask_data_insights_tool(**tool_params)
+
+                    with tracer.span("admission_wait"):
+                        await admission.acquire(user_id, on_position=publish_queue_position)
+                    try: # Everything after the acquire releases the slot, even if the client is gone
+                        if queued:
+                            publish(("admitted", None))
+
+                        # Deadline, hedged duplicate after the p95 delay, and circuit breaker
+                        try:
+                            with tracer.span("ask_data_insights", streaming=streaming_gate.is_open()):
+                                # Hedged duplicates and retries each need a free slot of their own
+                                return await toolbox_caller.call(attempt, reserve=lambda: admission.try_reserve(user_id))
+                        except CircuitOpenError:
+                            raise
+                        except Exception:
+                            # The toolbox server may have restarted; reload the toolset next time
+                            toolbox_pool.invalidate()
+                            raise
+                    finally:
+                        admission.release(user_id)
+
+                async def show_shared_answer():
+                    thinking_message.content = "The same question is already being answered, sharing that answer..."
+                    await thinking_message.update()
+
+                streamed = False
+
+                async def show_event(event):
+                    nonlocal streamed
+                    kind, value = event
+                    if kind == "token":
+                        if not streamed:
+                            thinking_message.content = "" # Replace the "Processing your query..." placeholder
+                            streamed = True
+                        await thinking_message.stream_token(value)
+                    elif streamed:
+                        return
+                    elif kind == "queued":
+                        thinking_message.content = f"Orion is busy answering other questions. You are number {value} in the queue..."
+                        await thinking_message.update()
+                    elif kind == "admitted":
+                        thinking_message.content = "Processing your query..."
+                        await thinking_message.update()
+
+                # --- Identical questions in flight share one tool call ---
+                flight_key = make_flight_key(full_query_with_context, schema.table_references)
+                with tracer.span("tool_call"):
+                    response_string, coalesced = await singleflight.do(
+                        flight_key, call_ask_data_insights, on_join=show_shared_answer, on_event=show_event,
+                    )
+                trace.attributes["coalesced"] = coalesced
+
+            if not response_string:
+                trace.attributes["outcome"] = "empty"
+                await cl.Message(author="Orion", content="I'm sorry, I couldn't generate a response for that question.").send()
+                return
+
+            logger.debug("Raw toolbox response (%s):\n%s", type(response_string).__name__, response_string)
+
+            # Parse response
+            with tracer.span("parse_tool_response"):
+                parsed_data = parse_tool_response(response_string)
+
+            logger.debug("Parsed tool response:\n%s", parsed_data)
+
+            # 1. Extract the data from the parsed response
+            answer_string = parsed_data.answer
+            sql_query = parsed_data.sql
+
+            if not answer_string:
+                trace.attributes["outcome"] = "empty"
+                thinking_message.content = "I received a response from the backend, but I couldn't extract a valid answer. Please check the 'Raw Backend Response' for details."
+                thinking_message.elements = [cl.Text(name="Raw Backend Response", content=f"```\n{response_string}\n```", display="inline")]
+                await thinking_message.update()
+                return
+
+            if from_cache:
+                logger.info("Answer cache hit for query: %s", user_query, extra={"interaction_id": interaction_id})
+            elif parsed_data.succeeded:
+                # Error answers and empty tables are not cached, so the next ask retries them
+                with tracer.span("answer_cache_put"):
+                    await answer_cache.save(cache_key, response_string)
+
+            # 2. The parser already split the answer into its components
+            follow_ups = parsed_data.follow_ups
+
+            # 3. Construct the main message content (Table + Reasoning)
+            main_content = parsed_data.main_content
+            history_content = main_content
+
+            # --- Large tables are shown a page at a time; history keeps a preview ---
+            paged_table = split_table(parsed_data.table, page_size=config.TABLE_PAGE_SIZE)
+            if needs_paging(paged_table, config.TABLE_PAGING_MIN_ROWS, config.TABLE_PAGING_MIN_BYTES):
+                reasoning = parsed_data.reasoning.strip()
+                main_content = paged_table.render_page(0) + "\n\n" + reasoning
+                history_content = paged_table.compact(config.HISTORY_PREVIEW_ROWS) + "\n\n" + reasoning
+            else:
+                paged_table = None
+
+            # --- Keep the answer server-side; actions only carry the interaction ID ---
+            await result_store.save(StoredResult(
+                interaction_id=interaction_id,
+                user_query=user_query,
+                answer=answer_string,
+                sql=sql_query,
+                follow_ups=follow_ups.strip(),
+                pages=paged_table,
+            ))
+
+            # --- Update the history with the latest exchange ---
+            await session_store.append_turn(thread_id, (user_query, history_content, sql_query))
+            # ----------------------------------------------------
+            thinking_message.content = main_content
+
+            # --- Create a list of actions and elements ---
+            actions = []
+
+            # Add the "View SQL" button if a query exists
+            if sql_query:
+                actions.append(
+                    cl.Action(name="view_sql", value="sql", label="🧾 View SQL", payload={})
+                )
             
-        ask_data_insights_tool = toolset_list[0]
-
-        tables_to_use = [{
-            "projectId": config.PROJECT_ID,
-            "datasetId": config.DATASET_ID_1,
-            "tableId": config.TABLE_ID_1
-        }]
-
-        temperature = 0.0  # set to your desired value
-        full_query_with_context_final = f"Temperature setting: {temperature}\n\n{full_query_with_context}"
-
-
-        # The tool call returns a single string containing multiple JSON objects
-        response_string = await ask_data_insights_tool(
-            user_query_with_context=full_query_with_context_final,
-            table_references=json.dumps(tables_to_use)
-        )
-
-        if not response_string:
-            await cl.Message(author="Orion", content="I'm sorry, I couldn't generate a response for that question.").send()
-            return
-
-        logger.debug("--- 1. RAW RESPONSE FROM TOOLBOX ---")
-        logger.debug(f"Type: {type(response_string)}")
-        logger.debug(f"Content:\n{response_string}")
-        logger.debug("------------------------------------")
+            if follow_ups:
+                actions.append(cl.Action(name="view_follow_ups", value="follow_ups", label="❓ Follow-ups", payload={}))
 
-        # Parse response
-        parsed_data = parse_tool_response(response_string)
+            # Add the "Next page" button for a paged table
+            if paged_table is not None:
+                actions.append(cl.Action(name="next_page", value="next_page", label="➡️ Next page", payload={"page": 1}))
 
-        logger.debug("--- 2. PARSED DATA DICTIONARY ---")
-        logger.debug(f"Type: {type(parsed_data)}")
-        logger.debug(f"Content:\n{parsed_data}")
-        logger.debug("---------------------------------")
+            # Log the initial interaction with the message ID
+            log_to_bq(user_query=user_query, answer=parsed_data.main_content, interaction_id=interaction_id)
 
-        # 1. Extract the data from the parsed dictionary
-        answer_string = parsed_data.get("Answer", "")
-        sql_query = parsed_data.get("SQL Generated", "")
-
-        if not answer_string:
-            thinking_message.content = "I received a response from the backend, but I couldn't extract a valid answer. Please check the 'Raw Backend Response' for details."
-            thinking_message.elements = [cl.Text(name="Raw Backend Response", content=f"```\n{response_string}\n```", display="inline")]
-            await thinking_message.update()
-            return
-
-        logger.debug("--- 3. EXTRACTED SQL ---")
-        logger.debug(f"Type: {type(sql_query)}")
-        logger.debug(f"Content:\n{sql_query}")
-        logger.debug("------------------------")
-
-        logger.debug("--- 4. EXTRACTED ANSWER ---")
-        logger.debug(f"Type: {type(answer_string)}")
-        logger.debug(f"Content:\n{answer_string}")
-        logger.debug("---------------------------")
-        
-        # 2. Parse the answer string into its components
-        table_and_intro = ""
-        reasoning = ""
-        follow_ups = ""
-
-        if "Reasoning:" in answer_string:
-            parts = answer_string.split("Reasoning:", 1)
-            table_and_intro = parts[0]
-            remaining_text = "Reasoning:\n" + parts[1]
-            
-            if "Follow-up Questions:" in remaining_text:
-                reasoning_parts = remaining_text.split("Follow-up Questions:", 1)
-                reasoning = reasoning_parts[0]
-                follow_ups = reasoning_parts[1]
-            else:
-                reasoning = remaining_text
-        else:
-            table_and_intro = answer_string
-        
-        # 3. Construct the main message content (Table + Reasoning)
-        main_content = table_and_intro.strip() + "\n\n" + reasoning.strip()
-        
-        # Send initial "Processing..." message and get its ID
-        # This ensures thinking_message.id is available for logging and actions
-        await thinking_message.update()
-        interaction_id = thinking_message.id
-
-        # --- Update the history with the latest exchange ---
-        history.append((user_query, main_content))
-        cl.user_session.set("history", history)
-        # ----------------------------------------------------
-        thinking_message.content = main_content
-
-        # --- Create a list of actions and elements ---
-        actions = []
-
-        # Add the "View SQL" button if a query exists
-        if sql_query:
+            # --- Add CSV download button ---
             actions.append(
-                cl.Action(name="view_sql", value="sql", label="🧾 View SQL", payload={"sql_query": sql_query})
-            )
-        
-        if follow_ups:
-            actions.append(cl.Action(name="view_follow_ups", value="follow_ups", label="❓ Follow-ups", payload={"follow_ups": follow_ups.strip()}))
-
-        # Log the initial interaction with the message ID
-        log_to_bq(user_query=user_query, answer=main_content, interaction_id=interaction_id)
-
-        # --- Add CSV download button ---
-        actions.append(
-            cl.Action(
-                name="download_csv",
-                value="download_csv",
-                label="Download CSV",
-                payload={"answer_text": answer_string}
+                cl.Action(
+                    name="download_csv",
+                    value="download_csv",
+                    label="Download CSV",
+                    payload={}
+                )
             )
-        )
-        # --- Add thumbs up ---
-        actions.append(
-            cl.Action(
-                name="feedback_up",
-                value="thumbs_up",
-                label="👍",
-                payload={"user_query": user_query, "answer": answer_string}
+            # --- Add a chart of the answer table ---
+            table_rows = sum(1 for line in answer_string.splitlines() if line.strip().startswith("|")) - 2
+            if CHARTS_ENABLED and table_rows >= 2:
+                actions.append(
+                    cl.Action(
+                        name="view_chart",
+                        value="view_chart",
+                        label="📈 View Chart",
+                        payload={}
+                    )
+                )
+            # --- Add full export (re-runs the generated SQL) ---
+            if sql_query:
+                actions.append(
+                    cl.Action(
+                        name="export_data",
+                        value="export_data",
+                        label="📦 Full Export",
+                        payload={}
+                    )
+                )
+            # --- Add thumbs up ---
+            actions.append(
+                cl.Action(
+                    name="feedback_up",
+                    value="thumbs_up",
+                    label="👍",
+                    payload={}
+                )
             )
-        )
-        # --- Add thumbs down ---
-        actions.append(
-            cl.Action(
-                name="feedback_down",
-                value="thumbs_down",
-                label="👎",
-                payload={"user_query": user_query, "answer": answer_string}
+            # --- Add thumbs down ---
+            actions.append(
+                cl.Action(
+                    name="feedback_down",
+                    value="thumbs_down",
+                    label="👎",
+                    payload={}
+                )
             )
-        )
 
-        # 5. Attach the elements and update the final message
-        # Update the actions with the interaction_id in their payload
-        for action in actions:
-            action.payload["interaction_id"] = interaction_id
+            # 5. Attach the elements and update the final message
+            # Update the actions with the interaction_id in their payload
+            for action in actions:
+                action.payload["interaction_id"] = interaction_id
 
-        # Attach the elements and update the final message
-        thinking_message.actions = actions
-        await thinking_message.update()
-        await thinking_message.update() # Update with content and actions
+            # Attach the elements and update the final message
+            thinking_message.actions = actions
+            with tracer.span("message_update"):
+                await thinking_message.update() # Update with content and actions
 
-    except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}", exc_info=True)
-        log_to_bq(user_query=user_query, answer=None, status="error", error_message=str(e))
-        await cl.Message(
-            author="Error",
-            content=f"An unexpected error occurred: {str(e)}"
-        ).send()
+        except CircuitOpenError as e:
+            trace.attributes["outcome"] = "circuit_open"
+            log_to_bq(user_query=user_query, answer=None, status="rejected", error_message=str(e))
+            thinking_message.content = f"The analytics backend is having trouble right now, so Orion is pausing new questions. Please try again in about {e.retry_after:.0f} seconds."
+            await thinking_message.update()
+
+        except DeadlineExceeded as e:
+            trace.attributes["outcome"] = "deadline_exceeded"
+            log_to_bq(user_query=user_query, answer=None, status="error", error_message=str(e))
+            thinking_message.content = f"Generating this answer took longer than {e.deadline:.0f} seconds, so it was stopped. Please try again or narrow down the question."
+            await thinking_message.update()
+
+        except AdmissionRejected as e:
+            trace.attributes["outcome"] = "shed"
+            log_to_bq(user_query=user_query, answer=None, status="rejected", error_message=str(e))
+            thinking_message.content = "Orion is handling too many questions right now. Please try again in a minute."
+            await thinking_message.update()
+
+        except Exception as e:
+            trace.attributes["outcome"] = "error"
+            logger.error("An unexpected error occurred: %s", e, exc_info=True, extra={"interaction_id": interaction_id})
+            log_to_bq(user_query=user_query, answer=None, status="error", error_message=str(e))
+            # Replaces the placeholder, or whatever part of the answer was already streamed
+            thinking_message.content = f"An unexpected error occurred: {str(e)}"
+            thinking_message.actions = []
+            thinking_message.elements = []
+            await thinking_message.update()
 
 
 # --- Create a function to handle the SQL button click ---
@@ -249,52 +419,73 @@ async def on_action(action: cl.Action):
     """
     This function is called when the user clicks the 'View SQL' button.
     """
-    sql_query_from_payload = action.payload.get("sql_query")
+    result = await result_store.fetch(action.payload.get("interaction_id"))
     
-    if sql_query_from_payload:
+    if result and result.sql:
         # --- Format the content as a Markdown string ---
         await cl.Message(
             author="Generated SQL",
-            content=f"```sql\n{sql_query_from_payload}\n```"
+            content=f"```sql\n{result.sql}\n```"
         ).send()
         # ----------------------------------------------------
     else:
-        await cl.Message(content="Could not retrieve the SQL query from the action.").send()
+        await cl.Message(content="Could not retrieve the SQL query for this answer. Please ask the question again.").send()
 
 # --- Action callback for Follow-up Questions ---
 @cl.action_callback("view_follow_ups")
 async def on_follow_ups_action(action: cl.Action):
-    follow_ups_from_payload = action.payload.get("follow_ups")
-    if follow_ups_from_payload:
+    result = await result_store.fetch(action.payload.get("interaction_id"))
+    if result and result.follow_ups:
         await cl.Message(
             author="Suggested Follow-ups",
-            content=follow_ups_from_payload
+            content=result.follow_ups
         ).send()
     else:
         await cl.Message(content="Could not retrieve the follow-up questions.").send()
 
+# --- Action callback for the next page of a large table ---
+@cl.action_callback("next_page")
+async def on_next_page(action: cl.Action):
+    interaction_id = action.payload.get("interaction_id")
+    result = await result_store.fetch(interaction_id)
+    if result is None or result.pages is None:
+        await cl.Message(content="This table is no longer available. Please ask the question again.").send()
+        return
+
+    page = int(action.payload.get("page", 1))
+    actions = []
+    if page + 1 < result.pages.page_count:
+        actions.append(cl.Action(
+            name="next_page",
+            value="next_page",
+            label="➡️ Next page",
+            payload={"interaction_id": interaction_id, "page": page + 1},
+        ))
+    await cl.Message(author="Orion", content=result.pages.render_page(page), actions=actions).send()
+    await action.remove() # The following page now carries the button
+
+
 # --- Action callback for CSV download ---
 @cl.action_callback("download_csv")
 async def on_download_csv(action: cl.Action):
-    answer_text = action.payload.get("answer_text", "")
-    if not answer_text.strip():
-        await cl.Message("No data available to download.").send()
+    interaction_id = action.payload.get("interaction_id")
+    result = await result_store.fetch(interaction_id)
+    if result is None or not result.answer.strip():
+        await cl.Message("No data available to download. Please ask the question again.").send()
         return
 
     try:
-        df = markdown_table_to_df(answer_text)
-
-        # Convert numeric columns automatically
-        for col in df.columns[1:]:
-            df[col] = pd.to_numeric(df[col], errors='ignore')
+        # Parsed (with numeric columns converted) once and cached in the result store
+        df = await result_store.load_frame(interaction_id)
+        if df is None:
+            await cl.Message("No data available to download. Please ask the question again.").send()
+            return
 
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
+        csv_bytes = await run_blocking(dataframe_to_csv_bytes, df)
 
         file_element = cl.File(
             name="copilot_result.csv",
-            content=csv_buffer.getvalue().encode('utf-8'),
+            content=csv_bytes,
             display="inline"
         )
 
@@ -303,28 +494,105 @@ async def on_download_csv(action: cl.Action):
             elements=[file_element]
         ).send()
 
-        logger.info(f"CSV generated successfully")
+        logger.info("CSV generated successfully")
 
     except ValueError as e:
-        logger.warning(f"Could not generate CSV from markdown: {e}")
+        logger.warning("Could not generate CSV from markdown: %s", e)
         await cl.Message(f"Could not detect a valid table in the response to generate a CSV.").send()
     except Exception as e:
-        logger.error(f"Failed to generate CSV: {str(e)}")
+        logger.error("Failed to generate CSV: %s", e)
         await cl.Message(f"An error occurred while generating the CSV: {str(e)}").send()
 
 
+# --- Action callback for charts ---
+@cl.action_callback("view_chart")
+async def on_view_chart(action: cl.Action):
+    interaction_id = action.payload.get("interaction_id")
+    result = await result_store.fetch(interaction_id)
+    if result is None or not result.answer.strip():
+        await cl.Message("No data available to chart. Please ask the question again.").send()
+        return
+
+    try:
+        df = await result_store.load_frame(interaction_id)
+        spec = infer_chart_spec(
+            df, title=result.user_query, max_points=config.CHART_MAX_POINTS, max_bars=config.CHART_MAX_BARS
+        ) if df is not None else None
+        if spec is None:
+            await cl.Message("This answer has no numeric column to chart.").send()
+            return
+
+        # Rendered on the CPU worker pool and cached per interaction and chart spec
+        with tracer.span("render_chart", kind=spec.kind):
+            image = await chart_cache.get_or_render(interaction_id, df, spec)
+
+        await cl.Message(
+            content=f"**Chart:** {', '.join(spec.y)} by {spec.x}",
+            elements=[cl.Image(name="copilot_chart.png", content=image, mime="image/png", display="inline", size="large")]
+        ).send()
+
+    except ValueError as e:
+        logger.warning("Could not build a chart from markdown: %s", e)
+        await cl.Message("Could not detect a valid table in the response to chart.").send()
+    except Exception as e:
+        logger.error("Failed to render chart: %s", e, exc_info=True)
+        await cl.Message(f"An error occurred while rendering the chart: {str(e)}").send()
+
+
+# --- Action callback for full-fidelity export ---
+@cl.action_callback("export_data")
+async def on_export_data(action: cl.Action):
+    result = await result_store.fetch(action.payload.get("interaction_id"))
+    if result is None or not result.sql:
+        await cl.Message("There is no query to export for this answer. Please ask the question again.").send()
+        return
+
+    choice = await cl.AskActionMessage(
+        content="Choose an export format. The query is re-run to export the complete, unrounded result.",
+        actions=[
+            cl.Action(name=f"export_{fmt}", payload={"format": fmt}, label=fmt.upper())
+            for fmt in EXPORT_FORMATS
+        ],
+    ).send()
+    if not choice:
+        return
+    export_format = choice.get("payload", {}).get("format")
+
+    try:
+        export = await run_blocking(run_export, result.sql, export_format, get_export_backend(), config.EXPORT_DIR)
+    except ExportError as e:
+        await cl.Message(f"Could not export this answer: {e}").send()
+        return
+    except Exception as e:
+        logger.error("Failed to export query results: %s", e, exc_info=True)
+        await cl.Message(f"An error occurred while exporting the data: {str(e)}").send()
+        return
+
+    try:
+        file_element = cl.File(
+            name=f"copilot_export{EXPORT_FORMATS[export_format][0]}",
+            path=export.path,
+            mime=export.mime,
+            display="inline"
+        )
+        await cl.Message(
+            content=f"**Full Export:** {export.rows:,} rows - click below to download.",
+            elements=[file_element]
+        ).send()
+    finally:
+        os.remove(export.path) # Chainlit keeps its own copy of the file
+
+
 @cl.action_callback("feedback_up")
 async def handle_feedback_up(action: cl.Action):
     user = cl.user_session.get("user")
     user_id = user.identifier if user else "anonymous"
-    user_query = action.payload.get("user_query")
-    answer = action.payload.get("answer")
     interaction_id = action.payload.get("interaction_id")
 
-    logger.info(f"[FEEDBACK] 👍 submitted by {user_id} (Interaction ID: {interaction_id})")
+    logger.info("[FEEDBACK] 👍 submitted by %s", user_id, extra={"interaction_id": interaction_id, "feedback": "positive"})
 
-    # Update the existing row with feedback
-    log_to_bq(user_query=user_query, answer=answer, user_feedback='positive', interaction_id=interaction_id)
+    # Record an append-only feedback event for this interaction
+    log_to_bq(user_query=None, answer=None, user_feedback='positive', interaction_id=interaction_id)
     await cl.Message(author="Orion", content="Feedback submitted!").send()
 
 
@@ -332,12 +600,10 @@ async def handle_feedback_up(action: cl.Action):
 async def handle_feedback_down(action: cl.Action):
     user = cl.user_session.get("user")
     user_id = user.identifier if user else "anonymous"
-    user_query = action.payload.get("user_query")
-    answer = action.payload.get("answer")
     interaction_id = action.payload.get("interaction_id")
 
-    logger.info(f"[FEEDBACK] 👎 submitted by {user_id} (Interaction ID: {interaction_id})")
+    logger.info("[FEEDBACK] 👎 submitted by %s", user_id, extra={"interaction_id": interaction_id, "feedback": "negative"})
 
-    # Update the existing row with feedback
-    log_to_bq(user_query=user_query, answer=answer, user_feedback='negative', interaction_id=interaction_id)
+    # Record an append-only feedback event for this interaction
+    log_to_bq(user_query=None, answer=None, user_feedback='negative', interaction_id=interaction_id)
     await cl.Message(author="Orion", content="Feedback submitted!").send()
\ No newline at end of file
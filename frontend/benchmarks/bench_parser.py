@@ -0,0 +1,111 @@
+"""
+Micro-benchmark for `parse_tool_response`.
+
+First checks the parser, and which responses count as successful (and may
+be cached), against the fixtures in `fixtures/malformed_responses.json`, then times it against the previous
+regex-based implementation on synthetic responses of growing size. A fixture
+with `max_ms` also fails when parsing it takes longer (e.g. a large truncated
+response, which must not take quadratic time).
+
+Usage (from the frontend directory):
+    python benchmarks/bench_parser.py [--rows 10 1000 10000] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_parser import parse_tool_response  # noqa: E402
+
+FIXTURES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "malformed_responses.json")
+
+
+def legacy_parse_tool_response(response_text: str) -> dict:
+    """The previous implementation: whole-string json.loads plus a non-greedy regex."""
+    if not response_text:
+        return {"SQL Generated": "", "Answer": ""}
+    try:
+        actual_content_string = json.loads(response_text)
+    except (json.JSONDecodeError, TypeError):
+        actual_content_string = response_text
+    parsed_objects = []
+    for block in re.findall(r'\{.*?\}', str(actual_content_string), flags=re.S):
+        try:
+            parsed_objects.append(json.loads(block))
+        except json.JSONDecodeError:
+            pass
+    result = {"SQL Generated": "", "Answer": ""}
+    for item in parsed_objects:
+        if "SQL Generated" in item:
+            result["SQL Generated"] = item["SQL Generated"]
+        elif "Answer" in item:
+            result["Answer"] = item["Answer"]
+    return result
+
+
+def check_fixtures() -> int:
+    """Runs the parser over every fixture and returns the number of failures."""
+    with open(FIXTURES_FILE, "r") as f:
+        cases = json.load(f)
+
+    failures = 0
+    for case in cases:
+        started = time.perf_counter()
+        parsed = parse_tool_response(case["response"])
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        legacy = legacy_parse_tool_response(case["response"])
+        mismatches = {
+            field: (getattr(parsed, field), expected)
+            for field, expected in case["expected"].items()
+            if getattr(parsed, field) != expected
+        }
+        legacy_ok = legacy.get("Answer") == case["expected"].get("answer", legacy.get("Answer"))
+        too_slow = "max_ms" in case and elapsed_ms > case["max_ms"]
+        status = "FAIL" if mismatches or too_slow else "ok"
+        print(f"  [{status}] {case['name']} (legacy parser {'ok' if legacy_ok else 'wrong'})")
+        for field, (actual, expected) in mismatches.items():
+            print(f"      {field}: expected {expected!r}, got {actual!r}")
+        if too_slow:
+            print(f"      took {elapsed_ms:.1f}ms, budget {case['max_ms']}ms")
+        failures += bool(mismatches or too_slow)
+    return failures
+
+
+def synthetic_response(rows: int) -> str:
+    """Builds a tool response with a `rows`-row answer table."""
+    table_lines = ["| month_start | region | disbursement_cr | count |", "|---|---|---|---|"]
+    table_lines += [f"| 2025-{i % 12 + 1:02d}-01 | Region {{{i % 7}}} | {i * 1.25:.2f} | {i} |" for i in range(rows)]
+    answer = "\n".join(table_lines) + "\n\nReasoning: Synthetic data.\n\nFollow-up Questions:\n- Next?"
+    sql = "WITH base AS (SELECT * FROM `t`) SELECT * FROM base"
+    return json.dumps({"SQL Generated": sql}) + "\n" + json.dumps({"Answer": answer})
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000, 10000])
+    arg_parser.add_argument("--repeat", type=int, default=20)
+    args = arg_parser.parse_args()
+
+    print("Fixtures:")
+    failures = check_fixtures()
+
+    print("\nTimings (ms per parse):")
+    print(f"  {'rows':>8} {'bytes':>10} {'parser':>10} {'legacy':>10}")
+    for rows in args.rows:
+        response = synthetic_response(rows)
+        current = min(timeit.repeat(lambda: parse_tool_response(response), number=1, repeat=args.repeat))
+        legacy = min(timeit.repeat(lambda: legacy_parse_tool_response(response), number=1, repeat=args.repeat))
+        print(f"  {rows:>8} {len(response):>10} {current * 1000:>10.3f} {legacy * 1000:>10.3f}")
+
+    if failures:
+        print(f"\n{failures} fixture(s) failed.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Cold-start benchmark for the Chainlit app.
+
+Runs `import app` in fresh interpreters with `-X importtime` and reports the
+import time of each module the app pulls in, then runs the app's startup hook
+against the mock toolbox and reports the time until the app is ready to
+serve. Fails (exit code 1) when a timing exceeds its budget or when a heavy
+module that should load lazily is imported at startup.
+
+Usage (from the frontend directory):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 5 --budget benchmarks/startup_budget.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FRONTEND_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BUDGET = os.path.join(BENCH_DIR, "startup_budget.json")
+
+# Runs in the child: imports the app, then runs its startup hook against the mock toolbox.
+CHILD_CODE = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+modules = sorted(sys.modules)
+
+sys.path.insert(0, {bench_dir!r})
+from mock_toolbox import DEFAULT_RECORDINGS, MockToolbox, load_recordings, start_mock_toolbox
+from toolbox_pool import toolbox_pool
+
+async def ready():
+    runner, url = await start_mock_toolbox(MockToolbox(load_recordings([DEFAULT_RECORDINGS]), latency_ms=0))
+    toolbox_pool.url = url
+    hook_started = time.perf_counter()
+    await app.startup()
+    hook_seconds = time.perf_counter() - hook_started
+    await app.shutdown()
+    await runner.cleanup()
+    return hook_seconds
+
+startup_seconds = asyncio.run(ready())
+print("BENCH_RESULT " + json.dumps({{
+    "import_seconds": imported - started,
+    "startup_hook_seconds": startup_seconds,
+    "modules": modules,
+}}))
+"""
+
+
+def parse_importtime(stderr: str) -> List[Tuple[int, int, int, str]]:
+    """Parses `-X importtime` output into (depth, self_us, cumulative_us, module) tuples."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((depth, int(self_us), int(cumulative_us), name.strip()))
+    return entries
+
+
+def app_imports(entries: List[Tuple[int, int, int, str]]) -> Dict[str, int]:
+    """Cumulative import time (us) of each module imported directly by `app`."""
+    # importtime prints children before their parent, so collect depth-1 entries until `app` closes
+    direct = {}
+    pending = {}
+    for depth, _, cumulative_us, name in entries:
+        if depth == 0:
+            if name == "app":
+                direct = pending
+            pending = {}
+        elif depth == 1:
+            pending[name] = cumulative_us
+    return direct
+
+
+def run_once(env: Dict[str, str]) -> dict:
+    code = CHILD_CODE.format(bench_dir=BENCH_DIR)
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=FRONTEND_DIR, env=env, capture_output=True, text=True, timeout=300,
+    )
+    wall = time.perf_counter() - started
+    result_line = next((line for line in proc.stdout.splitlines() if line.startswith("BENCH_RESULT ")), None)
+    if proc.returncode != 0 or result_line is None:
+        sys.stderr.write(proc.stderr[-4000:])
+        raise RuntimeError(f"Startup child failed with exit code {proc.returncode}")
+
+    result = json.loads(result_line[len("BENCH_RESULT "):])
+    result["process_seconds"] = wall
+    result["app_imports_us"] = app_imports(parse_importtime(proc.stderr))
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters to run; medians are reported.")
+    arg_parser.add_argument("--budget", default=DEFAULT_BUDGET, help="JSON file with the timing budgets.")
+    arg_parser.add_argument("--top", type=int, default=15, help="Slowest app imports to list.")
+    arg_parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = arg_parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        "METRICS_PORT": "0",
+        "PREFETCH_ENABLED": "false",
+        "ANSWER_CACHE_DB_PATH": "",
+        "LOG_LEVEL": "WARNING",
+    })
+
+    runs = [run_once(env) for _ in range(args.runs)]
+    report = {
+        "runs": args.runs,
+        "import_app_ms": statistics.median(r["import_seconds"] for r in runs) * 1000,
+        "startup_hook_ms": statistics.median(r["startup_hook_seconds"] for r in runs) * 1000,
+        "ready_ms": statistics.median(r["import_seconds"] + r["startup_hook_seconds"] for r in runs) * 1000,
+        "process_ms": statistics.median(r["process_seconds"] for r in runs) * 1000,
+        "app_imports_ms": {
+            name: statistics.median(r["app_imports_us"].get(name, 0) for r in runs) / 1000
+            for name in runs[0]["app_imports_us"]
+        },
+    }
+
+    with open(args.budget, "r") as f:
+        budget = json.load(f)
+    failures = []
+    for key in ("import_app_ms", "ready_ms"):
+        if key in budget and report[key] > budget[key]:
+            failures.append(f"{key} {report[key]:.0f}ms exceeds the budget of {budget[key]:.0f}ms")
+    loaded = set(runs[0]["modules"])
+    for module in budget.get("lazy_modules", []):
+        if module in loaded:
+            failures.append(f"{module} is imported at startup but should load lazily")
+    report["failures"] = failures
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"import app:    {report['import_app_ms']:8.0f} ms (budget {budget.get('import_app_ms', '-')})")
+        print(f"startup hook:  {report['startup_hook_ms']:8.0f} ms")
+        print(f"ready:         {report['ready_ms']:8.0f} ms (budget {budget.get('ready_ms', '-')})")
+        print(f"process total: {report['process_ms']:8.0f} ms")
+        print(f"\nSlowest imports made by app (cumulative, median of {args.runs}):")
+        slowest = sorted(report["app_imports_ms"].items(), key=lambda item: item[1], reverse=True)[:args.top]
+        for name, ms in slowest:
+            print(f"  {name:<32} {ms:8.1f} ms")
+        for failure in failures:
+            print(f"BUDGET EXCEEDED: {failure}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
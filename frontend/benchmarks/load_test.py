@@ -0,0 +1,391 @@
+"""
+Load test and replay benchmark for the Chainlit frontend.
+
+Starts the mock toolbox server, then drives N concurrent simulated Chainlit
+sessions through `app.start_chat`, `app.main` and the action callbacks
+(View SQL, Download CSV, View Chart, Next page, feedback). Tool calls go
+through the real toolbox_core ToolboxClient over the mock's MCP endpoint
+(streamed answers read its native endpoint; use --no-streaming for the
+buffered client path only). Interaction logs go through the real
+`log_writer`, but into a fake BigQuery sink with configurable latency.
+
+Reports p50/p95/p99 latency per stage, message throughput, event-loop stall
+time and log-writer flush latency. Results can be saved as a baseline and
+later runs compared against it; the script exits non-zero on a regression.
+
+Usage (from the frontend directory):
+    python benchmarks/load_test.py --sessions 50 --messages 3 --latency-ms 1500
+    python benchmarks/load_test.py --save-baseline benchmarks/baselines/load_test.json
+    python benchmarks/load_test.py --compare benchmarks/baselines/load_test.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+FRONTEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FRONTEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Stages whose p95 is compared against the baseline.
+COMPARED_STAGES = ("first_token", "main", "view_sql", "download_csv", "view_chart", "next_page", "feedback")
+
+# Stages timed by tracing.py inside the app, reported as bucketed p95s.
+APP_STAGES = (
+    "send_placeholder", "select_schema", "build_context", "answer_cache_get", "load_toolset", "ask_data_insights",
+    "first_token", "parse_tool_response", "answer_cache_put", "message_update", "log_to_bq", "bigquery_flush",
+)
+
+DEFAULT_RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings", "ask_data_insights.jsonl")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values`."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class StageTimer:
+    """Collects durations (in seconds) per stage."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, dict]:
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+
+
+class LoopStallMonitor:
+    """Measures how late the event loop wakes up a task that sleeps `interval` seconds."""
+
+    def __init__(self, interval: float = 0.01, threshold: float = 0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_stall = 0.0
+        self.total_stall = 0.0
+        self.stalls_over_50ms = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lateness = time.perf_counter() - expected
+            if lateness > self.threshold:
+                self.total_stall += lateness
+                self.max_stall = max(self.max_stall, lateness)
+                self.stalls_over_50ms += lateness > 0.05
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self) -> dict:
+        return {
+            "max_stall_ms": self.max_stall * 1000,
+            "total_stall_ms": self.total_stall * 1000,
+            "stalls_over_50ms": self.stalls_over_50ms,
+        }
+
+
+class FakeBigQuerySink:
+    """Stands in for the BigQuery load job; sleeps `latency_ms` per flush and counts rows."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.rows_by_table: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, table_full_id: str, rows: List[dict]):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        with self._lock:
+            self.rows_by_table[table_full_id] = self.rows_by_table.get(table_full_id, 0) + len(rows)
+
+
+def make_recording_emitter():
+    """Builds a Chainlit stub emitter that records actions and the first streamed token."""
+    from chainlit.emitter import BaseChainlitEmitter
+
+    class RecordingEmitter(BaseChainlitEmitter):
+        def __init__(self, session):
+            super().__init__(session)
+            self.reset()
+
+        def reset(self):
+            self.actions: Dict[str, dict] = {}
+            self.first_token_at = None
+
+        def _token(self):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+
+        async def emit(self, event, data):
+            if event == "action":
+                self.actions[data["name"]] = data
+
+        async def stream_start(self, step_dict):
+            self._token()
+
+        async def send_token(self, id, token, is_sequence=False, is_input=False):
+            self._token()
+
+    return RecordingEmitter
+
+
+async def run_session(index: int, questions: List[str], args, timer: StageTimer, app, emitter_class):
+    """Simulates one user: starts a chat, asks questions and clicks the actions."""
+    import chainlit as cl
+    from chainlit.context import ChainlitContext, context_var
+    from chainlit.session import HTTPSession
+
+    session = HTTPSession(
+        id=str(uuid.uuid4()),
+        thread_id=str(uuid.uuid4()),
+        token=None,
+        user=cl.User(identifier=f"loadtest-{index}"),
+        client_type="webapp",
+    )
+    emitter = emitter_class(session)
+    context_var.set(ChainlitContext(session, emitter))
+
+    try:
+        await app.start_chat()
+        for _ in range(args.messages):
+            emitter.reset()
+            started = time.perf_counter()
+            await app.main(cl.Message(content=random.choice(questions)))
+            timer.record("main", time.perf_counter() - started)
+            if emitter.first_token_at is not None:
+                timer.record("first_token", emitter.first_token_at - started)
+
+            callbacks = [
+                ("view_sql", "view_sql", app.on_action),
+                ("download_csv", "download_csv", app.on_download_csv),
+                ("view_chart", "view_chart", app.on_view_chart),
+                ("next_page", "next_page", app.on_next_page),
+                ("feedback_up", "feedback", app.handle_feedback_up),
+            ]
+            for action_name, stage, callback in callbacks:
+                action = emitter.actions.get(action_name)
+                if action is None:
+                    continue
+                started = time.perf_counter()
+                await callback(cl.Action(name=action_name, payload=action["payload"]))
+                timer.record(stage, time.perf_counter() - started)
+
+            if args.think_ms:
+                await asyncio.sleep(random.uniform(0, args.think_ms / 1000.0))
+    finally:
+        await session.delete()
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Returns a description of every p95 (and loop stall) regression beyond `tolerance`."""
+    regressions = []
+    for stage in COMPARED_STAGES:
+        current = report["stages"].get(stage, {}).get("p95_ms")
+        previous = baseline.get("stages", {}).get(stage, {}).get("p95_ms")
+        if current is None or not previous:
+            continue
+        if current > previous * (1 + tolerance):
+            regressions.append(f"{stage} p95 {current:.1f}ms vs baseline {previous:.1f}ms")
+
+    current_stall = report["event_loop"]["max_stall_ms"]
+    previous_stall = baseline.get("event_loop", {}).get("max_stall_ms")
+    if previous_stall and current_stall > max(previous_stall * (1 + tolerance), previous_stall + 20):
+        regressions.append(f"max event-loop stall {current_stall:.1f}ms vs baseline {previous_stall:.1f}ms")
+    return regressions
+
+
+def print_report(report: dict):
+    print(f"\nSessions: {report['sessions']}  Messages: {report['messages']}  Wall time: {report['wall_seconds']:.2f}s")
+    print(f"Throughput: {report['throughput_msgs_per_s']:.2f} messages/s  Toolbox calls: {report['toolbox_invocations']}")
+    print(f"\n  {'stage':<14} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<14} {stats['count']:>6} {stats['p50_ms']:>10.1f} {stats['p95_ms']:>10.1f} {stats['p99_ms']:>10.1f} {stats['max_ms']:>10.1f}")
+    print("\nApp stage p95 (histogram bucket upper bound):")
+    for stage, p95 in report["app_stage_p95_ms"].items():
+        print(f"  {stage:<20} <= {p95:.0f}ms")
+    loop = report["event_loop"]
+    print(f"\nEvent loop: max stall {loop['max_stall_ms']:.1f}ms, total {loop['total_stall_ms']:.1f}ms, {loop['stalls_over_50ms']} stalls > 50ms")
+    shed = report["admission"]
+    print(f"Admission: {shed['admitted']} admitted, {shed['queued']} queued, {shed['rejected']} shed")
+    writer = report["log_writer"]
+    print(f"Log writer: {writer['rows_written']} rows in {writer['flushes']} flushes, max flush {writer['max_flush_seconds'] * 1000:.1f}ms, dropped {writer['rows_dropped']}")
+
+
+async def run(args) -> dict:
+    import app
+    import config
+    from log_writer import log_writer
+    from mock_toolbox import MockToolbox, load_recordings, start_mock_toolbox
+    from toolbox_pool import toolbox_pool
+    from tracing import STAGE_METRIC, metrics
+    from admission import admission
+
+    questions = []
+    for path in args.recordings:
+        with open(path, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        questions += [record.get("question") or record.get("user_query") for record in records]
+
+    mock = MockToolbox(load_recordings(args.recordings), args.latency_ms, args.jitter, args.chunks, args.error_rate)
+    runner, base_url = await start_mock_toolbox(mock)
+
+    config.TOOLBOX_URL = base_url
+    toolbox_pool.url = base_url # The real ToolboxClient, over the mock's MCP endpoint
+    sink = FakeBigQuerySink(args.bq_latency_ms)
+    log_writer.sink = sink
+
+    timer = StageTimer()
+    monitor = LoopStallMonitor()
+    emitter_class = make_recording_emitter()
+
+    await app.startup()
+    monitor.start()
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(run_session(i, questions, args, timer, app, emitter_class) for i in range(args.sessions)),
+        return_exceptions=True,
+    )
+    wall = time.perf_counter() - started
+    await monitor.stop()
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    for error in errors[:5]:
+        print(f"Session failed: {error!r}")
+
+    await app.shutdown()
+    await runner.cleanup()
+
+    messages = len(timer.samples.get("main", []))
+    return {
+        "sessions": args.sessions,
+        "messages": messages,
+        "failed_sessions": len(errors),
+        "wall_seconds": wall,
+        "throughput_msgs_per_s": messages / wall if wall else 0.0,
+        "toolbox_invocations": mock.invocations,
+        "stages": timer.summary(),
+        "event_loop": monitor.summary(),
+        "log_writer": log_writer.stats(),
+        "admission": admission.stats(),
+        "app_stage_p95_ms": {
+            stage: p95 * 1000
+            for stage in APP_STAGES
+            if (p95 := metrics.percentile(STAGE_METRIC, 95, stage=stage, status="ok")) is not None
+        },
+        "bigquery_rows": sink.rows_by_table,
+        "settings": {
+            "latency_ms": args.latency_ms,
+            "bq_latency_ms": args.bq_latency_ms,
+            "messages_per_session": args.messages,
+            "streaming": not args.no_streaming,
+            "answer_cache": args.answer_cache,
+        },
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--sessions", type=int, default=20, help="Concurrent simulated sessions.")
+    arg_parser.add_argument("--messages", type=int, default=3, help="Questions asked per session.")
+    arg_parser.add_argument("--think-ms", type=float, default=200.0, help="Max random pause between questions.")
+    arg_parser.add_argument("--recordings", nargs="+", default=[DEFAULT_RECORDINGS])
+    arg_parser.add_argument("--latency-ms", type=float, default=1000.0, help="Median mock toolbox latency.")
+    arg_parser.add_argument("--jitter", type=float, default=0.3, help="Log-normal sigma of the toolbox latency.")
+    arg_parser.add_argument("--chunks", type=int, default=8, help="Chunks the mock response is streamed in.")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of toolbox calls that fail.")
+    arg_parser.add_argument("--bq-latency-ms", type=float, default=500.0, help="Latency of each fake BigQuery flush.")
+    arg_parser.add_argument("--no-streaming", action="store_true", help="Use the buffered tool call.")
+    arg_parser.add_argument("--answer-cache", action="store_true", help="Leave the answer cache enabled.")
+    arg_parser.add_argument("--session-backend", choices=["memory", "sqlite", "redis"], default="memory", help="Session store backend.")
+    arg_parser.add_argument("--save-baseline", metavar="PATH")
+    arg_parser.add_argument("--compare", metavar="PATH")
+    arg_parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p95 regression ratio.")
+    arg_parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    arg_parser.add_argument("--verbose", action="store_true")
+    args = arg_parser.parse_args()
+
+    # Configure the app before config.py is imported.
+    os.chdir(FRONTEND_DIR)
+    os.environ["STREAMING_ENABLED"] = "false" if args.no_streaming else "true"
+    os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.answer_cache else "false"
+    os.environ["ANSWER_CACHE_DB_PATH"] = ""
+    os.environ.setdefault("LOG_FLUSH_INTERVAL_SECONDS", "1")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ["PREFETCH_ENABLED"] = "false"
+    # Spool the logs (and keep SQLite session state) in a scratch directory removed after the run
+    scratch_dir = tempfile.mkdtemp(prefix="load_test_")
+    os.environ.setdefault("LOG_SPOOL_DIR", os.path.join(scratch_dir, "spool"))
+    os.environ.setdefault("LOG_SPOOL_SEGMENT_SECONDS", "1")
+    os.environ["SESSION_BACKEND"] = args.session_backend
+    if args.session_backend == "sqlite":
+        os.environ.setdefault("SESSION_DB_PATH", os.path.join(scratch_dir, "session_state.sqlite3"))
+    if not args.verbose:
+        logging.getLogger("Nostradamus-CoPilot").setLevel(logging.WARNING)
+        from logger import logger
+        logger.setLevel(logging.WARNING)
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    exit_code = 1 if report["failed_sessions"] else 0
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            exit_code = 1
+        else:
+            print(f"\nNo regressions against {args.compare} (tolerance {args.tolerance:.0%}).")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
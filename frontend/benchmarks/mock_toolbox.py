@@ -0,0 +1,246 @@
+"""
+Local mock of the toolbox server for load tests.
+
+Serves the MCP endpoint the ToolboxClient talks to (`/mcp/`, stateless
+JSON-RPC `tools/list` and `tools/call` as in MCP 2026-07-28), so the real
+toolbox_core client path is exercised, and the native HTTP API
+(`/api/toolset/{name}` and `/api/tool/{name}/invoke`) that the streaming
+path reads. Both replay recorded `ask_data_insights` responses with
+configurable latency; the native response envelope is written in chunks.
+
+Recordings are JSONL files with either `{"question": ..., "response": ...}`
+lines, or rows exported from the interaction log
+(`{"user_query": ..., "model_answer": ...}`).
+
+Usage (from the frontend directory):
+    python benchmarks/mock_toolbox.py --port 5055 --latency-ms 1500
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from answer_cache import normalize_question  # noqa: E402
+
+DEFAULT_RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings", "ask_data_insights.jsonl")
+# bigquery_get_table_info result (BigQuery Go client TableMetadata) served for every table
+TABLE_INFO_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "table_info.json")
+
+_CURRENT_QUESTION = re.compile(r"Current Question:\s*(.*)\s*$", re.S)
+
+# MCP versions the mock speaks (the stateless protocol needs no initialize handshake)
+MCP_PROTOCOL_VERSIONS = ["2026-07-28"]
+UNSUPPORTED_PROTOCOL_VERSION = -32022
+
+# name -> (description, [(parameter, description)]); every parameter is a string
+TOOLS = {
+    "ask_data_insights": (
+        "Mock data insights tool.",
+        [("user_query_with_context", "The question with its context."), ("table_references", "JSON list of table references.")],
+    ),
+    "bigquery_get_table_info": (
+        "Mock table metadata tool.",
+        [("dataset", "Dataset ID."), ("table", "Table ID.")],
+    ),
+}
+
+
+class MockToolError(Exception):
+    """A failed tool call, answered as an HTTP error or a JSON-RPC error."""
+
+    def __init__(self, message: str, status: int = 500):
+        super().__init__(message)
+        self.status = status
+
+
+def load_recordings(paths: List[str]) -> Dict[str, str]:
+    """Loads recorded responses keyed by normalized question."""
+    recordings = {}
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "response" in record:
+                    question, response = record["question"], record["response"]
+                else:
+                    # A row captured from the interaction log
+                    question = record.get("user_query") or ""
+                    response = json.dumps({"Answer": record.get("model_answer") or ""})
+                recordings[normalize_question(question)] = response
+    if not recordings:
+        raise ValueError("No recorded responses were loaded.")
+    return recordings
+
+
+class MockToolbox:
+    """Replays recorded responses with a log-normal latency around `latency_ms`."""
+
+    def __init__(self, recordings: Dict[str, str], latency_ms: float = 1000.0, jitter: float = 0.3, chunks: int = 8, error_rate: float = 0.0):
+        self.recordings = recordings
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.chunks = max(1, chunks)
+        self.error_rate = error_rate
+        self.invocations = 0
+
+    def pick_response(self, query_with_context: str) -> str:
+        match = _CURRENT_QUESTION.search(query_with_context or "")
+        question = normalize_question(match.group(1)) if match else ""
+        if question in self.recordings:
+            return self.recordings[question]
+        return random.choice(list(self.recordings.values()))
+
+    def _delay(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.jitter) * self.latency_ms / 1000.0
+
+    async def call_tool(self, tool_name: str, params: dict, delay: float) -> str:
+        """Returns the tool result, or raises MockToolError after `delay` for a simulated failure."""
+        self.invocations += 1
+        if tool_name == "bigquery_get_table_info":
+            with open(TABLE_INFO_FIXTURE, "r") as f:
+                return f.read()
+        if tool_name != "ask_data_insights":
+            raise MockToolError(f"unknown tool {tool_name}", status=404)
+        if self.error_rate and random.random() < self.error_rate:
+            await asyncio.sleep(delay)
+            raise MockToolError("mock backend failure")
+        return self.pick_response(params.get("user_query_with_context", ""))
+
+    # --- MCP ---
+
+    async def mcp(self, request: web.Request) -> web.Response:
+        message = await request.json()
+        method, params, request_id = message.get("method"), message.get("params") or {}, message.get("id")
+        if request_id is None:
+            return web.Response(status=202) # A notification
+
+        version = request.headers.get("MCP-Protocol-Version")
+        if version not in MCP_PROTOCOL_VERSIONS:
+            return self._rpc_error(request_id, UNSUPPORTED_PROTOCOL_VERSION, "Unsupported protocol version", {"supported": MCP_PROTOCOL_VERSIONS})
+        result_meta = {"io.modelcontextprotocol/serverInfo": {"name": "mock-toolbox", "version": "mock"}}
+
+        if method == "tools/list":
+            tools = [
+                {
+                    "name": name,
+                    "description": description,
+                    "inputSchema": {
+                        "type": "object",
+                        "properties": {param: {"type": "string", "description": text} for param, text in parameters},
+                        "required": [param for param, _ in parameters],
+                    },
+                }
+                for name, (description, parameters) in TOOLS.items()
+            ]
+            return self._rpc_result(request_id, {"tools": tools, "_meta": result_meta})
+
+        if method == "tools/call":
+            delay = self._delay() if params.get("name") == "ask_data_insights" else 0.0
+            try:
+                text = await self.call_tool(params.get("name"), params.get("arguments") or {}, delay)
+            except MockToolError as e:
+                return self._rpc_error(request_id, -32603, str(e))
+            await asyncio.sleep(delay) # A buffered answer: nothing is sent until the whole result is ready
+            return self._rpc_result(request_id, {"content": [{"type": "text", "text": text}], "isError": False, "_meta": result_meta})
+
+        return self._rpc_error(request_id, -32601, f"Method not found: {method}")
+
+    @staticmethod
+    def _rpc_result(request_id, result: dict) -> web.Response:
+        return web.json_response({"jsonrpc": "2.0", "id": request_id, "result": result})
+
+    @staticmethod
+    def _rpc_error(request_id, code: int, message: str, data: Optional[dict] = None) -> web.Response:
+        error = {"code": code, "message": message}
+        if data is not None:
+            error["data"] = data
+        return web.json_response({"jsonrpc": "2.0", "id": request_id, "error": error})
+
+    # --- Native HTTP API ---
+
+    async def toolset(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "serverVersion": "mock",
+            "tools": {
+                name: {
+                    "description": description,
+                    "parameters": [{"name": param, "type": "string", "description": text} for param, text in parameters],
+                    "authRequired": [],
+                }
+                for name, (description, parameters) in TOOLS.items()
+            },
+        })
+
+    async def invoke(self, request: web.Request) -> web.StreamResponse:
+        tool_name = request.match_info["tool_name"]
+        params = await request.json()
+        delay = self._delay() if tool_name == "ask_data_insights" else 0.0
+        try:
+            result = await self.call_tool(tool_name, params, delay)
+        except MockToolError as e:
+            return web.json_response({"error": str(e)}, status=e.status)
+        if tool_name != "ask_data_insights":
+            return web.json_response({"result": result})
+
+        body = json.dumps({"result": result}).encode("utf-8")
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+
+        # Spend a third of the latency before the first byte and spread the rest over the chunks.
+        await asyncio.sleep(delay / 3)
+        chunk_size = max(1, len(body) // self.chunks + 1)
+        for start in range(0, len(body), chunk_size):
+            await response.write(body[start:start + chunk_size])
+            await asyncio.sleep(2 * delay / 3 / self.chunks)
+        await response.write_eof()
+        return response
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/mcp/", self.mcp)
+        app.router.add_post("/mcp/{toolset_name}", self.mcp)
+        app.router.add_get("/api/toolset/{toolset_name}", self.toolset)
+        app.router.add_get("/api/toolset/", self.toolset)
+        app.router.add_post("/api/tool/{tool_name}/invoke", self.invoke)
+        return app
+
+
+async def start_mock_toolbox(mock: MockToolbox, host: str = "127.0.0.1", port: int = 0) -> Tuple[web.AppRunner, str]:
+    """Starts `mock` in the running loop and returns the runner and its base URL."""
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=5055)
+    arg_parser.add_argument("--recordings", nargs="+", default=[DEFAULT_RECORDINGS])
+    arg_parser.add_argument("--latency-ms", type=float, default=1000.0)
+    arg_parser.add_argument("--jitter", type=float, default=0.3)
+    arg_parser.add_argument("--chunks", type=int, default=8)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    mock = MockToolbox(load_recordings(args.recordings), args.latency_ms, args.jitter, args.chunks, args.error_rate)
+    web.run_app(mock.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Charts of answer tables, rendered off the event loop.
+
+A chart is described by a ChartSpec (kind, x column, y columns), inferred
+from the parsed answer table: a line chart when the first column holds dates
+or periods (e.g. month_start), otherwise a bar chart of the numeric columns.
+Long line series are downsampled with Largest-Triangle-Three-Buckets (LTTB),
+which keeps the visual shape (peaks and dips) with far fewer points; bar
+charts show the first `max_bars` rows in the answer's order.
+
+Rendering runs on the CPU process pool with matplotlib's Agg canvas and
+produces a PNG. Rendered images are cached by interaction ID and chart
+spec, and concurrent requests for the same chart share one render.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from executors import run_cpu_bound
+from singleflight import SingleFlight
+import config
+
+# Column names that suggest dates or periods on the x axis
+TEMPORAL_HINTS = ("date", "month", "week", "year", "quarter", "period", "day", "time")
+
+
+@dataclass(frozen=True)
+class ChartSpec:
+    kind: str # "line" or "bar"
+    x: str
+    y: Tuple[str, ...]
+    title: str = ""
+    max_points: int = 500
+    max_bars: int = 40
+
+    def key(self) -> str:
+        return hashlib.sha256(repr(sorted(asdict(self).items())).encode("utf-8")).hexdigest()[:16]
+
+
+def charts_available() -> bool:
+    """True if matplotlib is installed."""
+    return importlib.util.find_spec("matplotlib") is not None
+
+
+def load_backend():
+    """Imports matplotlib's Agg backend (about a second), ahead of the first render in a worker."""
+    from matplotlib.backends import backend_agg  # noqa: F401
+
+
+def _parse_dates(values):
+    import pandas as pd
+
+    parsed = pd.to_datetime(values, errors="coerce", format="mixed")
+    return parsed if parsed.notna().mean() >= 0.8 else None
+
+
+def infer_chart_spec(df, title: str = "", max_points: int = 500, max_bars: int = 40, max_series: int = 4) -> Optional[ChartSpec]:
+    """Chooses a chart for a parsed answer table, or None if it has no numeric column to plot."""
+    import pandas as pd
+
+    if df is None or df.empty or df.shape[1] < 2:
+        return None
+    x = str(df.columns[0])
+    numeric = [str(c) for c in df.columns[1:] if pd.api.types.is_numeric_dtype(df[c])]
+    if not numeric:
+        return None
+
+    temporal = any(hint in x.lower() for hint in TEMPORAL_HINTS) and _parse_dates(df[x]) is not None
+    return ChartSpec(
+        kind="line" if temporal else "bar",
+        x=x,
+        y=tuple(numeric[:max_series]),
+        title=title,
+        max_points=max_points,
+        max_bars=max_bars,
+    )
+
+
+def lttb_indices(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[int]:
+    """
+    Indices of the points kept by Largest-Triangle-Three-Buckets downsampling.
+    Keeps the first and last point and, from each bucket in between, the point
+    forming the largest triangle with the previous kept point and the next bucket's average.
+    """
+    import numpy as np
+
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    x = np.asarray(xs, dtype=float)
+    y = np.asarray(ys, dtype=float)
+    every = (n - 2) / (threshold - 2)
+    kept = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept.append(a)
+    kept.append(n - 1)
+    return kept
+
+
+def downsample(df, spec: ChartSpec):
+    """Sorts a line chart's rows by x and downsamples them (on the first series) to `max_points`."""
+    dates = _parse_dates(df[spec.x])
+    frame = df.assign(**{spec.x: dates}).dropna(subset=[spec.x]).sort_values(spec.x)
+    if len(frame) <= spec.max_points:
+        return frame
+    first = frame[spec.y[0]].astype(float).fillna(0.0)
+    indices = lttb_indices(frame[spec.x].astype("int64").to_numpy(), first.to_numpy(), spec.max_points)
+    return frame.iloc[indices]
+
+
+def render_chart(df, spec: ChartSpec, dpi: int = 110) -> bytes:
+    """Renders `spec` over `df` to PNG bytes. CPU-bound; runs on the process pool."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(9, 4.5), dpi=dpi)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+
+    if spec.kind == "line":
+        frame = downsample(df, spec)
+        for column in spec.y:
+            axes.plot(frame[spec.x], frame[column], marker="o" if len(frame) <= 36 else None, label=column)
+        figure.autofmt_xdate()
+    else:
+        frame = df.head(spec.max_bars)
+        width = 0.8 / len(spec.y)
+        positions = range(len(frame))
+        for offset, column in enumerate(spec.y):
+            axes.bar([p + offset * width for p in positions], frame[column], width=width, label=column)
+        axes.set_xticks([p + width * (len(spec.y) - 1) / 2 for p in positions])
+        axes.set_xticklabels(frame[spec.x].astype(str), rotation=45 if len(frame) > 6 else 0, ha="right" if len(frame) > 6 else "center")
+
+    axes.set_xlabel(spec.x if len(frame) == len(df) or spec.kind == "line" else f"{spec.x} (first {len(frame)} of {len(df)})")
+    if len(spec.y) > 1:
+        axes.legend()
+    else:
+        axes.set_ylabel(spec.y[0])
+    if spec.title:
+        axes.set_title(spec.title if len(spec.title) <= 90 else spec.title[:87] + "...")
+    axes.grid(alpha=0.3)
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """LRU of rendered charts keyed by interaction ID and chart spec, capped by count and bytes."""
+
+    def __init__(self, max_entries: int = 200, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._images: "OrderedDict[str, bytes]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._flights = SingleFlight(enabled=True)
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self._counters = {"hits": 0, "misses": 0, "renders": 0, "evictions": 0}
+
+    async def get_or_render(self, interaction_id: str, df, spec: ChartSpec) -> bytes:
+        """Returns the cached PNG for this chart, rendering it on the process pool on a miss."""
+        key = f"{interaction_id}:{spec.key()}"
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self._counters["hits"] += 1
+                return image
+            self._counters["misses"] += 1
+
+        async def render(publish) -> bytes:
+            self._counters["renders"] += 1
+            image = await run_cpu_bound(render_chart, df, spec)
+            self._put(key, image)
+            return image
+
+        image, _ = await self._flights.do(key, render)
+        return image
+
+    def start_warm_up(self, workers: int):
+        """Loads matplotlib in the CPU workers in the background, so app startup does not wait on it."""
+        if self._warm_up_task is None:
+            calls = [run_cpu_bound(load_backend) for _ in range(max(1, workers))]
+            self._warm_up_task = asyncio.ensure_future(asyncio.gather(*calls, return_exceptions=True))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot["entries"] = len(self._images)
+            snapshot["bytes"] = self._total_bytes
+        return snapshot
+
+    def _put(self, key: str, image: bytes):
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            self._images[key] = image
+            self._total_bytes += len(image)
+            while len(self._images) > self.max_entries or (self._total_bytes > self.max_bytes and len(self._images) > 1):
+                _, evicted = self._images.popitem(last=False)
+                self._total_bytes -= len(evicted)
+                self._counters["evictions"] += 1
+
+
+chart_cache = ChartCache(
+    max_entries=config.CHART_CACHE_MAX_ENTRIES,
+    max_bytes=config.CHART_CACHE_MAX_BYTES,
+)
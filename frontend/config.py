@@ -7,14 +7,34 @@ API endpoints, and Google Cloud project details.
 Please replace the placeholder values with your actual configuration.
 """
 import os 
+import json
 
 # --- System Prompt Configuration ---
-# Path to the file containing the system prompt instructions for the model.
-SYSTEM_PROMPT_FILE = "system_prompt.txt"
+# Path to the file containing the system prompt instructions for the model
+# (relative paths are resolved against this directory, not the working directory).
+SYSTEM_PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("SYSTEM_PROMPT_FILE", "system_prompt.txt"))
 
 # --- Toolbox Configuration ---
 TOOLBOX_URL = os.getenv("TOOLBOX_URL", "http://127.0.0.1:5000")
 TOOLSET_NAME = "my-toolset"
+# Extra HTTP headers (JSON object, e.g. an Authorization header) sent with every toolbox request
+TOOLBOX_HEADERS = json.loads(os.getenv("TOOLBOX_HEADERS", "{}"))
+
+# One pooled ToolboxClient is shared by every session; the loaded toolset is
+# cached for this many seconds before it is fetched again.
+TOOLSET_CACHE_TTL_SECONDS = float(os.getenv("TOOLSET_CACHE_TTL_SECONDS", "300"))
+TOOLBOX_MAX_CONNECTIONS = int(os.getenv("TOOLBOX_MAX_CONNECTIONS", "100"))
+
+# Stream the SQL and answer into the chat message as the toolbox produces them.
+# Streaming reads the toolbox server's native HTTP endpoint
+# (/api/tool/<name>/invoke) directly instead of going through the MCP client,
+# so it is off by default: enable it only for a server that serves that
+# endpoint, and compare first-token latency with the load test
+# (benchmarks/load_test.py with and without --no-streaming). Otherwise, or
+# when the endpoint fails, the whole response is awaited before display, and
+# streaming is not tried again for STREAMING_RETRY_SECONDS.
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "false").lower() == "true"
+STREAMING_RETRY_SECONDS = float(os.getenv("STREAMING_RETRY_SECONDS", "300"))
 
 # --- Google Cloud BigQuery Configuration ---
 PROJECT_ID = 'analytics-datapipeline-prod'
@@ -23,6 +43,179 @@ PROJECT_ID = 'analytics-datapipeline-prod'
 DATASET_ID_DUMP = 'aiml_cj'
 TABLE_ID_DUMP = 'aiml_cj_nost_copilot_dump'
 
+# Append-only feedback events, and the view that merges them onto the dump table
+TABLE_ID_FEEDBACK = 'aiml_cj_nost_copilot_feedback'
+VIEW_ID_FEEDBACK = 'aiml_cj_nost_copilot_dump_with_feedback'
+
 # Dataset used by the model for quering
 DATASET_ID_1 = "aiml_cj_nostd_mart"
-TABLE_ID_1 = "TW_NOSTD_MART_REALTIME_UPDATED"
\ No newline at end of file
+TABLE_ID_1 = "TW_NOSTD_MART_REALTIME_UPDATED"
+
+# Tables the model may query, as a comma-separated list of "dataset.table" or
+# "project.dataset.table". The relevant ones are passed to ask_data_insights
+# as table_references for each question.
+QUERY_TABLES = os.getenv("QUERY_TABLES", f"{DATASET_ID_1}.{TABLE_ID_1}")
+TABLE_REFERENCES = [
+    dict(zip(("projectId", "datasetId", "tableId"), ([PROJECT_ID] + parts)[-3:]))
+    for parts in (table.strip().split(".") for table in QUERY_TABLES.split(",") if table.strip())
+]
+
+# Table metadata from bigquery_get_table_info is cached for this long (and
+# refreshed in the background after that). Up to SCHEMA_MAX_TABLES tables and
+# SCHEMA_MAX_COLUMNS columns per table that match the question are listed in
+# the prompt; SCHEMA_HINTS_ENABLED=false sends all tables and no column list.
+SCHEMA_HINTS_ENABLED = os.getenv("SCHEMA_HINTS_ENABLED", "true").lower() == "true"
+SCHEMA_CACHE_TTL_SECONDS = float(os.getenv("SCHEMA_CACHE_TTL_SECONDS", "3600"))
+SCHEMA_MAX_TABLES = int(os.getenv("SCHEMA_MAX_TABLES", "2"))
+SCHEMA_MAX_COLUMNS = int(os.getenv("SCHEMA_MAX_COLUMNS", "30"))
+
+# BigQuery location of the datasets (matches the toolbox source in tools.yaml)
+BQ_LOCATION = os.getenv("BQ_LOCATION", "asia-south1")
+
+# --- Interaction Log Writer Configuration ---
+# Log rows are queued in memory and flushed to BigQuery in batches by a
+# background thread, either when a batch fills up or on the flush interval.
+LOG_QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("LOG_FLUSH_INTERVAL_SECONDS", "5"))
+
+# Flushed batches are first appended to segment files under LOG_SPOOL_DIR and
+# uploaded from there, so rows survive BigQuery outages and restarts. Segments
+# close after LOG_SPOOL_SEGMENT_BYTES or LOG_SPOOL_SEGMENT_SECONDS; the oldest
+# are dropped once the spool exceeds LOG_SPOOL_MAX_BYTES.
+LOG_SPOOL_ENABLED = os.getenv("LOG_SPOOL_ENABLED", "true").lower() == "true"
+LOG_SPOOL_DIR = os.getenv("LOG_SPOOL_DIR", "log_spool")
+LOG_SPOOL_SEGMENT_BYTES = int(os.getenv("LOG_SPOOL_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+LOG_SPOOL_SEGMENT_SECONDS = float(os.getenv("LOG_SPOOL_SEGMENT_SECONDS", "15"))
+LOG_SPOOL_MAX_BYTES = int(os.getenv("LOG_SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))
+LOG_UPLOAD_MAX_BACKOFF_SECONDS = float(os.getenv("LOG_UPLOAD_MAX_BACKOFF_SECONDS", "300"))
+# A segment that fails this many upload passes while others upload is quarantined
+LOG_UPLOAD_MAX_ATTEMPTS = int(os.getenv("LOG_UPLOAD_MAX_ATTEMPTS", "5"))
+
+
+# --- Answer Cache Configuration ---
+# Raw tool responses are cached per question, context and completed period.
+# Set ANSWER_CACHE_DB_PATH to an empty string to keep the cache in memory only.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(6 * 3600)))
+ANSWER_CACHE_DB_PATH = os.getenv("ANSWER_CACHE_DB_PATH", "answer_cache.sqlite3")
+
+# Popular opening questions (ranked from the interaction log and its feedback)
+# are answered ahead of time into the answer cache after each data refresh,
+# each day and before the cached answers expire. One worker per host runs the
+# passes (a lease in the session store), so enable it together with a shared
+# SESSION_BACKEND, after creating the feedback view (`python feedback.py`).
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "20"))
+PREFETCH_LOOKBACK_DAYS = int(os.getenv("PREFETCH_LOOKBACK_DAYS", "30"))
+PREFETCH_MIN_ASKS = int(os.getenv("PREFETCH_MIN_ASKS", "3"))
+# A question opens a conversation if its user asked nothing for this long before it
+PREFETCH_SESSION_GAP_MINUTES = int(os.getenv("PREFETCH_SESSION_GAP_MINUTES", "30"))
+PREFETCH_CHECK_INTERVAL_SECONDS = float(os.getenv("PREFETCH_CHECK_INTERVAL_SECONDS", "900"))
+
+
+# --- Conversation Context Configuration ---
+# Approximate token budget for the prompt sent to the toolbox. The most recent
+# turns are kept verbatim; older turns are compacted or dropped to fit.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "2"))
+
+
+# --- Result Store Configuration ---
+# Answers are kept server-side by interaction ID so chat actions carry only the ID.
+RESULT_STORE_MAX_ENTRIES = int(os.getenv("RESULT_STORE_MAX_ENTRIES", "1000"))
+RESULT_STORE_MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+# --- Session State Configuration ---
+# Conversation history and answered results, by thread and interaction ID.
+# "memory" keeps them in this worker; with several workers behind a load
+# balancer use "sqlite" (workers on one host share SESSION_DB_PATH) or
+# "redis" (workers on several hosts share SESSION_REDIS_URL; needs `redis`).
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "session_state.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", str(24 * 3600)))
+SESSION_MEMORY_MAX_BYTES = int(os.getenv("SESSION_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_HISTORY_MAX_TURNS = int(os.getenv("SESSION_HISTORY_MAX_TURNS", "20"))
+
+
+# --- Table Paging Configuration ---
+# Answer tables with more than TABLE_PAGING_MIN_ROWS rows or TABLE_PAGING_MIN_BYTES
+# of text are shown TABLE_PAGE_SIZE rows at a time with a "Next page" action,
+# and the history keeps only their first HISTORY_PREVIEW_ROWS rows.
+TABLE_PAGING_MIN_ROWS = int(os.getenv("TABLE_PAGING_MIN_ROWS", "50"))
+TABLE_PAGING_MIN_BYTES = int(os.getenv("TABLE_PAGING_MIN_BYTES", str(16 * 1024)))
+TABLE_PAGE_SIZE = int(os.getenv("TABLE_PAGE_SIZE", "25"))
+HISTORY_PREVIEW_ROWS = int(os.getenv("HISTORY_PREVIEW_ROWS", "5"))
+
+
+# --- Chart Configuration ---
+# Answer tables can be charted (PNG, rendered on the CPU worker pool with
+# matplotlib). Line series longer than CHART_MAX_POINTS are downsampled with
+# LTTB and bar charts show at most CHART_MAX_BARS bars; rendered charts are
+# cached per interaction and chart spec.
+CHARTS_ENABLED = os.getenv("CHARTS_ENABLED", "true").lower() == "true"
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "500"))
+CHART_MAX_BARS = int(os.getenv("CHART_MAX_BARS", "40"))
+CHART_CACHE_MAX_ENTRIES = int(os.getenv("CHART_CACHE_MAX_ENTRIES", "200"))
+CHART_CACHE_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+# --- Full Export Configuration ---
+# Exports re-run the generated SQL and stream the full result to a file.
+# EXPORT_BACKEND is "bigquery" in production or "duckdb" for a local stand-in.
+EXPORT_BACKEND = os.getenv("EXPORT_BACKEND", "bigquery")
+EXPORT_DUCKDB_PATH = os.getenv("EXPORT_DUCKDB_PATH", ":memory:")
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_MAX_BYTES_BILLED = int(os.getenv("EXPORT_MAX_BYTES_BILLED", str(50 * 1024 ** 3)))
+# Chainlit reads the finished file into memory, so exports are capped
+EXPORT_MAX_ROWS = int(os.getenv("EXPORT_MAX_ROWS", "1000000"))
+EXPORT_MAX_FILE_BYTES = int(os.getenv("EXPORT_MAX_FILE_BYTES", str(100 * 1024 * 1024)))
+# Only queries that read from nothing but these tables (project.dataset.table) can be exported
+EXPORT_ALLOWED_TABLES = [f"{ref['projectId']}.{ref['datasetId']}.{ref['tableId']}" for ref in TABLE_REFERENCES]
+
+
+# --- Observability Configuration ---
+# Per-stage latency histograms are served at http://METRICS_HOST:METRICS_PORT/metrics
+# when METRICS_PORT is set (0 disables the endpoint). Give each worker on a host
+# its own port, and set METRICS_HOST=0.0.0.0 only if a scraper on another host
+# must reach it. Set OTLP_ENDPOINT (e.g. http://collector:4318/v1/traces) to
+# also export trace spans; that needs opentelemetry-sdk and
+# opentelemetry-exporter-otlp-proto-http. LOG_LEVEL and LOG_FORMAT (text or
+# json) are read by logger.py.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "")
+
+
+# --- Blocking Work and Admission Control ---
+# Blocking calls run on a thread pool; pure-Python CPU work (e.g. parsing large
+# answer tables) runs on a process pool. CPU_POOL_WORKERS=0 uses threads instead.
+BLOCKING_POOL_WORKERS = int(os.getenv("BLOCKING_POOL_WORKERS", "8"))
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "2"))
+
+# Limits on concurrent ask_data_insights calls. Requests over the limits queue
+# fairly across users; new ones are turned away once ADMISSION_MAX_QUEUE wait.
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "2"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+
+# Each ask_data_insights call must finish within the deadline. If nothing has
+# arrived after the HEDGE_PERCENTILE latency of recent calls (clamped to the
+# min/max delay), a duplicate request is sent and the first response wins.
+TOOLBOX_CALL_DEADLINE_SECONDS = float(os.getenv("TOOLBOX_CALL_DEADLINE_SECONDS", "180"))
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "true").lower() == "true"
+HEDGE_MAX_ATTEMPTS = int(os.getenv("HEDGE_MAX_ATTEMPTS", "2"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "5"))
+HEDGE_MAX_DELAY_SECONDS = float(os.getenv("HEDGE_MAX_DELAY_SECONDS", "60"))
+
+# After this many consecutive failures the toolbox is considered unhealthy and
+# calls fail fast until a probe succeeds, at most every CIRCUIT_RESET_SECONDS.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Concurrent identical questions (same prompt and tables) share one tool call.
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
@@ -0,0 +1,126 @@
+"""
+Token-budgeted conversation context for the toolbox prompt.
+
+The prompt is the system instruction, the tables and columns relevant to the
+question (see schema_cache.py), the conversation history and the current
+question. The most recent turns are kept verbatim; older turns are
+compacted to their question, SQL and a short summary of the answer table, and
+the oldest turns are dropped once the token budget is used up.
+"""
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence
+
+# Rough characters-per-token ratio; good enough for budgeting English + SQL.
+CHARS_PER_TOKEN = 4
+
+# Total row count noted under a table preview, e.g. "_5 of 1,234 rows shown._"
+_ROWS_SHOWN = re.compile(r"of ([\d,]+) rows shown\._")
+
+
+@dataclass
+class QueryContext:
+    """The assembled prompt plus the history section and token usage."""
+    prompt: str
+    history_text: str
+    usage: Dict[str, int] = field(default_factory=dict)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens in `text`."""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def summarize_answer(answer: str, max_chars: int = 200) -> str:
+    """Summarizes an answer as its table shape, or its first characters if there is no table."""
+    table_lines = [line.strip() for line in (answer or "").splitlines() if line.strip().startswith("|")]
+    if len(table_lines) >= 2:
+        columns = [c.strip() for c in table_lines[0].strip("|").split("|")]
+        row_count = len(table_lines) - 2 # Skip header and separator
+        shown = _ROWS_SHOWN.search(answer)
+        if shown: # A paged table kept as a preview (see pagination.py)
+            row_count = int(shown.group(1).replace(",", ""))
+        return f"Table with {row_count} rows and {len(columns)} columns ({', '.join(columns)})"
+
+    text = " ".join((answer or "").split())
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "..."
+
+
+def format_turn(turn: Sequence[str], compact: bool = False) -> str:
+    """Formats a `(question, answer[, sql])` history entry for the prompt."""
+    question, answer = turn[0], turn[1]
+    sql = turn[2] if len(turn) > 2 else ""
+
+    if not compact:
+        return f"Previous Question: {question}\n\nPrevious Answer: {answer}"
+
+    parts = [f"Previous Question: {question}"]
+    if sql:
+        parts.append(f"Previous SQL: {sql}")
+    parts.append(f"Previous Answer (summary): {summarize_answer(answer)}")
+    return "\n\n".join(parts)
+
+
+def build_query_context(
+    system_instruction: str,
+    history: List[Sequence[str]],
+    user_query: str,
+    token_budget: int = 8000,
+    recent_turns: int = 2,
+    schema_text: str = "",
+) -> QueryContext:
+    """Assembles the prompt for `user_query` within `token_budget` tokens."""
+    question_text = f"Current Question: {user_query}"
+    system_tokens = estimate_tokens(system_instruction)
+    schema_tokens = estimate_tokens(schema_text)
+    question_tokens = estimate_tokens(question_text)
+    remaining = token_budget - system_tokens - schema_tokens - question_tokens
+
+    usage = {
+        "system": system_tokens,
+        "schema": schema_tokens,
+        "question": question_tokens,
+        "history_verbatim": 0,
+        "history_compacted": 0,
+        "turns_verbatim": 0,
+        "turns_compacted": 0,
+        "turns_dropped": 0,
+    }
+
+    # Walk the history newest-first so the most recent turns win the budget.
+    selected = []
+    for age, turn in enumerate(reversed(history)):
+        text = None
+        if age < recent_turns:
+            verbatim = format_turn(turn)
+            if estimate_tokens(verbatim) <= remaining:
+                text, kind = verbatim, "verbatim"
+        if text is None:
+            compacted = format_turn(turn, compact=True)
+            if estimate_tokens(compacted) <= remaining:
+                text, kind = compacted, "compacted"
+        if text is None:
+            usage["turns_dropped"] = len(history) - age
+            break
+
+        tokens = estimate_tokens(text)
+        remaining -= tokens
+        usage[f"history_{kind}"] += tokens
+        usage[f"turns_{kind}"] += 1
+        selected.append(text)
+
+    history_text = "\n\n".join(reversed(selected))
+    usage["total"] = system_tokens + schema_tokens + question_tokens + usage["history_verbatim"] + usage["history_compacted"]
+
+    sections = [section for section in (schema_text, history_text, question_text) if section]
+    prompt = f"{system_instruction}\n\n" + "\n\n".join(sections)
+    return QueryContext(prompt=prompt, history_text=history_text, usage=usage)
+
+
+def build_tool_params(prompt: str, table_references: Sequence[dict], temperature: float = 0.0) -> Dict[str, str]:
+    """Builds the `ask_data_insights` arguments for an assembled prompt."""
+    return {
+        "user_query_with_context": f"Temperature setting: {temperature}\n\n{prompt}",
+        "table_references": json.dumps(list(table_references)),
+    }
@@ -0,0 +1,126 @@
+"""
+Bounded worker pools for blocking work started from async handlers.
+
+`run_blocking` runs I/O-bound or GIL-releasing calls (BigQuery jobs, file
+writes, `DataFrame.to_csv`) on a shared thread pool. `run_cpu_bound` runs
+pure-Python CPU work (such as parsing a large markdown table) on a process
+pool, so it cannot hold the GIL while the event loop is serving other users.
+Functions sent to the process pool must be picklable module-level functions.
+
+Both pools are created on first use and sized from config; with
+CPU_POOL_WORKERS set to 0, CPU-bound work falls back to the thread pool.
+"""
+import asyncio
+import contextvars
+import functools
+import importlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, Tuple, TypeVar
+
+from logger import logger
+import config
+
+T = TypeVar("T")
+
+
+def _import_modules(module_names: Tuple[str, ...]):
+    """Process-pool initializer: imports the modules tasks will be unpickled from."""
+    for name in module_names:
+        importlib.import_module(name)
+
+
+class WorkerPools:
+    """Lazily created thread and process pools with in-flight counters."""
+
+    def __init__(self, thread_workers: int = 8, process_workers: int = 2):
+        self.thread_workers = max(1, thread_workers)
+        self.process_workers = max(0, process_workers)
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._preload: Tuple[str, ...] = ()
+        self._lock = threading.Lock()
+        self._counters = {
+            "thread_in_flight": 0,
+            "thread_submitted": 0,
+            "process_in_flight": 0,
+            "process_submitted": 0,
+        }
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix="blocking")
+            return self._threads
+
+    def _process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if not self.process_workers:
+            return None
+        with self._lock:
+            if self._processes is None:
+                # "spawn" avoids forking a process that already runs the event loop and writer threads
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.process_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_import_modules,
+                    initargs=(self._preload,),
+                )
+            return self._processes
+
+    async def _submit(self, kind: str, executor: Executor, call: Callable[[], T]) -> T:
+        with self._lock:
+            self._counters[f"{kind}_in_flight"] += 1
+            self._counters[f"{kind}_submitted"] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, call)
+        finally:
+            with self._lock:
+                self._counters[f"{kind}_in_flight"] -= 1
+
+    async def run_blocking(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Runs `func` on the thread pool, keeping the caller's context (e.g. the current trace)."""
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await self._submit("thread", self._thread_pool(), call)
+
+    async def run_cpu_bound(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Runs `func` on the process pool, or on the thread pool if it is disabled."""
+        pool = self._process_pool()
+        if pool is None:
+            return await self.run_blocking(func, *args, **kwargs)
+        return await self._submit("process", pool, functools.partial(func, *args, **kwargs))
+
+    async def warm_up(self, preload: Iterable[str] = ()):
+        """Starts the process workers ahead of the first task, importing `preload` in each."""
+        self._preload = tuple(preload)
+        pool = self._process_pool()
+        if pool is None:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for _ in range(self.process_workers)))
+        logger.info("Started %d CPU worker processes.", self.process_workers)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def shutdown(self):
+        """Waits for running work and stops both pools."""
+        with self._lock:
+            threads, processes = self._threads, self._processes
+            self._threads = self._processes = None
+        if threads is not None:
+            threads.shutdown(wait=True)
+        if processes is not None:
+            processes.shutdown(wait=True)
+        logger.info("Worker pools shut down.")
+
+
+worker_pools = WorkerPools(
+    thread_workers=config.BLOCKING_POOL_WORKERS,
+    process_workers=config.CPU_POOL_WORKERS,
+)
+run_blocking = worker_pools.run_blocking
+run_cpu_bound = worker_pools.run_cpu_bound
@@ -0,0 +1,374 @@
+"""
+Full-fidelity export of an answer by re-running its generated SQL.
+
+The markdown table in an answer is rounded, formatted and often truncated, so
+exports re-run the `SQL Generated` query instead and stream the result as
+Arrow record batches into a CSV, Parquet or Arrow IPC file on disk. The
+finished file is handed to Chainlit, which reads it into memory, so exports
+are capped in rows and bytes and stop with an ExportError past either cap.
+
+Only queries that read nothing but the allowed tables (fully qualified) are
+run. The SQL is checked locally, and BigQuery also dry-runs it and checks the
+tables the job would reference.
+
+Backends are pluggable: BigQuery (Storage Read API when available) in
+production, and DuckDB as a local stand-in for testing.
+"""
+import functools
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from logger import logger
+from log_writer import log_writer
+import config
+
+# Export format -> (file extension, mime type)
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "arrow": (".arrows", "application/vnd.apache.arrow.stream"),
+}
+
+_BACKTICK_IDENTIFIER = re.compile(r"`([^`]+)`")
+
+# Comments, string literals (which may hide anything) and quoted identifiers, then words and symbols
+_SQL_TOKEN = re.compile(
+    r"""(?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)"""
+    r"""|(?P<string>[rRbB]{0,2}(?:'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*"))"""
+    r"""|(?P<quoted>`[^`]*`)"""
+    r"""|(?P<word>[A-Za-z_][A-Za-z0-9_]*)"""
+    r"""|(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)"""
+    r"""|(?P<space>\s+)"""
+    r"""|(?P<symbol>.)""",
+    re.S,
+)
+
+# Words that end a table reference instead of being its alias
+_CLAUSE_KEYWORDS = {
+    "where", "group", "order", "having", "limit", "join", "inner", "left", "right", "full", "cross", "on",
+    "using", "union", "except", "intersect", "window", "qualify", "tablesample", "for", "pivot", "unpivot",
+}
+
+# FROM inside these calls is not a table (e.g. EXTRACT(YEAR FROM date))
+_FROM_FUNCTIONS = {"extract", "trim", "substring"}
+
+class ExportError(Exception):
+    """Raised when an export cannot be run."""
+
+
+@dataclass
+class ExportResult:
+    """A finished export file."""
+    path: str
+    format: str
+    rows: int
+    bytes: int
+    seconds: float
+
+    @property
+    def mime(self) -> str:
+        return EXPORT_FORMATS[self.format][1]
+
+
+def _tokenize(sql: str) -> List[Tuple[str, str]]:
+    """Splits SQL into (kind, text) tokens, dropping comments and whitespace."""
+    tokens = []
+    for match in _SQL_TOKEN.finditer(sql):
+        kind = match.lastgroup
+        if kind == "symbol" and match.group() in "'\"`":
+            raise ExportError("The query has an unterminated string or identifier.")
+        if kind not in ("comment", "space"):
+            tokens.append((kind, match.group()))
+    return tokens
+
+
+def _is_word(token: Tuple[str, str], *words: str) -> bool:
+    return token[0] == "word" and token[1].lower() in words
+
+
+def _matching_paren(tokens: List[Tuple[str, str]], start: int) -> int:
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i] == ("symbol", "("):
+            depth += 1
+        elif tokens[i] == ("symbol", ")"):
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ExportError("The query has unbalanced parentheses.")
+
+
+def _read_table_name(tokens: List[Tuple[str, str]], i: int) -> Tuple[str, int]:
+    """Joins a (possibly dotted, quoted or dashed) table path starting at `i`. Returns it and the next index."""
+    parts = []
+    while i < len(tokens):
+        kind, text = tokens[i]
+        if kind == "quoted":
+            parts.append(text[1:-1])
+        elif kind in ("word", "number") and (not parts or parts[-1] in (".", "-")):
+            parts.append(text)
+        elif kind == "symbol" and text in ".-" and parts:
+            parts.append(text)
+        else:
+            break
+        i += 1
+    return "".join(parts), i
+
+
+def table_references(sql: str) -> Tuple[Set[str], Set[str]]:
+    """
+    Returns the tables a query reads (every name after FROM, JOIN or a comma
+    in a FROM list) and the names of its WITH clauses. String literals and
+    comments are ignored, so a table name inside them does not count.
+    """
+    tokens = _tokenize(sql)
+    tables: Set[str] = set()
+    ctes: Set[str] = set()
+    calls: List[str] = []  # Word before each open parenthesis
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        previous = tokens[i - 1] if i else ("", "")
+        if token == ("symbol", "("):
+            calls.append(previous[1].lower() if previous[0] == "word" else "")
+        elif token == ("symbol", ")"):
+            if calls:
+                calls.pop()
+        elif token[0] in ("word", "quoted") and i + 2 < len(tokens) and _is_word(tokens[i + 1], "as") \
+                and tokens[i + 2] == ("symbol", "(") and (_is_word(previous, "with", "recursive") or previous == ("symbol", ",")):
+            ctes.add(token[1].strip("`"))
+        elif _is_word(token, "join") or (
+            _is_word(token, "from") and not _is_word(previous, "distinct") and not (calls and calls[-1] in _FROM_FUNCTIONS)
+        ):
+            i = _read_from_list(tokens, i + 1, tables, single=_is_word(token, "join"))
+            continue
+        i += 1
+    return tables, ctes
+
+
+def _read_from_list(tokens: List[Tuple[str, str]], i: int, tables: Set[str], single: bool) -> int:
+    """Records the tables of a FROM list (or one JOIN operand) starting at `i`; returns where scanning resumes."""
+    while i < len(tokens):
+        if tokens[i] == ("symbol", "("):
+            # A subquery or a parenthesized join; its own FROM and JOIN are scanned later
+            return i
+        if _is_word(tokens[i], "unnest"):
+            i = _matching_paren(tokens, i + 1) + 1
+        else:
+            name, i = _read_table_name(tokens, i)
+            if not name:
+                raise ExportError("The query has a table reference that could not be read.")
+            if i < len(tokens) and tokens[i] == ("symbol", "("):
+                raise ExportError(f"Table functions such as {name} cannot be exported.")
+            tables.add(name)
+
+        # Optional alias
+        if i < len(tokens) and _is_word(tokens[i], "as"):
+            i += 2
+        elif i < len(tokens) and tokens[i][0] in ("word", "quoted") and tokens[i][1].lower() not in _CLAUSE_KEYWORDS:
+            i += 1
+        if single or i >= len(tokens) or tokens[i] != ("symbol", ","):
+            return i
+        i += 1
+    return i
+
+
+def validate_export_sql(sql: str, allowed_tables: List[str]) -> str:
+    """
+    Checks that `sql` is a single read-only query that reads only from the
+    allowed tables (fully qualified `project.dataset.table`) and returns it.
+    """
+    query = (sql or "").strip().rstrip(";").strip()
+    if not query:
+        raise ExportError("There is no SQL to re-run for this answer.")
+
+    tokens = _tokenize(query)
+    if not tokens or not _is_word(tokens[0], "select", "with"):
+        raise ExportError("Only SELECT queries can be exported.")
+    if ("symbol", ";") in tokens:
+        raise ExportError("Only a single query can be exported.")
+
+    tables, ctes = table_references(query)
+    if not tables:
+        raise ExportError("The query does not read from an exportable table.")
+    allowed = set(allowed_tables)
+    for table in tables:
+        if table not in allowed and table not in ctes:
+            raise ExportError(f"The query reads from {table}, which cannot be exported.")
+    return query
+
+
+class ExportBackend:
+    """Runs a query and yields its result as pyarrow RecordBatches."""
+
+    def iter_batches(self, sql: str) -> Iterator:
+        raise NotImplementedError
+
+
+class BigQueryExportBackend(ExportBackend):
+    """Runs the query on BigQuery and reads it back with the Storage Read API when installed."""
+
+    def __init__(
+        self,
+        client_factory,
+        location: Optional[str] = None,
+        max_bytes_billed: Optional[int] = None,
+        allowed_tables: Optional[List[str]] = None,
+        max_rows: Optional[int] = None,
+    ):
+        self._client_factory = client_factory
+        self.location = location
+        self.max_bytes_billed = max_bytes_billed
+        self.allowed_tables = allowed_tables
+        self.max_rows = max_rows
+        self._bqstorage_client = None
+
+    def _get_bqstorage_client(self):
+        if self._bqstorage_client is None:
+            try:
+                from google.cloud import bigquery_storage # type: ignore
+            except ImportError:
+                logger.info("google-cloud-bigquery-storage is not installed; exporting through the REST API.")
+                return None
+            self._bqstorage_client = bigquery_storage.BigQueryReadClient()
+        return self._bqstorage_client
+
+    def iter_batches(self, sql: str) -> Iterator:
+        from google.cloud import bigquery
+
+        client = self._client_factory()
+        if self.allowed_tables is not None:
+            self.check_referenced_tables(client, sql)
+        job_config = bigquery.QueryJobConfig(use_legacy_sql=False, maximum_bytes_billed=self.max_bytes_billed)
+        query_job = client.query(sql, job_config=job_config, location=self.location)
+        rows = query_job.result()
+        if self.max_rows and rows.total_rows is not None and rows.total_rows > self.max_rows:
+            raise ExportError(_too_many_rows(self.max_rows))
+        yield from rows.to_arrow_iterable(bqstorage_client=self._get_bqstorage_client())
+
+    def check_referenced_tables(self, client, sql: str):
+        """Dry-runs `sql` and raises ExportError if the job would read a table that is not allowed (e.g. through a view)."""
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(use_legacy_sql=False, dry_run=True, use_query_cache=False)
+        dry_run = client.query(sql, job_config=job_config, location=self.location)
+        for table in dry_run.referenced_tables:
+            table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+            if table_id not in self.allowed_tables:
+                raise ExportError(f"The query reads from {table_id}, which cannot be exported.")
+
+
+class DuckDBExportBackend(ExportBackend):
+    """Local stand-in that runs the query on a DuckDB database."""
+
+    def __init__(self, database: str = ":memory:", batch_rows: int = 100_000):
+        self.database = database
+        self.batch_rows = batch_rows
+
+    @staticmethod
+    def localize_sql(sql: str) -> str:
+        """Rewrites BigQuery `project.dataset.table` references to plain DuckDB table names."""
+        return _BACKTICK_IDENTIFIER.sub(lambda m: '"' + m.group(1).split(".")[-1] + '"', sql)
+
+    def iter_batches(self, sql: str) -> Iterator:
+        import duckdb # type: ignore
+
+        connection = duckdb.connect(self.database, read_only=self.database != ":memory:")
+        try:
+            reader = connection.execute(self.localize_sql(sql)).fetch_record_batch(self.batch_rows)
+            yield from reader
+        finally:
+            connection.close()
+
+
+def _too_many_rows(max_rows: int) -> str:
+    return f"The result has more than {max_rows:,} rows, the export limit. Please narrow the question (e.g. a region or a shorter period) and export again."
+
+
+def _too_large(max_bytes: int) -> str:
+    return f"The export is larger than {max_bytes / 1024 ** 2:,.0f} MB, the export limit. Please narrow the question or choose Parquet, and export again."
+
+
+def write_batches(batches: Iterable, export_format: str, path: str, max_rows: Optional[int] = None, max_bytes: Optional[int] = None) -> int:
+    """
+    Streams record batches into `path` in the given format and returns the row count.
+    Raises ExportError once the file is over `max_rows` rows or `max_bytes` bytes.
+    """
+    import pyarrow as pa
+
+    writer = None
+    rows = 0
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = _open_writer(export_format, path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+            if max_rows and rows > max_rows:
+                raise ExportError(_too_many_rows(max_rows))
+            if max_bytes and os.path.getsize(path) > max_bytes:
+                raise ExportError(_too_large(max_bytes))
+        if writer is None:
+            # No batches at all: still produce a valid, empty file.
+            writer = _open_writer(export_format, path, pa.schema([]))
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _open_writer(export_format: str, path: str, schema):
+    if export_format == "csv":
+        import pyarrow.csv as pa_csv
+        return pa_csv.CSVWriter(path, schema)
+    if export_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema)
+    if export_format == "arrow":
+        import pyarrow as pa
+        return pa.ipc.new_stream(path, schema)
+    raise ExportError(f"Unsupported export format: {export_format}")
+
+
+def run_export(sql: str, export_format: str, backend: ExportBackend, directory: Optional[str] = None) -> ExportResult:
+    """Re-runs `sql` on `backend` and writes the result to a new file. Blocking."""
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unsupported export format: {export_format}")
+    query = validate_export_sql(sql, config.EXPORT_ALLOWED_TABLES)
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="copilot_export_", suffix=EXPORT_FORMATS[export_format][0], dir=directory)
+    os.close(fd)
+
+    started = time.perf_counter()
+    try:
+        rows = write_batches(backend.iter_batches(query), export_format, path, config.EXPORT_MAX_ROWS, config.EXPORT_MAX_FILE_BYTES)
+        if config.EXPORT_MAX_FILE_BYTES and os.path.getsize(path) > config.EXPORT_MAX_FILE_BYTES:
+            # Writers that buffer (Parquet) may only reach the disk on close
+            raise ExportError(_too_large(config.EXPORT_MAX_FILE_BYTES))
+    except Exception:
+        os.remove(path)
+        raise
+    result = ExportResult(path=path, format=export_format, rows=rows, bytes=os.path.getsize(path), seconds=time.perf_counter() - started)
+    logger.info("Exported %d rows (%d bytes, %s) in %.2fs.", result.rows, result.bytes, export_format, result.seconds)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def get_export_backend() -> ExportBackend:
+    """Returns the (shared) backend selected by EXPORT_BACKEND."""
+    if config.EXPORT_BACKEND == "duckdb":
+        return DuckDBExportBackend(config.EXPORT_DUCKDB_PATH)
+    return BigQueryExportBackend(
+        client_factory=log_writer.get_client,
+        location=config.BQ_LOCATION,
+        max_bytes_billed=config.EXPORT_MAX_BYTES_BILLED,
+        allowed_tables=config.EXPORT_ALLOWED_TABLES,
+        max_rows=config.EXPORT_MAX_ROWS,
+    )
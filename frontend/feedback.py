@@ -0,0 +1,83 @@
+"""
+Append-only feedback events for the interaction log.
+
+Thumbs up/down clicks are written as rows to a separate feedback table keyed
+by `interaction_id` (through the batched log writer) instead of running a DML
+UPDATE against the dump table. The merged view below joins the latest
+feedback event for each interaction back onto the interaction rows. Log
+uploads are append-only and may be retried, so the view also keeps one row
+per (interaction_id, user, time) of the dump table.
+
+Run `python feedback.py` once per environment to create the feedback table
+and the merged view.
+"""
+from datetime import datetime
+
+from logger import logger
+from log_writer import log_writer
+import config
+
+FEEDBACK_TABLE_FULL_ID = f"{config.PROJECT_ID}.{config.DATASET_ID_DUMP}.{config.TABLE_ID_FEEDBACK}"
+DUMP_TABLE_FULL_ID = f"{config.PROJECT_ID}.{config.DATASET_ID_DUMP}.{config.TABLE_ID_DUMP}"
+FEEDBACK_VIEW_FULL_ID = f"{config.PROJECT_ID}.{config.DATASET_ID_DUMP}.{config.VIEW_ID_FEEDBACK}"
+
+# Columns of the feedback event table, as (name, type) pairs.
+FEEDBACK_SCHEMA = [
+    ("interaction_id", "STRING"),
+    ("user", "STRING"),
+    ("time", "TIMESTAMP"),
+    ("user_feedback", "STRING"),
+]
+
+FEEDBACK_VIEW_SQL = f"""
+CREATE OR REPLACE VIEW `{FEEDBACK_VIEW_FULL_ID}` AS
+WITH interactions AS (
+  SELECT *
+  FROM `{DUMP_TABLE_FULL_ID}`
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY interaction_id, user, time) = 1
+),
+latest_feedback AS (
+  SELECT interaction_id, user_feedback, time AS feedback_time
+  FROM `{FEEDBACK_TABLE_FULL_ID}`
+  WHERE interaction_id IS NOT NULL
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY interaction_id ORDER BY time DESC) = 1
+)
+SELECT
+  d.* EXCEPT (user_feedback),
+  COALESCE(f.user_feedback, d.user_feedback) AS user_feedback,
+  f.feedback_time
+FROM interactions AS d
+LEFT JOIN latest_feedback AS f
+  ON d.interaction_id = f.interaction_id
+"""
+
+
+def record_feedback(interaction_id: str, user_feedback: str, user_id: str) -> bool:
+    """Queues a feedback event row. Returns False if the row was dropped."""
+    return log_writer.enqueue(FEEDBACK_TABLE_FULL_ID, {
+        "interaction_id": interaction_id,
+        "user": user_id,
+        "time": datetime.utcnow().isoformat(),
+        "user_feedback": user_feedback,
+    })
+
+
+def create_feedback_objects():
+    """Creates the feedback event table (if missing) and the merged view."""
+    from google.cloud import bigquery
+
+    client = log_writer.get_client()
+    table = bigquery.Table(
+        FEEDBACK_TABLE_FULL_ID,
+        schema=[bigquery.SchemaField(name, field_type) for name, field_type in FEEDBACK_SCHEMA],
+    )
+    table.time_partitioning = bigquery.TimePartitioning(field="time")
+    client.create_table(table, exists_ok=True)
+    logger.info("Feedback table %s is ready.", FEEDBACK_TABLE_FULL_ID)
+
+    client.query(FEEDBACK_VIEW_SQL).result()
+    logger.info("Merged feedback view %s is ready.", FEEDBACK_VIEW_FULL_ID)
+
+
+if __name__ == "__main__":
+    create_feedback_objects()
@@ -0,0 +1,280 @@
+"""
+On-disk write-ahead spool for interaction log and feedback rows.
+
+The log writer appends each batch of rows to the current segment, a JSONL
+file with one `{"table": ..., "row": ...}` object per line, so a row is on
+disk within one flush interval whether or not BigQuery is reachable. The
+current segment is closed (renamed from `.open` to `.jsonl`) once it reaches
+`segment_max_bytes` or `segment_max_age` seconds, and the writer's uploader
+thread uploads closed segments to BigQuery and deletes each one only after all
+of its rows were written. Rows carry insert IDs derived from (interaction_id,
+user, time) and are deduplicated on read, so a segment that is uploaded twice
+does not duplicate rows. A segment that keeps failing is quarantined (renamed
+to `.jsonl.failed`) so it does not hold up the others.
+
+Segment names carry the writer's process ID. Segments left open by a process
+that died, or being uploaded, are closed again when the next spool starts,
+so they are uploaded after a crash or restart. Once the spool is larger than
+`max_total_bytes` the oldest closed and quarantined segments are deleted and
+their rows counted as dropped.
+
+Run `python log_spool.py status` to inspect the spool, or
+`python log_spool.py replay [FILE ...]` to upload its segments (or any JSONL
+files in the same format, e.g. quarantined segments once their table exists,
+or a backfill) to BigQuery.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from logger import logger
+import config
+
+SEGMENT_SUFFIX = ".jsonl"
+OPEN_SUFFIX = ".jsonl.open"
+UPLOADING_SUFFIX = ".jsonl.uploading"
+FAILED_SUFFIX = ".jsonl.failed"
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return False # Our PID on a leftover file means it was written by an earlier run (e.g. PID 1 in a container)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_segment(path: str) -> Dict[str, List[dict]]:
+    """Reads a segment into rows per table. Unreadable lines (e.g. a truncated last line from a crash) are skipped."""
+    rows_by_table: Dict[str, List[dict]] = {}
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                table, row = record["table"], record["row"]
+            except (json.JSONDecodeError, TypeError, KeyError):
+                logger.warning("Skipping unreadable line %d of %s.", line_number, path)
+                continue
+            rows_by_table.setdefault(table, []).append(row)
+    return rows_by_table
+
+
+class LogSpool:
+    """Rotating JSONL segments of log rows in one directory."""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_max_bytes: int = 8 * 1024 * 1024,
+        segment_max_age: float = 15.0,
+        max_total_bytes: int = 512 * 1024 * 1024,
+        fsync: bool = True,
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.max_total_bytes = max_total_bytes
+        # fsync each closed segment, so it also survives a host crash
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._path: Optional[str] = None
+        self._opened_at = 0.0
+        self._sequence = 0
+        self._counters = {"rows_spooled": 0, "rows_evicted": 0, "segments_evicted": 0, "segments_quarantined": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    # --- Public API ---
+
+    def append(self, rows: List[Tuple[str, dict]]):
+        """Appends `(table_full_id, row)` pairs to the current segment. Blocking (disk I/O)."""
+        if not rows:
+            return
+        data = "".join(json.dumps({"table": table, "row": row}, default=str) + "\n" for table, row in rows)
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            self._counters["rows_spooled"] += len(rows)
+            if self._file.tell() >= self.segment_max_bytes:
+                self._close_segment()
+        self._enforce_cap()
+
+    def rotate(self, force: bool = False):
+        """Closes the current segment if it is old enough (or always with `force`), making it uploadable."""
+        with self._lock:
+            if self._file is not None and (force or time.monotonic() - self._opened_at >= self.segment_max_age):
+                self._close_segment()
+
+    def closed_segments(self) -> List[str]:
+        """Paths of the closed segments, oldest first."""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def claim(self, path: str) -> Optional[str]:
+        """Marks a closed segment as being uploaded by this process. Returns None if another process took it."""
+        claimed = path[: -len(SEGMENT_SUFFIX)] + f".{os.getpid()}" + UPLOADING_SUFFIX
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def release(self, claimed: str):
+        """Returns a claimed segment to the closed segments after a failed upload."""
+        os.rename(claimed, self._base(claimed) + SEGMENT_SUFFIX)
+
+    def quarantine(self, claimed: str):
+        """Sets a claimed segment aside after repeated failed uploads; `replay` can upload it later."""
+        os.rename(claimed, self._base(claimed) + FAILED_SUFFIX)
+        self._counters["segments_quarantined"] += 1
+
+    def remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def total_bytes(self) -> int:
+        total = 0
+        for name in os.listdir(self.directory):
+            try:
+                total += os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def failed_segments(self) -> List[str]:
+        """Paths of the quarantined segments, oldest first."""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(FAILED_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def stats(self) -> Dict[str, float]:
+        snapshot = dict(self._counters)
+        snapshot["segments_pending"] = len(self.closed_segments())
+        snapshot["segments_failed"] = len(self.failed_segments())
+        snapshot["bytes"] = self.total_bytes()
+        return snapshot
+
+    def close(self):
+        """Closes the current segment so it is uploaded by the next pass (or the next run)."""
+        self.rotate(force=True)
+
+    # --- Internals ---
+
+    @staticmethod
+    def _base(claimed: str) -> str:
+        return claimed[: -len(UPLOADING_SUFFIX)].rsplit(".", 1)[0]
+
+    def _open_segment(self):
+        self._sequence += 1
+        name = f"segment-{time.time_ns():020d}-{os.getpid()}-{self._sequence:06d}"
+        self._path = os.path.join(self.directory, name + OPEN_SUFFIX)
+        self._file = open(self._path, "a", encoding="utf-8")
+        self._opened_at = time.monotonic()
+
+    def _close_segment(self):
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._path, self._path[: -len(OPEN_SUFFIX)] + SEGMENT_SUFFIX)
+        self._file = None
+        self._path = None
+
+    def _recover(self):
+        """Closes segments that a dead process left open or mid-upload."""
+        for name in os.listdir(self.directory):
+            if name.endswith(OPEN_SUFFIX):
+                base = name[: -len(OPEN_SUFFIX)]
+                pid = base.split("-")[2] if base.count("-") >= 3 else ""
+            elif name.endswith(UPLOADING_SUFFIX):
+                base, _, pid = name[: -len(UPLOADING_SUFFIX)].rpartition(".")
+            else:
+                continue
+            if pid.isdigit() and _pid_alive(int(pid)):
+                continue
+            os.rename(os.path.join(self.directory, name), os.path.join(self.directory, base + SEGMENT_SUFFIX))
+            logger.info("Recovered log spool segment %s for upload.", base)
+
+    def _enforce_cap(self):
+        """Deletes the oldest closed or quarantined segments while the spool is over its size cap."""
+        if not self.max_total_bytes:
+            return
+        total = self.total_bytes()
+        # Names start with the creation time, so this is oldest first
+        for path in sorted(self.closed_segments() + self.failed_segments(), key=os.path.basename):
+            if total <= self.max_total_bytes:
+                return
+            try:
+                size = os.path.getsize(path)
+                dropped = sum(len(rows) for rows in read_segment(path).values())
+            except FileNotFoundError:
+                continue # Uploaded meanwhile
+            self.remove(path)
+            total -= size
+            self._counters["rows_evicted"] += dropped
+            self._counters["segments_evicted"] += 1
+            logger.error("Log spool is over its %d byte cap; dropped %d rows in %s.", self.max_total_bytes, dropped, os.path.basename(path))
+
+
+def iter_segment_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((SEGMENT_SUFFIX, OPEN_SUFFIX, UPLOADING_SUFFIX, FAILED_SUFFIX)):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("command", choices=["status", "replay"])
+    arg_parser.add_argument("files", nargs="*", help="Segment files or directories (default: the spool directory).")
+    arg_parser.add_argument("--dir", default=config.LOG_SPOOL_DIR, help="Spool directory.")
+    arg_parser.add_argument("--dry-run", action="store_true", help="Only count the rows that would be uploaded.")
+    arg_parser.add_argument("--keep", action="store_true", help="Keep the files after a successful upload.")
+    args = arg_parser.parse_args()
+
+    files = list(iter_segment_files(args.files or [args.dir]))
+    totals: Dict[str, int] = {}
+    failed = 0
+    if args.command == "replay" and not args.dry_run:
+        from log_writer import log_writer
+
+    for path in files:
+        rows_by_table = read_segment(path)
+        for table, rows in rows_by_table.items():
+            totals[table] = totals.get(table, 0) + len(rows)
+        if args.command == "status" or args.dry_run:
+            print(f"{os.path.basename(path)}: " + ", ".join(f"{len(rows)} rows for {table}" for table, rows in rows_by_table.items()))
+            continue
+        try:
+            for table, rows in rows_by_table.items():
+                log_writer.sink(table, rows)
+        except Exception as e:
+            failed += 1
+            print(f"{os.path.basename(path)}: upload failed: {e}")
+            continue
+        print(f"{os.path.basename(path)}: uploaded")
+        if not args.keep:
+            os.remove(path)
+
+    for table, count in totals.items():
+        print(f"{count:>8} rows  {table}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
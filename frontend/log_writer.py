@@ -0,0 +1,363 @@
+"""
+Background writer for the interaction log.
+
+Rows are pushed onto a bounded in-memory queue from the request path and a
+daemon thread flushes them in batches, either when a batch fills up or when
+the flush interval elapses. All writes go through one shared BigQuery
+client, so the Chainlit event loop never waits on a load job.
+
+With a spool (see log_spool.py) each batch is appended to a segment file on
+disk instead, and a second thread uploads the closed segments, retrying with
+exponential backoff while BigQuery is slow or down. A segment that fails
+while others upload (e.g. its table does not exist yet) is retried on later
+passes and quarantined after `max_upload_attempts`. The spool directory is
+opened when the writer starts (on `start()` or the first queued row), not
+at import.
+
+Uploads are append-only streaming inserts. Each row's insert ID is derived
+from (interaction_id, user, time), so BigQuery drops most retried rows and
+the views that read the log (see feedback.py) drop the rest.
+"""
+import atexit
+import functools
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from logger import logger
+from tracing import tracer
+from log_spool import LogSpool, read_segment
+import config
+
+# Columns that identify a log or feedback row when uploads are retried.
+DEDUPE_KEYS = ("interaction_id", "user", "time")
+
+# Rows per streaming insert request (BigQuery recommends at most 500)
+INSERT_CHUNK_ROWS = 500
+
+# Marker pushed onto the queue to wake the worker up on shutdown.
+_STOP = object()
+
+
+class BigQueryLogWriter:
+    """Batches log rows and writes them to BigQuery off the event loop."""
+
+    def __init__(
+        self,
+        project_id: str,
+        max_queue_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        sink: Optional[Callable[[str, List[dict]], None]] = None,
+        spool: Optional[LogSpool] = None,
+        spool_factory: Optional[Callable[[], LogSpool]] = None,
+        max_backoff: float = 300.0,
+        max_upload_attempts: int = 5,
+    ):
+        self.project_id = project_id
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.1, flush_interval)
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+        self.sink = sink or self._insert_to_bigquery # Called as sink(table_full_id, rows)
+        self.spool = spool
+        self.spool_factory = spool_factory # Builds the spool on start, so importing this module touches no files
+        self.max_backoff = max_backoff
+        self.max_upload_attempts = max(1, max_upload_attempts)
+        self._segment_failures: Dict[str, int] = {} # Segment path -> failed uploads while others succeeded
+        self._uploader: Optional[threading.Thread] = None
+        self._upload_wakeup = threading.Event()
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._counters = {
+            "rows_enqueued": 0,
+            "rows_dropped": 0,
+            "rows_written": 0,
+            "rows_failed": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+            "rows_spooled": 0,
+            "spool_failures": 0,
+            "upload_failures": 0,
+        }
+
+    # --- Public API ---
+
+    def enqueue(self, table_full_id: str, row: dict) -> bool:
+        """Queues a row for `table_full_id`. Returns False if it was dropped."""
+        if self._stopped.is_set():
+            self._count("rows_dropped")
+            logger.warning("Log writer is stopped; dropping row for %s.", table_full_id)
+            return False
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((table_full_id, row))
+        except queue.Full:
+            self._count("rows_dropped")
+            logger.warning("Log queue is full; dropping row for %s.", table_full_id)
+            return False
+
+        self._count("rows_enqueued")
+        return True
+
+    def start(self):
+        """Opens the spool and starts the worker threads. enqueue also does this on first use."""
+        self._ensure_started()
+
+    def stop(self, timeout: float = 30.0):
+        """Flushes all queued rows and stops the worker thread."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+
+        thread = self._thread
+        if thread is None:
+            return
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass  # The worker is busy draining and will notice the stop flag.
+        started = time.monotonic()
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning("Log writer did not drain within %.1fs; %d rows left in queue.", timeout, self._queue.qsize())
+
+        if self._uploader is not None:
+            # Close the last segment and give the uploader one more pass; whatever is left uploads on the next start
+            self.spool.close()
+            self._upload_wakeup.set()
+            self._uploader.join(max(0.0, timeout - (time.monotonic() - started)))
+            if self._uploader.is_alive():
+                logger.warning("Log spool upload did not finish before shutdown; %d segments stay on disk.", len(self.spool.closed_segments()))
+
+    def get_client(self):
+        """Returns the shared BigQuery client, creating it on first use."""
+        with self._client_lock:
+            if self._client is None:
+                from google.cloud import bigquery
+                self._client = bigquery.Client(project=self.project_id)
+            return self._client
+
+    def stats(self) -> Dict[str, float]:
+        """Returns a snapshot of the writer counters, including queue depth."""
+        with self._stats_lock:
+            snapshot = dict(self._counters)
+        snapshot["queue_depth"] = self._queue.qsize()
+        if self.spool is not None:
+            spool_stats = self.spool.stats()
+            snapshot["spool_segments_pending"] = spool_stats["segments_pending"]
+            snapshot["spool_bytes"] = spool_stats["bytes"]
+            snapshot["spool_rows_evicted"] = spool_stats["rows_evicted"]
+            snapshot["spool_segments_failed"] = spool_stats["segments_failed"]
+        return snapshot
+
+    def upload_spooled(self) -> bool:
+        """
+        Uploads every closed spool segment. Returns False if any failed; those
+        are left for a retry, and quarantined once they have failed
+        `max_upload_attempts` passes in which other segments uploaded.
+        """
+        self.spool.rotate()
+        uploaded, failed = 0, []
+        for path in self.spool.closed_segments():
+            claimed = self.spool.claim(path)
+            if claimed is None:
+                continue # Another process is uploading it
+            done = False
+            try:
+                if self._segment_failures.get(path, 0) >= self.max_upload_attempts:
+                    self.spool.quarantine(claimed)
+                    self._segment_failures.pop(path, None)
+                    logger.error(
+                        "Log spool segment %s failed %d uploads; quarantined it. Upload it with `python log_spool.py replay`.",
+                        os.path.basename(path), self.max_upload_attempts,
+                    )
+                    done = True
+                    continue
+                done = all(self._write(table_full_id, rows) for table_full_id, rows in read_segment(claimed).items())
+            except (OSError, ValueError, KeyError) as e:
+                logger.error("Could not read log spool segment %s: %s", claimed, e)
+            finally:
+                if not done:
+                    self.spool.release(claimed)
+            if done:
+                self.spool.remove(claimed)
+                self._segment_failures.pop(path, None)
+                uploaded += 1
+            else:
+                failed.append(path)
+
+        if uploaded:
+            # BigQuery is reachable, so these segments themselves are the problem
+            for path in failed:
+                self._segment_failures[path] = self._segment_failures.get(path, 0) + 1
+        return not failed
+
+    # --- Internals ---
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                if self.spool is None and self.spool_factory is not None:
+                    try:
+                        self.spool = self.spool_factory()
+                    except OSError as e:
+                        self._count("spool_failures")
+                        logger.error("Could not open the log spool; writing rows directly to BigQuery: %s", e)
+                self._thread = threading.Thread(target=self._run, name="bq-log-writer", daemon=True)
+                self._thread.start()
+                if self.spool is not None:
+                    self._uploader = threading.Thread(target=self._upload_loop, name="bq-log-uploader", daemon=True)
+                    self._uploader.start()
+
+    def _upload_loop(self):
+        backoff = 0.0
+        while True:
+            stopping = self._stopped.is_set() and not (self._thread and self._thread.is_alive())
+            if self.upload_spooled():
+                backoff = 0.0
+            else:
+                self._count("upload_failures")
+                backoff = min(self.max_backoff, max(1.0, backoff * 2))
+                logger.warning("Log spool upload failed; retrying in %.0fs.", backoff)
+            if stopping:
+                return
+            # The next pass runs when the current segment is due to close, or after the backoff
+            self._upload_wakeup.wait(backoff or self.spool.segment_max_age)
+            self._upload_wakeup.clear()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            if self._stopped.is_set() and self._queue.empty():
+                return
+
+    def _next_batch(self) -> List[tuple]:
+        """Collects rows until the batch is full or the flush interval elapses."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._stopped.is_set():
+                # Drain whatever is left without waiting on the timer.
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is _STOP:
+                continue
+            batch.append(item)
+        return batch
+
+    def _flush(self, batch: List[tuple]):
+        if self.spool is not None:
+            try:
+                self.spool.append(batch)
+                self._count("rows_spooled", len(batch))
+                return
+            except OSError as e:
+                # The disk is full or unwritable; write straight to BigQuery instead
+                self._count("spool_failures")
+                logger.error("Could not spool %d log rows, writing them directly: %s", len(batch), e)
+
+        rows_by_table: Dict[str, List[dict]] = {}
+        for table_full_id, row in batch:
+            rows_by_table.setdefault(table_full_id, []).append(row)
+
+        for table_full_id, rows in rows_by_table.items():
+            if not self._write(table_full_id, rows):
+                self._count("rows_failed", len(rows))
+
+    def _write(self, table_full_id: str, rows: List[dict]) -> bool:
+        """Writes `rows` through the sink. Returns False if the write failed."""
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            self.sink(table_full_id, rows)
+        except Exception as e:
+            status = "error"
+            self._count("flush_failures")
+            logger.error("Failed to flush %d log rows to %s: %s", len(rows), table_full_id, e)
+            return False
+        finally:
+            elapsed = time.perf_counter() - started
+            tracer.record("bigquery_flush", elapsed, status)
+            with self._stats_lock:
+                self._counters["flushes"] += 1
+                self._counters["last_flush_seconds"] = elapsed
+                self._counters["total_flush_seconds"] += elapsed
+                self._counters["max_flush_seconds"] = max(self._counters["max_flush_seconds"], elapsed)
+
+        self._count("rows_written", len(rows))
+        logger.info("Flushed %d log rows to %s in %.3fs.", len(rows), table_full_id, elapsed)
+        return True
+
+    def _insert_to_bigquery(self, table_full_id: str, rows: List[dict]):
+        """
+        Appends `rows` to `table_full_id` with streaming inserts. The insert ID
+        of each row is derived from DEDUPE_KEYS, so BigQuery drops most rows of
+        a retried upload.
+        """
+        client = self.get_client()
+        for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+            chunk = rows[start:start + INSERT_CHUNK_ROWS]
+            errors = client.insert_rows_json(
+                table_full_id,
+                chunk,
+                row_ids=[insert_id(table_full_id, row) for row in chunk],
+                ignore_unknown_values=True,
+            )
+            if errors:
+                raise RuntimeError(f"{len(errors)} of {len(chunk)} rows were rejected: {errors[:3]}")
+
+
+def insert_id(table_full_id: str, row: dict) -> str:
+    """A stable insert ID for a log row, from its DEDUPE_KEYS (or the whole row if it has none)."""
+    key = [row.get(name) for name in DEDUPE_KEYS]
+    if not any(key):
+        key = row
+    return hashlib.sha256(json.dumps([table_full_id, key], sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+
+log_writer = BigQueryLogWriter(
+    project_id=config.PROJECT_ID,
+    max_queue_size=config.LOG_QUEUE_MAX_SIZE,
+    batch_size=config.LOG_BATCH_SIZE,
+    flush_interval=config.LOG_FLUSH_INTERVAL_SECONDS,
+    spool_factory=functools.partial(
+        LogSpool,
+        directory=config.LOG_SPOOL_DIR,
+        segment_max_bytes=config.LOG_SPOOL_SEGMENT_BYTES,
+        segment_max_age=config.LOG_SPOOL_SEGMENT_SECONDS,
+        max_total_bytes=config.LOG_SPOOL_MAX_BYTES,
+    ) if config.LOG_SPOOL_ENABLED else None,
+    max_backoff=config.LOG_UPLOAD_MAX_BACKOFF_SECONDS,
+    max_upload_attempts=config.LOG_UPLOAD_MAX_ATTEMPTS,
+)
+atexit.register(log_writer.stop)
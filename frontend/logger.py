@@ -1,23 +1,69 @@
+import json
 import logging
+import os
 import sys
 
+# Attributes every LogRecord has; anything else was passed through `extra=`.
+_RESERVED_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in record.__dict__.items() if key not in _RESERVED_ATTRS}
+
+
+class TextFormatter(logging.Formatter):
+    """The usual single-line format, followed by any `extra=` fields as key=value pairs."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " | " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with `extra=` fields as top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.funcName}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
 def setup_logger():
     """
     Sets up a logger that prints to stdout with a specific format.
+
+    LOG_LEVEL sets the level (default INFO) and LOG_FORMAT=json switches to
+    one JSON object per line. Log calls should pass their arguments lazily
+    (`logger.debug("Got %s", value)`) so nothing is formatted when the level
+    is disabled, and structured fields via `extra={...}`.
     """
     logger = logging.getLogger("Nostradamus-CoPilot")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
     logger.propagate = False  # Prevent logs from being passed to the root logger
 
     # Avoid adding multiple handlers if the logger is already configured
     if not logger.handlers:
         handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(funcName)s:%(lineno)d] - %(message)s'
-        )
+        if os.getenv("LOG_FORMAT", "text").lower() == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = TextFormatter(
+                '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(funcName)s:%(lineno)d] - %(message)s'
+            )
         handler.setFormatter(formatter)
         logger.addHandler(handler)
 
     return logger
 
-logger = setup_logger()
\ No newline at end of file
+logger = setup_logger()
@@ -0,0 +1,78 @@
+"""
+Paged rendering of large answer tables.
+
+An answer table over the row or byte threshold is not sent to the browser in
+full: the message shows the first page and a summary line, and a "Next page"
+action serves the following pages from the rows kept in the result store.
+The conversation history keeps a compact preview of such tables, not the
+full table.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class PagedTable:
+    """A markdown table split into its header and row lines, with the text around it."""
+    header: str
+    separator: str
+    rows: List[str] = field(repr=False)
+    intro: str = ""
+    outro: str = ""
+    page_size: int = 25
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.rows) // self.page_size))
+
+    def size_bytes(self) -> int:
+        return sum(len(row) for row in self.rows) + len(self.header) + len(self.intro) + len(self.outro)
+
+    def render_page(self, page: int) -> str:
+        """Markdown for page `page` (0-based), with a line saying which rows it shows."""
+        page = min(max(0, page), self.page_count - 1)
+        start = page * self.page_size
+        end = min(start + self.page_size, len(self.rows))
+        parts = [self.intro] if page == 0 and self.intro else []
+        parts.append("\n".join([self.header, self.separator] + self.rows[start:end]))
+        parts.append(f"_Rows {start + 1:,}-{end:,} of {len(self.rows):,} (page {page + 1} of {self.page_count})._")
+        if page == 0 and self.outro:
+            parts.append(self.outro)
+        return "\n\n".join(parts)
+
+    def compact(self, preview_rows: int = 5) -> str:
+        """The table's first rows and its total row count, for the conversation history."""
+        shown = self.rows[:preview_rows]
+        parts = [self.intro] if self.intro else []
+        parts.append("\n".join([self.header, self.separator] + shown))
+        parts.append(f"_{len(shown):,} of {len(self.rows):,} rows shown._")
+        if self.outro:
+            parts.append(self.outro)
+        return "\n\n".join(parts)
+
+
+def split_table(text: str, page_size: int = 25) -> Optional[PagedTable]:
+    """Splits the first markdown table in `text`. Returns None if there is no table."""
+    lines = (text or "").strip().splitlines()
+    start = next((i for i, line in enumerate(lines) if line.strip().startswith("|")), None)
+    if start is None or start + 1 >= len(lines) or not lines[start + 1].strip().startswith("|"):
+        return None
+    end = start
+    while end < len(lines) and lines[end].strip().startswith("|"):
+        end += 1
+
+    return PagedTable(
+        header=lines[start].strip(),
+        separator=lines[start + 1].strip(),
+        rows=[line.strip() for line in lines[start + 2:end]],
+        intro="\n".join(lines[:start]).strip(),
+        outro="\n".join(lines[end:]).strip(),
+        page_size=max(1, page_size),
+    )
+
+
+def needs_paging(table: Optional[PagedTable], max_rows: int, max_bytes: int) -> bool:
+    """True if the table is over the row or the byte threshold."""
+    if table is None or len(table.rows) <= table.page_size:
+        return False
+    return len(table.rows) > max_rows or table.size_bytes() > max_bytes
@@ -0,0 +1,303 @@
+"""
+Prefetching of popular questions into the answer cache.
+
+The interaction log (through the merged feedback view) records which
+questions people ask and how they rate the answers. The prefetcher ranks
+recent opening questions by how often they were asked plus their net
+feedback, and answers the top K ahead of time so they are served from the
+answer cache instead of waiting on model generation. The log has no
+conversation ID, so a question opens a conversation when its user asked
+nothing in the `session_gap_minutes` before it; questions that read like
+follow-ups ("and last year?", "same by region") are left out, since their
+answer depends on the history they were asked with.
+
+A pass runs whenever the answers could have changed: after each refresh of
+the mart table (its last-modified time moves), when the date rolls over
+(year-to-date answers move daily and the others when a month closes, see
+`answer_cache.period_bucket`), or when the cached answers are about to
+expire. Only opening questions (no conversation history) are prefetched,
+since the cache key includes the history.
+
+The answer cache it fills is a SQLite file per host, so on each host only
+the worker holding that host's "prefetcher" lease in the session store runs
+the passes; the other workers read the answers from the shared file instead
+of each putting the same load on the toolbox. With the per-process "memory"
+session backend every worker holds its own lease; enable PREFETCH_ENABLED on
+one worker per host in that case.
+
+Run `python prefetch.py` to print the current ranking without answering.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from logger import logger
+from log_writer import log_writer
+from answer_cache import answer_cache
+from context_builder import build_query_context, build_tool_params
+from executors import run_blocking
+from admission import admission, AdmissionRejected
+from singleflight import singleflight, make_flight_key
+from toolbox_pool import toolbox_pool
+from schema_cache import schema_cache, schema_for_question
+from resilience import toolbox_caller, CircuitOpenError
+from response_parser import parse_tool_response
+from feedback import FEEDBACK_VIEW_FULL_ID
+from session_store import session_store
+import config
+
+# Admission-control identity of the prefetcher, so it is held to the per-user limit
+PREFETCH_USER = "prefetcher"
+
+# Session-store lease that one worker per host holds at a time
+PREFETCH_LEASE = f"prefetcher:{socket.gethostname()}"
+
+# Normalized questions that refer back to an earlier turn or are too short to stand alone
+FOLLOW_UP_PATTERN = (
+    r"^(and|but|also|or|then|now|so|ok|okay|what about|how about|same|instead|only|just|except)\b"
+    r"|\b(same|previous|above|aforementioned|those|these|them|that one|this one|last one)\b"
+    r"|^\S+(\s+\S+)?\??$"
+)
+
+# Ranks opening questions (the first of each user's session) by frequency plus net feedback over the lookback window.
+TOP_QUESTIONS_SQL = f"""
+WITH logged AS (
+  -- The dump table's `time` is DATETIME (naive UTC, as written by pandas_gbq) or TIMESTAMP
+  SELECT user, user_query, status, user_feedback, CAST(time AS TIMESTAMP) AS asked_at
+  FROM `{FEEDBACK_VIEW_FULL_ID}`
+  WHERE user_query IS NOT NULL
+),
+turns AS (
+  SELECT
+    user_query,
+    status,
+    user_feedback,
+    TIMESTAMP_DIFF(asked_at, LAG(asked_at) OVER (PARTITION BY user ORDER BY asked_at), MINUTE) AS minutes_since_previous
+  FROM logged
+  WHERE asked_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @lookback_days DAY)
+),
+asked AS (
+  SELECT
+    LOWER(TRIM(REGEXP_REPLACE(user_query, r'\\s+', ' '))) AS normalized_query,
+    user_query,
+    user_feedback
+  FROM turns
+  WHERE status = 'success'
+    AND (minutes_since_previous IS NULL OR minutes_since_previous >= @session_gap_minutes)
+)
+SELECT
+  ANY_VALUE(user_query) AS question,
+  COUNT(*) AS asked,
+  COUNTIF(user_feedback = 'positive') AS positive,
+  COUNTIF(user_feedback = 'negative') AS negative
+FROM asked
+WHERE NOT REGEXP_CONTAINS(normalized_query, @follow_up_pattern)
+GROUP BY normalized_query
+HAVING asked >= @min_asks
+ORDER BY asked + @positive_weight * positive - @negative_weight * negative DESC
+LIMIT @top_k
+"""
+
+
+class Prefetcher:
+    """Periodically warms the answer cache with the most popular questions."""
+
+    def __init__(
+        self,
+        top_k: int = 20,
+        lookback_days: int = 30,
+        min_asks: int = 3,
+        session_gap_minutes: int = 30,
+        positive_weight: float = 2.0,
+        negative_weight: float = 5.0,
+        check_interval: float = 900.0,
+        refresh_after: float = 4.5 * 3600,
+        concurrency: int = 2,
+    ):
+        self.top_k = top_k
+        self.lookback_days = lookback_days
+        self.min_asks = min_asks
+        self.session_gap_minutes = session_gap_minutes
+        self.positive_weight = positive_weight
+        self.negative_weight = negative_weight
+        self.check_interval = check_interval
+        # Re-warm before the cached answers expire even if nothing else changed
+        self.refresh_after = refresh_after
+        # Few calls at a time, so prefetching never fills the admission queue ahead of users
+        self.concurrency = max(1, concurrency)
+        self._system_instruction = ""
+        self._task: Optional[asyncio.Task] = None
+        self._last_signature: Optional[Tuple[str, str]] = None
+        self._data_version: Optional[str] = None
+        self._failing = False
+        self._last_run = 0.0
+        self._owner = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Outlives a missed check or two, and frees the lease soon after its holder stops
+        self.lease_ttl = 3 * check_interval
+        self._counters = {"runs": 0, "questions_warmed": 0, "questions_failed": 0, "last_run_seconds": 0.0, "lease_held": 0}
+
+    # --- Public API ---
+
+    def start(self, system_instruction: str):
+        """Starts the background schedule in the running event loop."""
+        self._system_instruction = system_instruction
+        if not session_store.shared:
+            logger.warning("Prefetching with a per-process session store: every worker runs its own passes. Use a shared SESSION_BACKEND.")
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._schedule(), name="prefetcher")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def rank_questions(self) -> List[Dict]:
+        """Returns the top-K questions with their ask and feedback counts. Blocking."""
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("lookback_days", "INT64", self.lookback_days),
+            bigquery.ScalarQueryParameter("min_asks", "INT64", self.min_asks),
+            bigquery.ScalarQueryParameter("session_gap_minutes", "INT64", self.session_gap_minutes),
+            bigquery.ScalarQueryParameter("follow_up_pattern", "STRING", FOLLOW_UP_PATTERN),
+            bigquery.ScalarQueryParameter("positive_weight", "FLOAT64", self.positive_weight),
+            bigquery.ScalarQueryParameter("negative_weight", "FLOAT64", self.negative_weight),
+            bigquery.ScalarQueryParameter("top_k", "INT64", self.top_k),
+        ])
+        from google.api_core.exceptions import NotFound
+
+        try:
+            rows = log_writer.get_client().query(TOP_QUESTIONS_SQL, job_config=job_config, location=config.BQ_LOCATION).result()
+        except NotFound as e:
+            raise LookupError(f"{e}. Run `python feedback.py` to create the feedback view.") from e
+        return [dict(row.items()) for row in rows]
+
+    def data_version(self) -> str:
+        """Last-modified time of the mart table the questions are answered from. Blocking."""
+        table = log_writer.get_client().get_table(f"{config.PROJECT_ID}.{config.DATASET_ID_1}.{config.TABLE_ID_1}")
+        return table.modified.isoformat() if table.modified else ""
+
+    async def run_once(self) -> int:
+        """Answers the current top-K questions into the answer cache. Returns how many were cached."""
+        started = time.perf_counter()
+        questions = await run_blocking(self.rank_questions)
+        logger.info("Prefetching answers for %d popular questions.", len(questions))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def warm(question: str) -> bool:
+            async with semaphore:
+                return await self._warm(question)
+
+        results = await asyncio.gather(*(warm(row["question"]) for row in questions), return_exceptions=True)
+        warmed = sum(1 for result in results if result is True)
+        failed = len(results) - warmed
+
+        elapsed = time.perf_counter() - started
+        self._counters["runs"] += 1
+        self._counters["questions_warmed"] += warmed
+        self._counters["questions_failed"] += failed
+        self._counters["last_run_seconds"] = elapsed
+        logger.info("Prefetched %d answers (%d failed) in %.1fs.", warmed, failed, elapsed)
+        return warmed
+
+    def stats(self) -> Dict[str, float]:
+        return dict(self._counters)
+
+    # --- Internals ---
+
+    async def _schedule(self):
+        while True:
+            try:
+                signature = (await run_blocking(self.data_version), date.today().isoformat())
+                if self._data_version is not None and signature[0] != self._data_version:
+                    schema_cache.invalidate() # The mart table was modified; re-read its metadata
+                self._data_version = signature[0]
+
+                held = await session_store.acquire_lease(PREFETCH_LEASE, self._owner, self.lease_ttl)
+                if held != bool(self._counters["lease_held"]):
+                    logger.info("Prefetcher lease %s.", "taken" if held else "held by another worker")
+                    self._counters["lease_held"] = int(held)
+                if not held:
+                    # The holder warms the shared answer cache; start afresh if this worker takes over
+                    self._last_signature = None
+                stale = time.monotonic() - self._last_run >= self.refresh_after
+                if held and (signature != self._last_signature or stale):
+                    await self.run_once()
+                    self._last_signature = signature
+                    self._last_run = time.monotonic()
+                if self._failing:
+                    logger.info("Prefetch passes are working again.")
+                    self._failing = False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Warn once, not on every pass, while the same problem (e.g. a missing view) persists
+                if not self._failing:
+                    logger.warning("Prefetch pass failed; retrying every %.0fs: %s", self.check_interval, e)
+                else:
+                    logger.debug("Prefetch pass failed again: %s", e)
+                self._failing = True
+            await asyncio.sleep(self.check_interval)
+
+    async def _warm(self, question: str) -> bool:
+        """Answers one opening question and caches the raw response, like a first message in a chat."""
+        schema = await schema_for_question(question)
+        query_context = build_query_context(
+            self._system_instruction,
+            [],
+            question,
+            token_budget=config.CONTEXT_TOKEN_BUDGET,
+            recent_turns=config.CONTEXT_RECENT_TURNS,
+            schema_text=schema.text,
+        )
+        tool_params = build_tool_params(query_context.prompt, schema.table_references, temperature=0.0)
+
+        async def call_ask_data_insights(publish) -> str:
+            await admission.acquire(PREFETCH_USER)
+            try:
+                toolset_list = await toolbox_pool.get_toolset()
+                # No hedging: a duplicate request is not worth it for a background warm-up
+                return await toolbox_caller.call(lambda claim: toolset_list[0](**tool_params), hedged=False)
+            finally:
+                admission.release(PREFETCH_USER)
+
+        try:
+            # A user asking the same question meanwhile joins this call instead of starting another
+            flight_key = make_flight_key(query_context.prompt, schema.table_references)
+            response_string, _ = await singleflight.do(flight_key, call_ask_data_insights)
+        except (AdmissionRejected, CircuitOpenError) as e:
+            logger.info("Skipping prefetch of %r: %s", question, e)
+            return False
+        except Exception as e:
+            logger.warning("Failed to prefetch %r: %s", question, e)
+            return False
+
+        if not response_string or not parse_tool_response(response_string).succeeded:
+            return False
+        await answer_cache.save(answer_cache.make_key(question, query_context.history_text), response_string)
+        return True
+
+
+prefetcher = Prefetcher(
+    top_k=config.PREFETCH_TOP_K,
+    lookback_days=config.PREFETCH_LOOKBACK_DAYS,
+    min_asks=config.PREFETCH_MIN_ASKS,
+    session_gap_minutes=config.PREFETCH_SESSION_GAP_MINUTES,
+    check_interval=config.PREFETCH_CHECK_INTERVAL_SECONDS,
+    refresh_after=0.75 * config.ANSWER_CACHE_TTL_SECONDS,
+    concurrency=config.ADMISSION_MAX_PER_USER,
+)
+
+
+if __name__ == "__main__":
+    for row in prefetcher.rank_questions():
+        print(f"{row['asked']:>5} asked  +{row['positive']}/-{row['negative']}  {row['question']}")
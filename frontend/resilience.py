@@ -0,0 +1,295 @@
+"""
+Deadlines, hedged requests and a circuit breaker for toolbox calls.
+
+`toolbox_caller.call(attempt)` runs one logical tool call:
+
+* the circuit breaker fails fast with CircuitOpenError while the backend is
+  unhealthy (after `failure_threshold` consecutive failed calls), and lets a
+  single probe through once `reset_timeout` has passed. Each logical call
+  counts once, however many attempts it made;
+* if the first attempt has not produced anything after a delay derived from
+  the p95 of recent calls' time to first output (measured from the start of
+  the call), a duplicate (hedged) attempt is started; the first attempt to
+  claim the result wins and the others are cancelled. An attempt that fails
+  early is replaced in the same way. Neither happens unless the breaker is
+  closed, so a half-open probe stays a single request, nor unless `reserve()`
+  grants the extra attempt an admission slot of its own, so duplicates stay
+  within the admission limits;
+* the whole call is bounded by a deadline (DeadlineExceeded).
+
+An attempt is `async def attempt(claim) -> result`. Attempts that show output
+as they go (streaming) must call `claim()` before their first visible
+output and, if it returns False, raise ClaimLost without showing anything;
+buffered attempts are claimed when they return.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from logger import logger
+from tracing import metrics
+import config
+
+T = TypeVar("T")
+Attempt = Callable[[Callable[[], bool]], Awaitable[T]]
+# Takes a slot for an extra attempt if one is free now; returns the slot's release, or None
+Reserve = Callable[[], Optional[Callable[[], None]]]
+
+ATTEMPTS_METRIC = "copilot_toolbox_attempts_total"
+OUTCOMES_METRIC = "copilot_toolbox_calls_total"
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the backend while the circuit breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The toolbox backend is unavailable; retry in {retry_after:.0f}s.")
+        self.retry_after = retry_after
+
+
+class ClaimLost(Exception):
+    """Raised by an attempt that found another attempt's output already claimed; not a failure."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a tool call does not finish within its deadline."""
+
+    def __init__(self, deadline: float):
+        super().__init__(f"The toolbox call did not finish within {deadline:.0f}s.")
+        self.deadline = deadline
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and half-opens for one probe after `reset_timeout`."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a call may go to the backend now."""
+        if self.state == CLOSED:
+            return
+        waited = time.monotonic() - self._opened_at
+        if self.state == OPEN and waited >= self.reset_timeout:
+            self.state = HALF_OPEN
+            logger.info("Circuit breaker half-open; probing the toolbox backend.")
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        raise CircuitOpenError(max(1.0, self.reset_timeout - waited))
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("Circuit breaker closed; the toolbox backend recovered.")
+        self.state = CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("Circuit breaker open after %d failures; failing fast for %.0fs.", self._failures, self.reset_timeout)
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def record_cancelled(self):
+        """A call that was cancelled (e.g. its user left) neither closes nor re-opens the circuit."""
+        self._probe_in_flight = False
+
+
+class LatencyWindow:
+    """Recent times to first output (from the start of each call), for a p95-derived hedge delay."""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class ResilientCaller:
+    """Runs tool calls with a circuit breaker, hedging and a deadline."""
+
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        deadline: Optional[float] = 180.0,
+        hedging_enabled: bool = True,
+        max_attempts: int = 2,
+        hedge_percentile: float = 95.0,
+        hedge_min_delay: float = 5.0,
+        hedge_max_delay: float = 60.0,
+        min_samples: int = 20,
+    ):
+        self.breaker = breaker
+        self.deadline = deadline
+        self.hedging_enabled = hedging_enabled
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.min_samples = min_samples
+        self.latencies = LatencyWindow()
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before starting a hedged attempt, or None when hedging is off."""
+        if not self.hedging_enabled:
+            return None
+        if len(self.latencies) < self.min_samples:
+            return self.hedge_max_delay
+        p = self.latencies.percentile(self.hedge_percentile)
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, p))
+
+    async def call(
+        self, attempt: Attempt, deadline: Optional[float] = None, hedged: bool = True, reserve: Optional[Reserve] = None
+    ) -> T:
+        """
+        Runs `attempt` within the deadline, hedged unless `hedged` is False. See the module docstring.
+        The caller holds a slot for the first attempt; each further one needs a slot from `reserve`.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        max_attempts = self.max_attempts if hedged else 1
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            metrics.inc(OUTCOMES_METRIC, outcome="circuit_open")
+            raise
+
+        try:
+            if deadline:
+                result = await asyncio.wait_for(self._hedged(attempt, max_attempts, reserve), timeout=deadline)
+            else:
+                result = await self._hedged(attempt, max_attempts, reserve)
+        except asyncio.TimeoutError:
+            self.breaker.record_failure()
+            metrics.inc(OUTCOMES_METRIC, outcome="deadline_exceeded")
+            raise DeadlineExceeded(deadline) from None
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            metrics.inc(OUTCOMES_METRIC, outcome="error")
+            raise
+        self.breaker.record_success()
+        metrics.inc(OUTCOMES_METRIC, outcome="success")
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        delay = self.hedge_delay()
+        return {
+            "circuit_state": {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[self.breaker.state],
+            "hedge_delay_seconds": delay if delay is not None else 0.0,
+            "latency_samples": len(self.latencies),
+        }
+
+    async def _hedged(self, attempt: Attempt, max_attempts: int, reserve: Optional[Reserve]) -> T:
+        tasks: List[asyncio.Task] = []
+        call_started = time.monotonic()
+        winner: Optional[int] = None
+
+        def make_claim(index: int) -> Callable[[], bool]:
+            def claim() -> bool:
+                nonlocal winner
+                if winner is None:
+                    winner = index
+                    # From the start of the call, so a winning hedge does not pull the p95 down
+                    self.latencies.add(time.monotonic() - call_started)
+                    for other, task in enumerate(tasks):
+                        if other != index:
+                            task.cancel()
+                    if index > 0:
+                        metrics.inc(ATTEMPTS_METRIC, outcome="hedge_won")
+                return winner == index
+            return claim
+
+        def launch(kind: str) -> bool:
+            index = len(tasks)
+            release = None
+            if index > 0:
+                release = reserve() if reserve is not None else None
+                if release is None:
+                    metrics.inc(ATTEMPTS_METRIC, outcome=f"{kind}_skipped")
+                    return False
+            task = asyncio.ensure_future(attempt(make_claim(index)))
+            if release is not None:
+                task.add_done_callback(lambda _: release())
+            tasks.append(task)
+            metrics.inc(ATTEMPTS_METRIC, outcome=kind)
+            return True
+
+        launch("primary")
+        last_error: Optional[BaseException] = None
+        try:
+            while True:
+                pending = [task for task in tasks if not task.done()]
+                # No extra attempts while the breaker is half-open (a single probe) or open
+                can_launch = winner is None and len(tasks) < max_attempts and self.breaker.state == CLOSED
+                delay = self.hedge_delay() if can_launch else None
+                if pending:
+                    done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    done = set()
+
+                if not done and pending:
+                    # The hedge delay passed without a response; without a free slot, check again after another delay
+                    if launch("hedge"):
+                        logger.info("No toolbox response after %.1fs; started a hedged request.", delay)
+                    continue
+
+                for task in done:
+                    index = tasks.index(task)
+                    if task.cancelled() or isinstance(task.exception(), ClaimLost):
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        if make_claim(index)():
+                            return task.result()
+                        continue
+                    metrics.inc(ATTEMPTS_METRIC, outcome="failed")
+                    if winner == index:
+                        raise error # Its output was already shown; no other attempt can take over
+                    logger.warning("Toolbox attempt %d failed: %s", index + 1, error)
+                    last_error = error
+
+                if winner is None and all(task.done() for task in tasks):
+                    # Replace an attempt that failed early, if the breaker and admission allow another one
+                    if not (can_launch and launch("retry")):
+                        raise last_error or RuntimeError("Every toolbox attempt was cancelled.")
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+toolbox_caller = ResilientCaller(
+    breaker=CircuitBreaker(
+        failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=config.CIRCUIT_RESET_SECONDS,
+    ),
+    deadline=config.TOOLBOX_CALL_DEADLINE_SECONDS,
+    hedging_enabled=config.HEDGING_ENABLED,
+    max_attempts=config.HEDGE_MAX_ATTEMPTS,
+    hedge_percentile=config.HEDGE_PERCENTILE,
+    hedge_min_delay=config.HEDGE_MIN_DELAY_SECONDS,
+    hedge_max_delay=config.HEDGE_MAX_DELAY_SECONDS,
+)
@@ -0,0 +1,190 @@
+"""
+Parser for the multi-JSON string returned by the `ask_data_insights` tool.
+
+The tool answers with several JSON objects in one string, e.g.
+`{"SQL Generated": "..."}` followed by `{"Answer": "..."}`, sometimes wrapped
+in a JSON string literal or an array. The parser finds the balanced objects
+in one scan and decodes them with `json.JSONDecoder.raw_decode`, so nested
+objects and braces inside the answer text are handled, and splits the answer
+into its table, reasoning and follow-up sections.
+"""
+import json
+import re
+from dataclasses import dataclass
+from typing import Any, Iterator, List, Optional, Tuple
+
+REASONING_MARKER = "Reasoning:"
+FOLLOW_UPS_MARKER = "Follow-up Questions:"
+
+SQL_KEY = "SQL Generated"
+ANSWER_KEY = "Answer"
+
+# The answer the model gives when its query failed (see "Query Error Protocol" in system_prompt.txt)
+ERROR_MARKERS = ("the query could not be completed", "due to the following error")
+
+_decoder = json.JSONDecoder(strict=False)
+
+_STRING_LITERAL = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_OBJECT_SPECIAL = re.compile(r'[{}"]')
+# A brace that can start a JSON object: followed by a key or by the closing brace
+_OBJECT_OPENING = re.compile(r'\{\s*["}]')
+
+# (start, end, complete objects directly inside) of a balanced object in the text
+_Span = Tuple[int, int, List[Any]]
+
+
+@dataclass
+class ToolResponse:
+    """The parts of a tool response that the UI renders."""
+    sql: str = ""
+    answer: str = ""
+    table: str = ""
+    reasoning: str = ""
+    follow_ups: str = ""
+
+    @property
+    def main_content(self) -> str:
+        """The table (with its intro) followed by the reasoning."""
+        return self.table.strip() + "\n\n" + self.reasoning.strip()
+
+    @property
+    def succeeded(self) -> bool:
+        """True if the response has SQL and an answer table with data rows, and is not an error answer."""
+        if not self.sql.strip() or any(marker in self.answer.lower() for marker in ERROR_MARKERS):
+            return False
+        table_lines = [line for line in self.table.splitlines() if line.strip().startswith("|")]
+        return len(table_lines) >= 3 # Header, separator and at least one row
+
+
+def iter_json_objects(text: str) -> Iterator[Any]:
+    """
+    Yields every top-level JSON object embedded in `text`, skipping anything malformed.
+
+    An object at the top level is decoded directly; if that fails, one scan
+    matches braces outside string literals and hands only balanced spans to
+    `raw_decode`, so a truncated or malformed response costs linear time. Braces that do not open an object (`{ stray` in noise) are looked
+    through; when an object fails to decode, or is cut off at the end of the
+    text, the complete objects directly inside it are tried instead.
+    """
+    # Open braces, outermost first: (start, is_object, children, owner); `children` collects the
+    # complete objects directly inside an object brace and `owner` is the enclosing object's list
+    frames: List[Tuple[int, bool, Optional[List[_Span]], Optional[List[_Span]]]] = []
+    owner: Optional[List[_Span]] = None # Children of the innermost open object brace
+    index = text.find("{")
+    while index != -1:
+        char = text[index]
+        if char == '"':
+            match = _STRING_LITERAL.match(text, index)
+            if match is None:
+                break # An unterminated string runs to the end of the text
+            index = match.end()
+        elif char == "{":
+            is_object = _OBJECT_OPENING.match(text, index) is not None
+            if is_object and not frames:
+                # Fast path for a well-formed object; a failed decode stops at the error or the end of the text
+                try:
+                    obj, end = _decoder.raw_decode(text, index)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    yield obj
+                    index = text.find("{", end)
+                    continue
+            children: Optional[List[_Span]] = [] if is_object else None
+            frames.append((index, is_object, children, owner))
+            if is_object:
+                owner = children
+            index += 1
+        else: # "}"
+            start, is_object, children, owner = frames.pop()
+            index += 1
+            if is_object:
+                span = (start, index, children)
+                if owner is not None:
+                    owner.append(span)
+                else:
+                    yield from _decode_span(text, span)
+        if not frames:
+            index = text.find("{", index)
+            continue
+        match = _OBJECT_SPECIAL.search(text, index)
+        index = match.start() if match else -1
+
+    # Cut off at the end: keep the complete objects inside the open ones, in text order
+    for _, is_object, children, _ in frames:
+        for span in children or ():
+            yield from _decode_span(text, span)
+
+
+def _decode_span(text: str, span: "_Span") -> Iterator[Any]:
+    """Decodes a balanced span, or else the spans directly inside it."""
+    start, _, children = span
+    try:
+        yield _decoder.raw_decode(text, start)[0]
+        return
+    except json.JSONDecodeError:
+        pass
+    for child_start, _, _ in children:
+        try:
+            yield _decoder.raw_decode(text, child_start)[0]
+        except json.JSONDecodeError:
+            pass
+
+
+def _unwrap(response_text: str) -> str:
+    """Decodes a response that arrived double-encoded as a JSON string literal."""
+    stripped = response_text.lstrip()
+    if stripped.startswith('"'):
+        try:
+            decoded, _ = _decoder.raw_decode(stripped)
+        except json.JSONDecodeError:
+            return response_text
+        if isinstance(decoded, str):
+            return decoded
+    return response_text
+
+
+def _find_fields(obj: Any, found: dict):
+    """Collects SQL/Answer values from `obj` and anything nested in it; the last one wins."""
+    if isinstance(obj, dict):
+        if SQL_KEY in obj:
+            found[SQL_KEY] = obj[SQL_KEY]
+        elif ANSWER_KEY in obj:
+            found[ANSWER_KEY] = obj[ANSWER_KEY]
+        else:
+            for value in obj.values():
+                _find_fields(value, found)
+    elif isinstance(obj, list):
+        for value in obj:
+            _find_fields(value, found)
+
+
+def split_answer_sections(answer: str) -> Tuple[str, str, str]:
+    """Splits an answer into (table and intro, reasoning, follow-up questions)."""
+    if REASONING_MARKER not in answer:
+        return answer, "", ""
+
+    table_and_intro, remaining = answer.split(REASONING_MARKER, 1)
+    remaining = "Reasoning:\n" + remaining
+    if FOLLOW_UPS_MARKER in remaining:
+        reasoning, follow_ups = remaining.split(FOLLOW_UPS_MARKER, 1)
+        return table_and_intro, reasoning, follow_ups
+    return table_and_intro, remaining, ""
+
+
+def parse_tool_response(response_text: str) -> ToolResponse:
+    """Extracts the SQL and the answer sections from a multi-JSON response string."""
+    if not response_text or not isinstance(response_text, str):
+        return ToolResponse()
+
+    found = {}
+    for obj in iter_json_objects(_unwrap(response_text)):
+        _find_fields(obj, found)
+
+    sql = found.get(SQL_KEY) or ""
+    answer = found.get(ANSWER_KEY) or ""
+    sql = sql if isinstance(sql, str) else json.dumps(sql)
+    answer = answer if isinstance(answer, str) else json.dumps(answer)
+
+    table, reasoning, follow_ups = split_answer_sections(answer)
+    return ToolResponse(sql=sql, answer=answer, table=table, reasoning=reasoning, follow_ups=follow_ups)
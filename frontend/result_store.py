@@ -0,0 +1,194 @@
+"""
+Server-side store of answered interactions.
+
+Each answer is kept once, keyed by `interaction_id`, so chat actions only need
+to carry that ID instead of the full answer text or SQL. The answer table is
+parsed into a typed DataFrame on first use and memoized. The store is an LRU
+capped both by entry count and by an estimate of the memory it holds.
+
+With a shared session store (see session_store.py), each result is also
+written there, and a result this worker does not hold (an action clicked
+after a reconnect to another worker, or after eviction) is loaded from it.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from logger import logger
+from utils import markdown_table_to_df, convert_numeric_columns
+from executors import run_cpu_bound
+from pagination import PagedTable, split_table
+from response_parser import split_answer_sections
+from session_store import SessionStore, session_store
+import config
+
+
+def parse_answer_frame(answer: str):
+    """Parses the markdown table in an answer into a DataFrame with numeric columns converted."""
+    return convert_numeric_columns(markdown_table_to_df(answer))
+
+
+@dataclass
+class StoredResult:
+    """One answered question and everything its actions need."""
+    interaction_id: str
+    user_query: str
+    answer: str
+    sql: str = ""
+    follow_ups: str = ""
+    frame: Optional[object] = field(default=None, repr=False)  # Parsed answer table (pandas.DataFrame)
+    pages: Optional[PagedTable] = field(default=None, repr=False)  # Row lines of a table shown in pages
+
+    def to_record(self) -> dict:
+        """The result for the session store. Paged rows are rebuilt from the answer's table section, so only the page size is kept."""
+        return {
+            "interaction_id": self.interaction_id,
+            "user_query": self.user_query,
+            "answer": self.answer,
+            "sql": self.sql,
+            "follow_ups": self.follow_ups,
+            "page_size": self.pages.page_size if self.pages is not None else None,
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "StoredResult":
+        page_size = record.get("page_size")
+        return cls(
+            interaction_id=record["interaction_id"],
+            user_query=record.get("user_query", ""),
+            answer=record.get("answer", ""),
+            sql=record.get("sql", ""),
+            follow_ups=record.get("follow_ups", ""),
+            pages=cls.paged_table(record.get("answer", ""), page_size) if page_size else None,
+        )
+
+    @staticmethod
+    def paged_table(answer: str, page_size: int) -> Optional[PagedTable]:
+        """Pages the table section of `answer` (its intro and table, without the reasoning), as `app.main` does."""
+        table, _, _ = split_answer_sections(answer)
+        return split_table(table, page_size)
+
+    def size_bytes(self) -> int:
+        """Estimates the memory held by this result."""
+        size = sum(len(text or "") for text in (self.user_query, self.answer, self.sql, self.follow_ups))
+        if self.pages is not None:
+            size += self.pages.size_bytes()
+        if self.frame is not None:
+            size += int(self.frame.memory_usage(index=True, deep=True).sum())
+        return size
+
+
+class ResultStore:
+    """Bounded LRU of StoredResult objects keyed by interaction_id."""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 256 * 1024 * 1024, shared: Optional[SessionStore] = None):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        # Only a store other workers see; the memory backend would just hold a second copy
+        self.shared = shared if shared is not None and shared.shared else None
+        self._results: "OrderedDict[str, StoredResult]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "frames_parsed": 0, "shared_hits": 0}
+
+    def put(self, result: StoredResult):
+        """Stores `result`, evicting the least recently used entries if over the caps."""
+        with self._lock:
+            self._discard(result.interaction_id)
+            self._results[result.interaction_id] = result
+            self._account(result)
+            self._evict()
+
+    def get(self, interaction_id: Optional[str]) -> Optional[StoredResult]:
+        """Returns the stored result, or None if it is unknown or was evicted."""
+        with self._lock:
+            result = self._results.get(interaction_id) if interaction_id else None
+            if result is None:
+                self._counters["misses"] += 1
+                return None
+            self._results.move_to_end(interaction_id)
+            self._counters["hits"] += 1
+            return result
+
+    async def save(self, result: StoredResult):
+        """Stores `result` here and, if configured, in the shared session store."""
+        self.put(result)
+        if self.shared is not None:
+            await self.shared.save_result(result.interaction_id, result.to_record())
+
+    async def fetch(self, interaction_id: Optional[str]) -> Optional[StoredResult]:
+        """Like get, but loads a result this worker does not hold from the shared session store."""
+        result = self.get(interaction_id)
+        if result is not None or self.shared is None or not interaction_id:
+            return result
+        record = await self.shared.load_result(interaction_id)
+        if record is None:
+            return None
+        result = StoredResult.from_record(record)
+        with self._lock:
+            self._counters["shared_hits"] += 1
+        self.put(result)
+        return result
+
+    def get_frame(self, interaction_id: Optional[str]):
+        """
+        Returns the typed DataFrame for a stored answer, parsing it once.
+        Returns None if the result is gone; raises ValueError if the answer has no table.
+        """
+        result = self.get(interaction_id)
+        if result is None:
+            return None
+        if result.frame is None:
+            self._set_frame(result, parse_answer_frame(result.answer))
+        return result.frame
+
+    async def load_frame(self, interaction_id: Optional[str]):
+        """Like get_frame, but parses on the CPU worker pool so the event loop stays responsive."""
+        result = await self.fetch(interaction_id)
+        if result is None:
+            return None
+        if result.frame is None:
+            self._set_frame(result, await run_cpu_bound(parse_answer_frame, result.answer))
+        return result.frame
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss/eviction counters and the current size of the store."""
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot["entries"] = len(self._results)
+            snapshot["bytes"] = self._total_bytes
+        return snapshot
+
+    def _set_frame(self, result: StoredResult, frame):
+        with self._lock:
+            result.frame = frame
+            self._counters["frames_parsed"] += 1
+            if self._results.get(result.interaction_id) is result:
+                self._account(result)
+                self._evict()
+
+    def _account(self, result: StoredResult):
+        size = result.size_bytes()
+        self._total_bytes += size - self._sizes.get(result.interaction_id, 0)
+        self._sizes[result.interaction_id] = size
+
+    def _discard(self, interaction_id: str):
+        if self._results.pop(interaction_id, None) is not None:
+            self._total_bytes -= self._sizes.pop(interaction_id, 0)
+
+    def _evict(self):
+        # The most recently used entry is never evicted, even if it alone exceeds max_bytes.
+        while len(self._results) > self.max_entries or (self._total_bytes > self.max_bytes and len(self._results) > 1):
+            oldest = next(iter(self._results))
+            self._discard(oldest)
+            self._counters["evictions"] += 1
+            logger.debug("Evicted result %s from the result store.", oldest)
+
+
+result_store = ResultStore(
+    max_entries=config.RESULT_STORE_MAX_ENTRIES,
+    max_bytes=config.RESULT_STORE_MAX_BYTES,
+    shared=session_store,
+)
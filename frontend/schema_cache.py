@@ -0,0 +1,353 @@
+"""
+Cached table metadata and per-question table and column selection.
+
+The metadata of every configured query table is fetched with the toolbox's
+`bigquery_get_table_info` tool and cached for a TTL. Fetches always run in
+the background, each bounded by `fetch_timeout` (loading the toolset
+included), so a question never waits on the metadata: a stale entry keeps
+being served until it is replaced, and until a table has loaded questions go
+without column hints. A refresh that reports the same `lastModifiedTime` as
+the cached entry only renews it; otherwise the new metadata replaces the
+entry, and a changed schema (new or altered columns) is logged.
+
+For each question the tables and columns whose names or descriptions match
+its words are selected. Only the selected tables are passed to
+`ask_data_insights` as `table_references`, and a short list of the relevant
+columns is added to the prompt instead of the whole schema.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+from logger import logger
+from toolbox_pool import toolbox_pool
+import config
+
+TABLE_INFO_TOOL = "bigquery_get_table_info"
+
+# Column types that are kept whenever a table is selected, for period filters
+DATE_TYPES = {"DATE", "DATETIME", "TIMESTAMP"}
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CAMEL = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_STOPWORDS = {
+    "the", "and", "for", "what", "which", "who", "how", "many", "much", "give", "show", "tell",
+    "with", "from", "last", "this", "that", "wise", "per", "are", "was", "were", "could", "you",
+    "please", "into", "over", "all", "has", "have", "highest", "lowest", "top", "me", "of", "in",
+    "to", "at", "on", "by", "is", "it", "an", "or", "as", "be", "if", "do", "does", "can", "than",
+    "according", "split", "count", "number", "total", "percentage", "percent", "between",
+}
+
+
+@dataclass
+class Column:
+    name: str
+    type: str = ""
+    description: str = ""
+
+
+@dataclass
+class TableSchema:
+    """Metadata of one query table, as returned by `bigquery_get_table_info`."""
+    reference: Dict[str, str]
+    description: str = ""
+    columns: List[Column] = field(default_factory=list)
+    modified: str = "" # lastModifiedTime, compared on refresh
+
+    @property
+    def full_id(self) -> str:
+        return f"{self.reference['projectId']}.{self.reference['datasetId']}.{self.reference['tableId']}"
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the column definitions; changes only when the schema does."""
+        columns = [[c.name, c.type, c.description] for c in self.columns]
+        return hashlib.sha256(json.dumps([self.description, columns]).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class SchemaSelection:
+    """The tables and columns chosen for one question."""
+    table_references: List[Dict[str, str]]
+    columns: Dict[str, List[Column]]
+    text: str
+
+
+def _get(data: Dict[str, Any], *names: str, default: Any = None) -> Any:
+    """Case-insensitive lookup, since the tool may return REST or Go client field names."""
+    lowered = {str(key).lower(): value for key, value in data.items()}
+    for name in names:
+        if name.lower() in lowered and lowered[name.lower()] is not None:
+            return lowered[name.lower()]
+    return default
+
+
+def _flatten_fields(fields: Sequence[Dict[str, Any]], prefix: str = "") -> List[Column]:
+    columns = []
+    for f in fields or []:
+        name = prefix + str(_get(f, "name", default=""))
+        columns.append(Column(name=name, type=str(_get(f, "type", default="")).upper(), description=_get(f, "description", default="") or ""))
+        nested = _get(f, "fields", "schema")
+        if isinstance(nested, dict):
+            nested = _get(nested, "fields", default=[])
+        if nested:
+            columns.extend(_flatten_fields(nested, prefix=f"{name}."))
+    return columns
+
+
+def parse_table_info(reference: Dict[str, str], result: Any) -> TableSchema:
+    """Parses a `bigquery_get_table_info` result into a TableSchema."""
+    if isinstance(result, str):
+        result = json.loads(result)
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    if not isinstance(result, dict):
+        raise ValueError(f"Unexpected table info result: {type(result).__name__}")
+
+    schema = _get(result, "schema", default=[])
+    fields = _get(schema, "fields", default=[]) if isinstance(schema, dict) else schema
+    return TableSchema(
+        reference=dict(reference),
+        description=_get(result, "description", default="") or "",
+        columns=_flatten_fields(fields),
+        modified=str(_get(result, "lastModifiedTime", "modified", default="")),
+    )
+
+
+def _stem(word: str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") else word
+
+
+def question_terms(text: str) -> List[str]:
+    """The words of a question that can match a column."""
+    return [_stem(w) for w in _WORD.findall((text or "").lower()) if len(w) >= 2 and w not in _STOPWORDS]
+
+
+def name_terms(name: str) -> List[str]:
+    """Splits a column or table name (snake_case, camelCase or ALLCAPS) into lowercase parts."""
+    parts = []
+    for piece in re.split(r"[_.\s]+", name or ""):
+        parts.extend(_CAMEL.sub(" ", piece).lower().split())
+    return [_stem(p) for p in parts if p]
+
+
+def _matches(term: str, part: str) -> bool:
+    if term == part:
+        return True
+    if len(term) >= 3 and len(part) >= 3 and (part.startswith(term) or term.startswith(part)):
+        return True
+    # Concatenated names such as DISBURSALAMOUNT against "disbursement"
+    common = 0
+    for a, b in zip(term, part):
+        if a != b:
+            break
+        common += 1
+    return common >= 5
+
+
+def score_column(terms: Sequence[str], column: Column) -> float:
+    """Name matches count fully, description matches half."""
+    names = name_terms(column.name)
+    described = question_terms(column.description)
+    score = 0.0
+    for term in set(terms):
+        if any(_matches(term, part) for part in names):
+            score += 1.0
+        elif any(_matches(term, word) for word in described):
+            score += 0.5
+    return score
+
+
+def select_schema(
+    question: str,
+    tables: Sequence[TableSchema],
+    fallback_references: Sequence[Dict[str, str]],
+    max_tables: int = 2,
+    max_columns: int = 30,
+) -> SchemaSelection:
+    """
+    Chooses the tables and columns relevant to `question`. Without cached
+    metadata every table in `fallback_references` is used and no columns are listed.
+    """
+    if not tables:
+        return SchemaSelection(table_references=[dict(ref) for ref in fallback_references], columns={}, text="")
+
+    terms = question_terms(question)
+    scored = []
+    for table in tables:
+        column_scores = [(score_column(terms, column), index, column) for index, column in enumerate(table.columns)]
+        table_score = sum(score for score, _, _ in column_scores)
+        table_score += sum(1.0 for term in set(terms) if any(_matches(term, part) for part in name_terms(table.reference["tableId"])))
+        table_score += 0.5 * sum(1.0 for term in set(terms) if term in question_terms(table.description))
+        scored.append((table_score, table, column_scores))
+
+    # Keep the best table, plus others that score at least half as well
+    ranked = sorted(scored, key=lambda entry: -entry[0]) # Stable, so ties keep the configured order
+    best = ranked[0][0]
+    chosen = ranked[:1] + [entry for entry in ranked[1:] if best > 0 and entry[0] >= best / 2]
+    chosen = chosen[:max(1, max_tables)]
+
+    selected_columns: Dict[str, List[Column]] = {}
+    lines = ["### Relevant Tables and Columns:"]
+    for table_score, table, column_scores in chosen:
+        matched = [(score, index, column) for score, index, column in column_scores if score > 0]
+        if not matched:
+            # Nothing matched (e.g. a follow-up like "and last year?"); list the table's first columns
+            keep = column_scores[:max_columns]
+        else:
+            dates = [(0.0, index, column) for score, index, column in column_scores if score == 0 and column.type in DATE_TYPES]
+            keep = sorted(matched, key=lambda item: (-item[0], item[1]))[:max_columns]
+            keep += dates[:max(0, max_columns - len(keep))]
+        columns = [column for _, _, column in sorted(keep, key=lambda item: item[1])]
+        selected_columns[table.full_id] = columns
+
+        header = f"Table `{table.full_id}`"
+        lines.append(f"{header}: {table.description}" if table.description else header)
+        for column in columns:
+            detail = f"- {column.name} ({column.type})" if column.type else f"- {column.name}"
+            lines.append(f"{detail}: {column.description}" if column.description else detail)
+
+    return SchemaSelection(
+        table_references=[dict(table.reference) for _, table, _ in chosen],
+        columns=selected_columns,
+        text="\n".join(lines),
+    )
+
+
+class SchemaCache:
+    """Caches `bigquery_get_table_info` results per table, refreshing stale entries in the background."""
+
+    def __init__(
+        self,
+        table_references: Sequence[Dict[str, str]],
+        ttl_seconds: float = 3600.0,
+        retry_seconds: float = 60.0,
+        fetch_timeout: float = 10.0,
+    ):
+        self.table_references = [dict(ref) for ref in table_references]
+        self.ttl_seconds = ttl_seconds
+        self.fetch_timeout = fetch_timeout
+        # Minimum pause before fetching again after a failed fetch
+        self.retry_seconds = retry_seconds
+        self._entries: Dict[str, TableSchema] = {}
+        self._fetched_at: Dict[str, float] = {}
+        self._failed_at: Dict[str, float] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._counters = {"fetches": 0, "fetch_errors": 0, "schema_changes": 0, "unmodified": 0}
+
+    async def get_all(self) -> List[TableSchema]:
+        """
+        Returns the cached metadata of every configured table loaded so far, without waiting;
+        missing and stale tables are fetched in the background.
+        """
+        now = time.monotonic()
+        for ref in self.table_references:
+            key = self._key(ref)
+            if key not in self._entries:
+                if now - self._failed_at.get(key, -self.retry_seconds) >= self.retry_seconds:
+                    self._refresh_in_background(ref)
+            elif now - self._fetched_at[key] >= self.ttl_seconds:
+                self._refresh_in_background(ref)
+        return [self._entries[self._key(ref)] for ref in self.table_references if self._key(ref) in self._entries]
+
+    async def warm_up(self):
+        """Loads every table's metadata ahead of the first question."""
+        await self.get_all()
+        await asyncio.gather(*self._refreshing.values(), return_exceptions=True)
+        logger.info("Schema cache loaded %d of %d tables.", len(self._entries), len(self.table_references))
+
+    def invalidate(self):
+        """Marks every entry stale, e.g. after the tables were modified; they are still served until refreshed."""
+        self._fetched_at = {key: float("-inf") for key in self._fetched_at}
+
+    async def close(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        await asyncio.gather(*self._refreshing.values(), return_exceptions=True)
+        self._refreshing.clear()
+
+    def stats(self) -> Dict[str, int]:
+        snapshot = dict(self._counters)
+        snapshot["tables"] = len(self._entries)
+        snapshot["columns"] = sum(len(table.columns) for table in self._entries.values())
+        return snapshot
+
+    # --- Internals ---
+
+    @staticmethod
+    def _key(ref: Dict[str, str]) -> str:
+        return f"{ref['projectId']}.{ref['datasetId']}.{ref['tableId']}"
+
+    def _refresh_in_background(self, ref: Dict[str, str]):
+        key = self._key(ref)
+        if key in self._refreshing:
+            return
+        task = asyncio.get_running_loop().create_task(self._refresh(ref), name=f"schema-refresh-{key}")
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _refresh(self, ref: Dict[str, str]):
+        key = self._key(ref)
+        started = time.perf_counter()
+        try:
+            # One bound for loading the toolset and the call, so a hung toolbox cannot hold a refresh
+            table = await asyncio.wait_for(self._fetch(ref), timeout=self.fetch_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self._record_failure(key, f"no answer within {self.fetch_timeout:g}s")
+            return
+        except Exception as e:
+            self._record_failure(key, e)
+            return
+
+        self._counters["fetches"] += 1
+        self._fetched_at[key] = time.monotonic()
+        previous = self._entries.get(key)
+        if previous is not None and table.modified and table.modified == previous.modified:
+            # The table was not modified since the cached fetch, so neither was its schema
+            self._counters["unmodified"] += 1
+            logger.debug("Schema of %s is unmodified since %s.", key, table.modified)
+            return
+        if previous is not None and previous.fingerprint != table.fingerprint:
+            self._counters["schema_changes"] += 1
+            logger.info("Schema of %s changed (%d -> %d columns).", key, len(previous.columns), len(table.columns))
+        self._entries[key] = table
+        logger.info("Loaded the schema of %s (%d columns) in %.3fs.", key, len(table.columns), time.perf_counter() - started)
+
+    async def _fetch(self, ref: Dict[str, str]) -> TableSchema:
+        tool = await toolbox_pool.get_tool(TABLE_INFO_TOOL)
+        if tool is None:
+            raise LookupError(f"The toolset has no '{TABLE_INFO_TOOL}' tool.")
+        return parse_table_info(ref, await tool(dataset=ref["datasetId"], table=ref["tableId"]))
+
+    def _record_failure(self, key: str, error: Any):
+        self._counters["fetch_errors"] += 1
+        self._failed_at[key] = time.monotonic()
+        self._fetched_at[key] = time.monotonic() - self.ttl_seconds + self.retry_seconds # Keep a stale entry, retry later
+        logger.warning("Could not load the schema of %s: %s", key, error)
+
+
+schema_cache = SchemaCache(
+    table_references=config.TABLE_REFERENCES,
+    ttl_seconds=config.SCHEMA_CACHE_TTL_SECONDS,
+)
+
+
+async def schema_for_question(question: str, history: Sequence[Sequence[str]] = ()) -> SchemaSelection:
+    """Selects the tables and columns for `question`; a follow-up also matches the previous question."""
+    if not config.SCHEMA_HINTS_ENABLED:
+        return select_schema(question, [], config.TABLE_REFERENCES)
+    tables = await schema_cache.get_all()
+    previous = history[-1][0] if history else ""
+    return select_schema(
+        f"{question} {previous}",
+        tables,
+        config.TABLE_REFERENCES,
+        max_tables=config.SCHEMA_MAX_TABLES,
+        max_columns=config.SCHEMA_MAX_COLUMNS,
+    )
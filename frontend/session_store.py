@@ -0,0 +1,392 @@
+"""
+Session state shared by every Chainlit worker.
+
+Conversation history (keyed by the chat's thread ID) and answered results
+(keyed by interaction ID, which is all an action's payload carries) are kept
+in a session store instead of `cl.user_session`, so a chat that reconnects to
+another worker, e.g. after a restart or a rebalance, keeps its context and
+its actions keep working.
+
+Backends:
+- "memory": in this process only (a single worker); an LRU capped in bytes.
+- "sqlite": a local database file, shared by the workers on one host.
+- "redis": a Redis server, shared by workers on several hosts.
+
+Values are compact JSON, zlib-compressed above `COMPRESS_MIN_BYTES`, and
+every write sets a TTL, so state of abandoned chats expires on its own.
+A turn is appended to a history with the backend's atomic update, so two
+workers answering in the same chat at once do not overwrite each other's
+turn. A value that cannot be decoded counts as a miss.
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from logger import logger
+from executors import run_blocking
+import config
+
+# Values at least this large are stored zlib-compressed
+COMPRESS_MIN_BYTES = 1024
+
+
+def encode(value: Any) -> bytes:
+    """Serializes `value` to compact JSON, compressed if it is large."""
+    data = json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(data, 6)
+    return b"j" + data
+
+
+def decode(data: bytes) -> Any:
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+class SessionBackend:
+    """Key-value storage with a TTL per key."""
+    # Whether calls do I/O and should run off the event loop
+    blocking = True
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]], ttl_seconds: float) -> Optional[bytes]:
+        """
+        Atomically replaces the value of `key` with `func(current)` (None if unset or expired).
+        If `func` returns None the value is left as it is. Returns the value now stored.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, float]:
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(SessionBackend):
+    """In-process LRU with expiry, capped in bytes."""
+    blocking = False
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"expired": 0, "evictions": 0}
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._discard(key)
+                self._counters["expired"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        with self._lock:
+            self._store(key, value, ttl_seconds)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]], ttl_seconds: float) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry[0] if entry is not None and entry[1] > time.time() else None
+            value = func(current)
+            if value is None:
+                return current
+            self._store(key, value, ttl_seconds)
+            return value
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot["entries"] = len(self._entries)
+            snapshot["bytes"] = self._total_bytes
+        return snapshot
+
+    def _store(self, key: str, value: bytes, ttl_seconds: float):
+        self._discard(key)
+        self._entries[key] = (value, time.time() + ttl_seconds)
+        self._total_bytes += len(value)
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            self._discard(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= len(entry[0])
+
+
+class SQLiteBackend(SessionBackend):
+    """A local SQLite file (WAL mode), so the workers on one host share state."""
+
+    def __init__(self, db_path: str, prune_every: int = 500):
+        self.db_path = db_path
+        self.prune_every = prune_every
+        self._db = None
+        self._writes_since_prune = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM session_state WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO session_state (key, value, expires_at) VALUES (?, ?, ?)", (key, value, now + ttl_seconds))
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= self.prune_every:
+                db.execute("DELETE FROM session_state WHERE expires_at <= ?", (now,))
+                self._writes_since_prune = 0
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connect().execute("DELETE FROM session_state WHERE key = ?", (key,))
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]], ttl_seconds: float) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            # Takes the write lock up front, so other workers' updates of the key wait for this one
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT value FROM session_state WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                current = bytes(row[0]) if row else None
+                value = func(current)
+                if value is not None:
+                    db.execute("INSERT OR REPLACE INTO session_state (key, value, expires_at) VALUES (?, ?, ?)", (key, value, now + ttl_seconds))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return current if value is None else value
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            entries, size = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM session_state"
+            ).fetchone()
+        return {"entries": entries, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _connect(self):
+        # Opened on first use, so importing this module (e.g. in a CPU worker) touches no files
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS session_state (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._db
+
+
+class RedisBackend(SessionBackend):
+    """A Redis server, so workers on several hosts share state. Needs the `redis` package."""
+
+    def __init__(self, url: str, prefix: str = "copilot:"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._connect().get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        self._connect().set(self.prefix + key, value, px=max(1, int(ttl_seconds * 1000)))
+
+    def delete(self, key: str):
+        self._connect().delete(self.prefix + key)
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]], ttl_seconds: float) -> Optional[bytes]:
+        import redis # type: ignore
+
+        # Optimistic compare-and-set: retried if another worker wrote the key in between
+        with self._connect().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.prefix + key)
+                    current = pipe.get(self.prefix + key)
+                    value = func(current)
+                    if value is None:
+                        pipe.unwatch()
+                        return current
+                    pipe.multi()
+                    pipe.set(self.prefix + key, value, px=max(1, int(ttl_seconds * 1000)))
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+
+    def stats(self) -> Dict[str, float]:
+        memory = self._connect().info("memory")
+        return {"server_used_bytes": memory.get("used_memory", 0)}
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def _connect(self):
+        if self._client is None:
+            import redis # type: ignore
+
+            self._client = redis.Redis.from_url(self.url, socket_timeout=5.0, socket_connect_timeout=5.0)
+        return self._client
+
+
+def create_backend(kind: str) -> SessionBackend:
+    """Builds the backend named by SESSION_BACKEND."""
+    if kind == "sqlite":
+        return SQLiteBackend(config.SESSION_DB_PATH)
+    if kind == "redis":
+        return RedisBackend(config.SESSION_REDIS_URL)
+    if kind != "memory":
+        logger.warning("Unknown SESSION_BACKEND %r; keeping session state in memory.", kind)
+    return MemoryBackend(max_bytes=config.SESSION_MEMORY_MAX_BYTES)
+
+
+class SessionStore:
+    """Conversation history per thread and answered results per interaction, over a SessionBackend."""
+
+    def __init__(self, backend: SessionBackend, ttl_seconds: float = 24 * 3600, history_max_turns: int = 20):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        # Older turns are dropped by the context builder anyway
+        self.history_max_turns = max(1, history_max_turns)
+        self._counters = {"reads": 0, "writes": 0, "misses": 0, "errors": 0}
+
+    @property
+    def shared(self) -> bool:
+        """True if other workers see this store (anything but the memory backend)."""
+        return not isinstance(self.backend, MemoryBackend)
+
+    # --- Public API ---
+
+    async def load_history(self, thread_id: str) -> List[Tuple[str, str, str]]:
+        """The chat's (question, answer, sql) turns, oldest first; empty if unknown or expired."""
+        turns = await self._get(f"history:{thread_id}")
+        return [tuple(turn) for turn in turns] if turns else []
+
+    async def append_turn(self, thread_id: str, turn: Sequence[str]):
+        """Appends a (question, answer, sql) turn to the chat's history, keeping the newest turns."""
+        key = f"history:{thread_id}"
+
+        def append(current: Optional[bytes]) -> bytes:
+            turns = []
+            if current is not None:
+                try:
+                    turns = decode(current)
+                    if not isinstance(turns, list):
+                        raise ValueError(f"expected a list, got {type(turns).__name__}")
+                except Exception as e: # Start the history afresh rather than fail every later turn
+                    turns = []
+                    self._counters["errors"] += 1
+                    logger.warning("Dropping an unreadable %s from the session store: %s", key, e)
+            turns.append(list(turn))
+            return encode(turns[-self.history_max_turns:])
+
+        self._counters["writes"] += 1
+        try:
+            await self._call(self.backend.update, key, append, self.ttl_seconds)
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning("Failed to write %s to the session store: %s", key, e)
+
+    async def load_result(self, interaction_id: str) -> Optional[dict]:
+        return await self._get(f"result:{interaction_id}")
+
+    async def save_result(self, interaction_id: str, record: dict):
+        await self._set(f"result:{interaction_id}", record)
+
+    async def acquire_lease(self, name: str, owner: str, ttl_seconds: float) -> bool:
+        """
+        Takes or renews the lease `name` for `owner` unless another owner holds it.
+        Leases are only exclusive across workers sharing the store (see `shared`).
+        """
+        held_by = encode(owner)
+
+        def take(current: Optional[bytes]) -> Optional[bytes]:
+            return held_by if current is None or current == held_by else None
+
+        try:
+            return await self._call(self.backend.update, f"lease:{name}", take, ttl_seconds) == held_by
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning("Failed to take the %s lease: %s", name, e)
+            return False
+
+    def stats(self) -> Dict[str, float]:
+        snapshot: Dict[str, float] = dict(self._counters)
+        if not self.backend.blocking: # Backend stats of the others would need I/O from the scrape
+            snapshot.update(self.backend.stats())
+        return snapshot
+
+    def close(self):
+        self.backend.close()
+
+    # --- Internals ---
+
+    async def _get(self, key: str) -> Any:
+        self._counters["reads"] += 1
+        try:
+            data = await self._call(self.backend.get, key)
+            if data is None:
+                self._counters["misses"] += 1
+                return None
+            return decode(data)
+        except Exception as e:
+            # State is lost for this request (a corrupt value reads as a miss), but the chat keeps working
+            self._counters["errors"] += 1
+            logger.warning("Failed to read %s from the session store: %s", key, e)
+            return None
+
+    async def _set(self, key: str, value: Any):
+        self._counters["writes"] += 1
+        try:
+            await self._call(self.backend.set, key, encode(value), self.ttl_seconds)
+        except Exception as e:
+            self._counters["errors"] += 1
+            logger.warning("Failed to write %s to the session store: %s", key, e)
+
+    async def _call(self, func, *args):
+        if self.backend.blocking:
+            return await run_blocking(func, *args)
+        return func(*args)
+
+
+session_store = SessionStore(
+    backend=create_backend(config.SESSION_BACKEND),
+    ttl_seconds=config.SESSION_TTL_SECONDS,
+    history_max_turns=config.SESSION_HISTORY_MAX_TURNS,
+)
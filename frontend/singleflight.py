@@ -0,0 +1,135 @@
+"""
+Coalescing of identical in-flight toolbox calls.
+
+When several sessions ask the same question (same normalized prompt and
+table references) at the same time, only the first one (the leader) calls
+`ask_data_insights`; the others wait on the leader's call and receive the same
+response string. The call runs in its own task and every caller awaits it
+through `asyncio.shield`, so a caller that is cancelled (e.g. its user closed
+the tab) never cancels the call the others are waiting on.
+
+The task starts in an empty context, so nothing in the call can reach the
+leader's Chainlit session. What the call wants to show (queue positions,
+streamed tokens) it publishes as events. Every caller replays them into its
+own message from its own task, starting with the events published before it
+joined.
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from logger import logger
+import config
+
+T = TypeVar("T")
+
+Publish = Callable[[Any], None]
+
+
+class _Flight:
+    """One shared call and the events it has published so far."""
+
+    def __init__(self, call: Callable[[Publish], Awaitable[Any]]):
+        self.events: List[Any] = []
+        self._changed = asyncio.Event()
+        # An empty context, so the call cannot see the caller's session (or touch its messages)
+        self.task = contextvars.Context().run(asyncio.ensure_future, call(self.publish))
+        self.task.add_done_callback(lambda _: self._notify())
+
+    def publish(self, event: Any):
+        self.events.append(event)
+        self._notify()
+
+    async def follow(self, on_event: Callable[[Any], Awaitable[None]]):
+        """Awaits `on_event` for every published event, in order, until the call is done."""
+        seen = 0
+        while True:
+            changed = self._changed
+            while seen < len(self.events):
+                seen += 1
+                await on_event(self.events[seen - 1])
+            if self.task.done():
+                return
+            await changed.wait()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+def make_flight_key(prompt: str, table_references: Any) -> str:
+    """Key under which identical tool calls are coalesced."""
+    normalized = re.sub(r"\s+", " ", prompt or "").strip().lower()
+    return hashlib.sha256(json.dumps([normalized, table_references], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result with concurrent callers."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._calls: Dict[str, _Flight] = {}
+        self._counters = {"leaders": 0, "followers": 0}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(
+        self,
+        key: str,
+        call: Callable[[Publish], Awaitable[T]],
+        on_join: Optional[Callable[[], Awaitable[None]]] = None,
+        on_event: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Tuple[T, bool]:
+        """
+        Returns `(result, shared)`. Starts `call(publish)` unless a call for `key` is in
+        flight, in which case `on_join()` is awaited and that call's result is shared.
+        Every event the call publishes is passed to `on_event`.
+        """
+        if not self.enabled:
+            flight = _Flight(call)
+            try:
+                return await self._wait(flight, on_event), False
+            except BaseException:
+                flight.task.cancel() # Nobody else is waiting on it
+                raise
+
+        flight = self._calls.get(key)
+        shared = flight is not None
+        if shared:
+            self._counters["followers"] += 1
+            logger.info("Joining an in-flight call for an identical question.", extra={"flight_key": key[:12]})
+            if on_join is not None:
+                await on_join()
+        else:
+            self._counters["leaders"] += 1
+            flight = _Flight(call)
+            self._calls[key] = flight
+            flight.task.add_done_callback(lambda done: self._forget(key, done))
+
+        return await self._wait(flight, on_event), shared
+
+    def stats(self) -> Dict[str, int]:
+        snapshot = dict(self._counters)
+        snapshot["in_flight"] = len(self._calls)
+        return snapshot
+
+    @staticmethod
+    async def _wait(flight: _Flight, on_event: Optional[Callable[[Any], Awaitable[None]]]) -> Any:
+        if on_event is not None:
+            await flight.follow(on_event)
+        return await asyncio.shield(flight.task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        flight = self._calls.get(key)
+        if flight is not None and flight.task is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Retrieve the exception so an unawaited failure is not reported as "never retrieved"
+            logger.debug("Coalesced call failed: %s", task.exception())
+
+
+singleflight = SingleFlight(enabled=config.COALESCE_REQUESTS)
@@ -0,0 +1,374 @@
+"""
+Streaming responses from the toolbox into a Chainlit message.
+
+The toolbox invoke endpoint answers with a `{"result": "..."}` envelope whose
+string holds several JSON objects (`{"SQL Generated": ...}`, `{"Answer": ...}`).
+The decoders below unwrap that envelope and pick the SQL and answer values
+out of it incrementally, so text can be passed on as soon as it arrives
+instead of after the whole round trip; `app.main` publishes it to every
+asker of the question, who streams it into their own message with
+`cl.Message.stream_token`.
+
+That endpoint is the server's native HTTP API, not the MCP transport the
+ToolboxClient uses, so the request is sent directly, over the pool's aiohttp
+session and with the pool's headers. The buffered tool call in `app.main`
+remains the fallback: once the endpoint fails before anything was shown
+(e.g. a server without it), `streaming_gate` keeps calls on the buffered
+path for `retry_seconds` instead of paying for a failed request every time.
+"""
+import codecs
+import json
+import re
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from logger import logger
+from response_parser import REASONING_MARKER, FOLLOW_UPS_MARKER
+from resilience import ClaimLost
+from toolbox_pool import toolbox_pool
+from tracing import tracer
+import config
+
+_RESULT_PREFIX = re.compile(r'"result"\s*:\s*')
+_STRING_SPECIAL = re.compile(r'[\\"]')
+_FIELD_PREFIX = re.compile(r'\{\s*"(SQL Generated|Answer)"\s*:\s*"')
+
+# Stream events: which field the text belongs to.
+SQL = "sql"
+ANSWER = "answer"
+
+# Answer sections, split the same way `app.main` renders them.
+TABLE = "table"
+REASONING = "reasoning"
+FOLLOW_UPS = "follow_ups"
+
+
+class StreamingUnavailable(Exception):
+    """Raised when the streaming endpoint cannot be used and nothing was streamed yet."""
+
+
+class StreamingGate:
+    """Switches streaming off for a while after the endpoint fails outright."""
+
+    def __init__(self, enabled: bool = False, retry_seconds: float = 300.0):
+        self.enabled = enabled
+        self.retry_seconds = retry_seconds
+        self._closed_until = 0.0
+        self._counters = {"fallbacks": 0}
+
+    def is_open(self) -> bool:
+        return self.enabled and time.monotonic() >= self._closed_until
+
+    def record_unavailable(self, error: Exception):
+        if time.monotonic() >= self._closed_until:
+            logger.warning("Streaming is unavailable; using the buffered call for %.0fs: %s", self.retry_seconds, error)
+        self._counters["fallbacks"] += 1
+        self._closed_until = time.monotonic() + self.retry_seconds
+
+    def stats(self) -> Dict[str, float]:
+        snapshot = dict(self._counters)
+        snapshot["open"] = int(self.is_open())
+        return snapshot
+
+
+class JsonStringDecoder:
+    """Incrementally decodes the body of a JSON string literal (after its opening quote)."""
+
+    def __init__(self):
+        self._pending = ""
+        self.done = False
+        self.rest = ""  # Text that followed the closing quote
+
+    def feed(self, chunk: str) -> str:
+        """Returns the newly decoded text. Sets `done` once the closing quote is seen."""
+        if self.done:
+            self.rest += chunk
+            return ""
+
+        buffer = self._pending + chunk
+        pos = 0
+        cut = 0
+        end = None
+        while True:
+            match = _STRING_SPECIAL.search(buffer, pos)
+            if match is None:
+                cut = len(buffer)
+                break
+            i = match.start()
+            if buffer[i] == '"':
+                cut = end = i
+                break
+            # Backslash escape: only cut after the whole sequence has arrived.
+            if i + 1 >= len(buffer):
+                cut = i
+                break
+            if buffer[i + 1] == "u":
+                length = 6
+                if i + 6 <= len(buffer) and 0xD800 <= int(buffer[i + 2:i + 6], 16) < 0xDC00:
+                    length = 12 # A high surrogate must be decoded with its pair
+                if i + length > len(buffer):
+                    cut = i
+                    break
+                pos = i + length
+            else:
+                pos = i + 2
+
+        raw = buffer[:cut]
+        if end is not None:
+            self.done = True
+            self.rest = buffer[end + 1:]
+            self._pending = ""
+        else:
+            self._pending = buffer[cut:]
+        return json.loads(f'"{raw}"', strict=False) if raw else ""
+
+
+class EnvelopeDecoder:
+    """Unwraps the `result` string of the toolbox `{"result": ...}` response envelope."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._string: Optional[JsonStringDecoder] = None
+
+    def feed(self, chunk: str) -> str:
+        """Returns the newly decoded part of the result string."""
+        if self._string is not None:
+            return self._string.feed(chunk)
+
+        self._buffer += chunk
+        match = _RESULT_PREFIX.search(self._buffer)
+        if match is None or match.end() >= len(self._buffer):
+            return ""
+        if self._buffer[match.end()] != '"':
+            raise StreamingUnavailable("Toolbox result is not a string.")
+
+        self._string = JsonStringDecoder()
+        remainder = self._buffer[match.end() + 1:]
+        self._buffer = ""
+        return self._string.feed(remainder)
+
+
+class ResponseStreamParser:
+    """Picks SQL and answer text out of the multi-JSON result string as it streams in."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._field: Optional[str] = None
+        self._value: Optional[JsonStringDecoder] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._skipping = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """Returns `(field, text)` events for the SQL and answer values in `text`."""
+        events = []
+        while text:
+            if self._value is not None:
+                decoded = self._value.feed(text)
+                if decoded:
+                    events.append((self._field, decoded))
+                if not self._value.done:
+                    return events
+                # Skip whatever else the object holds up to its closing brace.
+                text, self._value = self._value.rest, None
+                self._skipping, self._depth = True, 1
+                continue
+
+            if self._skipping:
+                text = self._skip_object(text)
+                continue
+
+            self._buffer += text
+            text = ""
+            start = self._buffer.find("{")
+            if start < 0:
+                self._buffer = ""
+                break
+            self._buffer = self._buffer[start:]
+            match = _FIELD_PREFIX.match(self._buffer)
+            if match:
+                self._field = SQL if match.group(1) == "SQL Generated" else ANSWER
+                self._value = JsonStringDecoder()
+                text, self._buffer = self._buffer[match.end():], ""
+            elif _could_be_field_prefix(self._buffer):
+                break # Wait for more text before deciding
+            else:
+                # Some other object; skip it as a whole.
+                text, self._buffer = self._buffer[1:], ""
+                self._skipping, self._depth = True, 1
+        return events
+
+    def _skip_object(self, text: str) -> str:
+        """Consumes `text` until the current object closes and returns what follows."""
+        for i, char in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._skipping = False
+                    return text[i + 1:]
+        return ""
+
+
+def _could_be_field_prefix(buffer: str) -> bool:
+    """True while `buffer` is still too short to rule out a SQL/Answer object prefix."""
+    compact = re.sub(r"\s+", "", buffer)
+    return any(candidate.startswith(compact) for candidate in ('{"SQLGenerated":"', '{"Answer":"'))
+
+
+class AnswerSectionSplitter:
+    """Splits streamed answer text into table, reasoning and follow-up sections."""
+
+    def __init__(self):
+        self.section = TABLE
+        self._held = ""
+
+    def feed(self, text: str, final: bool = False) -> List[Tuple[str, str]]:
+        """Returns `(section, text)` pieces; holds back text that may start a marker."""
+        pieces = []
+        buffer = self._held + text
+        self._held = ""
+        while buffer:
+            marker = {TABLE: REASONING_MARKER, REASONING: FOLLOW_UPS_MARKER}.get(self.section)
+            if marker is None:
+                pieces.append((self.section, buffer))
+                break
+
+            index = buffer.find(marker)
+            if index >= 0:
+                if index:
+                    pieces.append((self.section, buffer[:index]))
+                if self.section == TABLE:
+                    self.section = REASONING
+                    pieces.append((REASONING, "Reasoning:\n"))
+                else:
+                    self.section = FOLLOW_UPS
+                buffer = buffer[index + len(marker):]
+                continue
+
+            keep = 0 if final else _partial_marker_length(buffer, marker)
+            if len(buffer) > keep:
+                pieces.append((self.section, buffer[:len(buffer) - keep]))
+            self._held = buffer[len(buffer) - keep:]
+            break
+        return pieces
+
+
+def _partial_marker_length(buffer: str, marker: str) -> int:
+    """Length of the longest suffix of `buffer` that is a prefix of `marker`."""
+    for length in range(min(len(marker) - 1, len(buffer)), 0, -1):
+        if marker.startswith(buffer[-length:]):
+            return length
+    return 0
+
+
+async def stream_tool_call(tool_name: str, params: dict) -> AsyncIterator[str]:
+    """Invokes a toolbox tool over HTTP and yields the decoded result text as it arrives."""
+    session = await toolbox_pool.get_session()
+    url = f"{toolbox_pool.url.rstrip('/')}/api/tool/{tool_name}/invoke"
+    async with session.post(url, json=params, headers=toolbox_pool.headers or None) as resp:
+        if resp.status >= 400:
+            body = await resp.text()
+            raise StreamingUnavailable(f"Toolbox returned HTTP {resp.status}: {body[:500]}")
+
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        envelope = EnvelopeDecoder()
+        async for raw_chunk in resp.content.iter_any():
+            text = envelope.feed(utf8.decode(raw_chunk))
+            if text:
+                yield text
+        text = envelope.feed(utf8.decode(b"", final=True))
+        if text:
+            yield text
+
+
+async def stream_answer(
+    on_token: Callable[[str], None],
+    tool_name: str,
+    params: dict,
+    claim: Optional[Callable[[], bool]] = None,
+    max_table_chars: Optional[int] = None,
+) -> str:
+    """
+    Passes the SQL and the answer's table and reasoning to `on_token` as they
+    arrive and returns the full result string for the regular parsing path.
+    Raises StreamingUnavailable if the stream fails before anything was shown.
+    With `claim` (a hedged attempt), nothing is shown unless claim() returns
+    True before the first token; otherwise ClaimLost is raised. Table
+    text beyond `max_table_chars` is not streamed; the final message pages it.
+    """
+    parser = ResponseStreamParser()
+    splitter = AnswerSectionSplitter()
+    result_parts = []
+    streamed_any = False
+    sql_open = False
+    table_chars = 0
+    started = time.perf_counter()
+
+    async def forward_section(section: str, piece: str):
+        nonlocal table_chars
+        if section == FOLLOW_UPS: # Follow-ups go into their own action
+            return
+        if section == TABLE and max_table_chars is not None:
+            if table_chars >= max_table_chars:
+                return
+            table_chars += len(piece)
+            if table_chars >= max_table_chars:
+                await forward(piece + "\n\n_More rows are on their way..._\n\n")
+                return
+        await forward(piece)
+
+    async def forward(token: str):
+        nonlocal streamed_any
+        if not token:
+            return
+        if not streamed_any:
+            if claim is not None and not claim():
+                raise ClaimLost() # Another hedged attempt is already showing its answer
+            streamed_any = True
+            tracer.record("first_token", time.perf_counter() - started)
+        on_token(token)
+
+    try:
+        async for text in stream_tool_call(tool_name, params):
+            result_parts.append(text)
+            for field, value in parser.feed(text):
+                if field == SQL:
+                    if not sql_open:
+                        await forward("```sql\n")
+                        sql_open = True
+                    await forward(value)
+                    continue
+                if sql_open:
+                    await forward("\n```\n\n")
+                    sql_open = False
+                for section, piece in splitter.feed(value):
+                    await forward_section(section, piece)
+    except (StreamingUnavailable, ClaimLost):
+        raise
+    except Exception as e:
+        if not streamed_any:
+            raise StreamingUnavailable(str(e)) from e
+        raise
+
+    if sql_open:
+        await forward("\n```\n\n")
+    for section, piece in splitter.feed("", final=True):
+        await forward_section(section, piece)
+
+    logger.info("Streamed toolbox response (%d chunks).", len(result_parts))
+    return "".join(result_parts)
+
+
+streaming_gate = StreamingGate(enabled=config.STREAMING_ENABLED, retry_seconds=config.STREAMING_RETRY_SECONDS)
@@ -0,0 +1,113 @@
+"""
+Process-wide ToolboxClient and toolset cache.
+
+Every chat session shares one ToolboxClient backed by a single pooled
+aiohttp session, and the loaded toolset is cached for a configurable TTL so
+a question does not pay an extra round trip to the toolbox server.
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from logger import logger
+import config
+
+
+class ToolboxPool:
+    """Owns the shared ToolboxClient and caches the loaded toolset."""
+
+    def __init__(
+        self,
+        url: str,
+        toolset_name: str,
+        ttl_seconds: float = 300.0,
+        max_connections: int = 100,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.url = url
+        self.toolset_name = toolset_name
+        self.ttl_seconds = ttl_seconds
+        self.max_connections = max_connections
+        # Sent with every request, by the client and by the streaming path alike
+        self.headers = dict(headers or {})
+        self._session = None
+        self._client = None
+        self._toolset: Optional[List[Any]] = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get_client(self):
+        """Returns the shared ToolboxClient, creating it on first use."""
+        if self._client is None:
+            import aiohttp
+            from toolbox_core import ToolboxClient # type: ignore
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            )
+            self._client = ToolboxClient(self.url, session=self._session, client_headers=self.headers or None)
+        return self._client
+
+    async def get_session(self):
+        """Returns the pooled aiohttp session shared with the ToolboxClient."""
+        await self.get_client()
+        return self._session
+
+    def _is_fresh(self) -> bool:
+        return bool(self._toolset) and (time.monotonic() - self._loaded_at) < self.ttl_seconds
+
+    async def get_toolset(self) -> List[Any]:
+        """Returns the cached toolset, reloading it once the TTL has expired."""
+        if self._is_fresh():
+            return self._toolset
+
+        async with self._lock:
+            if self._is_fresh(): # Another session reloaded it while we waited
+                return self._toolset
+
+            client = await self.get_client()
+            started = time.perf_counter()
+            toolset = await client.load_toolset(self.toolset_name)
+            logger.info("Loaded toolset '%s' (%d tools) in %.3fs.", self.toolset_name, len(toolset or []), time.perf_counter() - started)
+
+            self._toolset = toolset
+            self._loaded_at = time.monotonic()
+            return toolset
+
+    async def get_tool(self, tool_name: str):
+        """Returns a tool from the cached toolset by name, or None if it is absent."""
+        for tool in await self.get_toolset():
+            if getattr(tool, "__name__", None) == tool_name:
+                return tool
+        return None
+
+    def invalidate(self):
+        """Drops the cached toolset so the next request reloads it."""
+        self._toolset = None
+        self._loaded_at = 0.0
+
+    async def warm_up(self):
+        """Opens the connection pool and loads the toolset ahead of the first question."""
+        try:
+            await self.get_toolset()
+        except Exception as e:
+            logger.warning("Toolbox warm-up failed; the toolset will load on first use: %s", e)
+
+    async def close(self):
+        """Closes the shared client and its connection pool."""
+        if self._client is not None:
+            await self._client.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._client = None
+        self._session = None
+        self.invalidate()
+
+
+toolbox_pool = ToolboxPool(
+    url=config.TOOLBOX_URL,
+    toolset_name=config.TOOLSET_NAME,
+    ttl_seconds=config.TOOLSET_CACHE_TTL_SECONDS,
+    max_connections=config.TOOLBOX_MAX_CONNECTIONS,
+    headers=config.TOOLBOX_HEADERS,
+)
@@ -0,0 +1,297 @@
+"""
+Per-stage latency tracing and a Prometheus-style metrics endpoint.
+
+Each stage of answering a question (loading the toolset, the toolbox call,
+parsing, message updates, logging) runs inside `tracer.span(...)`. A span
+records its duration into a latency histogram, adds it to the current
+interaction's timings and, when an OTLP endpoint is configured and
+OpenTelemetry is installed, is exported as an OpenTelemetry span as well.
+
+The interaction ID is carried in a context variable, so spans opened in
+helpers (streaming, logging) are tagged without passing it around. It is kept
+out of the Prometheus labels to bound their cardinality; it is on the
+structured log lines and the OpenTelemetry spans instead.
+"""
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from logger import logger
+import config
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0)
+
+STAGE_METRIC = "copilot_stage_duration_seconds"
+INTERACTION_METRIC = "copilot_interaction_duration_seconds"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class _Histogram:
+    """Bucket counts, sum and count for one label set."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Histograms and counters rendered in the Prometheus text format."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Tuple[str, Callable[[], Dict[str, float]]]] = []
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def register_collector(self, prefix: str, collect: Callable[[], Dict[str, float]]):
+        """Exposes every numeric value returned by `collect()` as a gauge named `<prefix>_<key>`."""
+        self._collectors.append((prefix, collect))
+
+    def percentile(self, name: str, pct: float, **labels) -> Optional[float]:
+        """Upper bound of the bucket holding the `pct` percentile, or None without samples."""
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+            if histogram is None or not histogram.count:
+                return None
+            target = histogram.count * pct / 100.0
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                if seen >= target:
+                    return bound
+        return float("inf")
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                self._render_header(lines, name, "histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for name, series in sorted(self._counters.items()):
+                self._render_header(lines, name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+        for prefix, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", prefix, e)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def _render_header(self, lines: List[str], name: str, metric_type: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+
+@dataclass
+class InteractionTrace:
+    """Stage timings collected while answering one question."""
+    interaction_id: str
+    started: float = field(default_factory=time.perf_counter)
+    stages: Dict[str, float] = field(default_factory=dict)
+    attributes: Dict[str, object] = field(default_factory=dict)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+_current_trace: contextvars.ContextVar[Optional[InteractionTrace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Tracer:
+    """Times named stages, feeds the metrics registry and optionally exports OpenTelemetry spans."""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._otel_tracer = None
+
+    def configure_otlp(self, endpoint: str, service_name: str = "nostradamus-copilot"):
+        """Exports spans to an OTLP/HTTP collector. Does nothing if OpenTelemetry is not installed."""
+        try:
+            from opentelemetry import trace
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            logger.warning("OTLP_ENDPOINT is set but the OpenTelemetry SDK/exporter is not installed; spans are not exported.")
+            return
+
+        provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        trace.set_tracer_provider(provider)
+        self._otel_tracer = trace.get_tracer("nostradamus-copilot")
+        logger.info("Exporting trace spans to %s.", endpoint)
+
+    @staticmethod
+    def current() -> Optional[InteractionTrace]:
+        return _current_trace.get()
+
+    @contextlib.contextmanager
+    def interaction(self, interaction_id: str, **attributes) -> Iterator[InteractionTrace]:
+        """Groups the spans opened inside under `interaction_id` and logs their timings at the end."""
+        trace = InteractionTrace(interaction_id=interaction_id, attributes=dict(attributes))
+        token = _current_trace.set(trace)
+        outcome = "success"
+        try:
+            with self._otel_span("interaction", trace.attributes):
+                yield trace
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            _current_trace.reset(token)
+            total = time.perf_counter() - trace.started
+            outcome = trace.attributes.get("outcome", outcome)
+            self.registry.observe(INTERACTION_METRIC, total, outcome=outcome)
+            logger.info(
+                "Interaction finished in %.3fs (%s).", total, outcome,
+                extra={
+                    "interaction_id": trace.interaction_id,
+                    "total_ms": round(total * 1000, 1),
+                    "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in trace.stages.items()},
+                    **{key: value for key, value in trace.attributes.items() if key != "outcome"},
+                },
+            )
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **attributes) -> Iterator[None]:
+        """Times the enclosed block as `stage` of the current interaction."""
+        trace = _current_trace.get()
+        if trace is not None:
+            attributes.setdefault("interaction_id", trace.interaction_id)
+        status = "ok"
+        started = time.perf_counter()
+        try:
+            with self._otel_span(stage, attributes):
+                yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.registry.observe(STAGE_METRIC, elapsed, stage=stage, status=status)
+            if trace is not None:
+                trace.add(stage, elapsed)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Stage %s took %.3fs.", stage, elapsed, extra={"stage": stage, "duration_ms": round(elapsed * 1000, 1), "status": status, **attributes})
+
+    def record(self, stage: str, seconds: float, status: str = "ok"):
+        """Records a stage timed elsewhere (e.g. time to first streamed token)."""
+        self.registry.observe(STAGE_METRIC, seconds, stage=stage, status=status)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, seconds)
+
+    def _otel_span(self, name: str, attributes: dict):
+        if self._otel_tracer is None:
+            return contextlib.nullcontext()
+        return self._otel_tracer.start_as_current_span(
+            name, attributes={key: str(value) for key, value in attributes.items() if value is not None}
+        )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are too frequent to log
+
+
+def start_metrics_server(registry: MetricsRegistry, port: int, host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    """
+    Serves `registry` at http://host:port/metrics from a daemon thread.
+    Returns None (with a warning) if the port cannot be bound, e.g. because
+    another worker on this host already serves it.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logger.warning("Could not serve metrics on %s:%d; continuing without the endpoint: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics.", host, server.server_address[1])
+    return server
+
+
+metrics = MetricsRegistry()
+metrics.describe(STAGE_METRIC, "Time spent in each stage of answering a question.")
+metrics.describe(INTERACTION_METRIC, "End-to-end time to answer a question, by outcome.")
+
+tracer = Tracer(metrics)
+if config.OTLP_ENDPOINT:
+    tracer.configure_otlp(config.OTLP_ENDPOINT)
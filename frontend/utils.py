@@ -1,130 +1,88 @@
 import os
 import json
 import re
-import io
-import pandas as pd
-import pandas_gbq
-import chainlit as cl
+import functools
 from datetime import datetime # type: ignore
-from google.cloud import bigquery # NEW IMPORT
+from typing import TYPE_CHECKING
 from logger import logger
+from log_writer import log_writer
+from feedback import record_feedback
+from response_parser import ToolResponse, parse_tool_response
+from tracing import tracer
 import config
 
+# pandas, pandas_gbq and chainlit are imported where they are used, so importing
+# this module (in the app or a CPU worker process) stays cheap.
+if TYPE_CHECKING:
+    import pandas as pd
 
+
+@functools.lru_cache(maxsize=None)
 def load_system_prompt(file_path: str) -> str:
-    """Loads the system prompt from a text file."""
+    """Loads the system prompt from a text file (read once per path)."""
     try:
         with open(file_path, "r") as f:
             return f.read()
     except FileNotFoundError:
-        logger.error(f"System prompt file not found at: {file_path}")
+        logger.error("System prompt file not found at: %s", file_path)
         return "" # Return empty string if file not found
 
 
-def parse_tool_response(response_text: str) -> dict:
-    """Extracts SQL and Answer blocks from a multi-JSON string."""
-    if not response_text:
-        return {"SQL Generated": "", "Answer": ""}
-
-    try:
-        actual_content_string = json.loads(response_text)
-    except (json.JSONDecodeError, TypeError):
-        actual_content_string = response_text
-
-    json_blocks = re.findall(r'\{.*?\}', str(actual_content_string), flags=re.S)
-    parsed_objects = []
-    for block in json_blocks:
-        try:
-            parsed_objects.append(json.loads(block))
-        except json.JSONDecodeError:
-            pass
-
-    result = {"SQL Generated": "", "Answer": ""}
-    for item in parsed_objects:
-        if "SQL Generated" in item:
-            result["SQL Generated"] = item["SQL Generated"]
-        elif "Answer" in item:
-            result["Answer"] = item["Answer"]
+def to_bq(df: "pd.DataFrame", project_id: str, dataset_id: str, table_id: str, if_exists: str = 'append'):
+    """Writes a DataFrame to a BigQuery table. Blocking: call it through executors.run_blocking from async code."""
+    import pandas_gbq
 
-    return result
-
-
-def to_bq(df: pd.DataFrame, project_id: str, dataset_id: str, table_id: str, if_exists: str = 'append'):
-    """Writes a DataFrame to a BigQuery table."""
     table_full_id = f"{project_id}.{dataset_id}.{table_id}"
     try:
         pandas_gbq.to_gbq(df, destination_table=table_full_id, project_id=project_id, if_exists=if_exists)
-        logger.info(f"Data written to {table_full_id} successfully with shape {df.shape}.")
+        logger.info("Data written to %s successfully with shape %s.", table_full_id, df.shape)
     except Exception as e:
-        logger.error(f"Failed to write to BigQuery table {table_full_id}: {e}")
+        logger.error("Failed to write to BigQuery table %s: %s", table_full_id, e)
         raise
 
 
 
 def log_to_bq(user_query: str, answer: str, status: str = "success", user_feedback: str = None, error_message: str = None, interaction_id: str = None):
     """
-    Constructs a log entry and writes it to BigQuery.
-    If user_feedback is provided and interaction_id is present, it attempts to update an existing row.
-    Otherwise, it inserts a new row.
+    Constructs a log entry and hands it to the background BigQuery writer.
+    If user_feedback is provided and interaction_id is present, it queues a feedback event
+    for that interaction. Otherwise, the row is queued and appended to the dump table.
     """
-    try:
-        user = cl.user_session.get("user")
-        user_id = user.identifier if user else "anonymous"
-        table_full_id = f"{config.PROJECT_ID}.{config.DATASET_ID_DUMP}.{config.TABLE_ID_DUMP}"
-        bq_client = bigquery.Client(project=config.PROJECT_ID)
-
-        df = pd.DataFrame([{
-            "user": user_id,
-            "time": datetime.utcnow(),
-            "user_query": user_query,
-            "model_answer": answer,
-            "status": status,
-            "error_message": error_message,
-            "user_feedback": user_feedback,
-        }])
-
-        if user_feedback is not None and interaction_id is not None:
-            # Attempt to update an existing row for feedback
-            update_query = f"""
-            UPDATE `{table_full_id}`
-            SET user_feedback = @user_feedback
-            WHERE interaction_id = @interaction_id
-            """
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("user_feedback", "STRING", user_feedback),
-                    bigquery.ScalarQueryParameter("interaction_id", "STRING", interaction_id),
-                ]
-            )
-            query_job = bq_client.query(update_query, job_config=job_config)
-            query_job.result() # Wait for the job to complete
-            logger.info(f"Feedback updated for interaction_id {interaction_id} in {table_full_id}.")
-        else:
-            # Insert a new row for initial log or error
+    import chainlit as cl
+
+    with tracer.span("log_to_bq"):
+        try:
             user = cl.user_session.get("user")
             user_id = user.identifier if user else "anonymous"
-            
-            data = {
-                "user": user_id,
-                "time": datetime.utcnow(),
-                "user_query": user_query,
-                "model_answer": answer,
-                "status": status,
-                "error_message": error_message,
-                "user_feedback": user_feedback, # This will be None for initial logs
-            }
-            if interaction_id: # Add interaction_id to the data if provided
-                data["interaction_id"] = interaction_id
-
-            df = pd.DataFrame([data])
-
-            to_bq(df, project_id=config.PROJECT_ID, dataset_id=config.DATASET_ID_DUMP, table_id=config.TABLE_ID_DUMP)
-    except Exception as e:
-        logger.error(f"Failed to log to BigQuery: {e}")
-
-
-def markdown_table_to_df(markdown_text: str) -> pd.DataFrame:
+            table_full_id = f"{config.PROJECT_ID}.{config.DATASET_ID_DUMP}.{config.TABLE_ID_DUMP}"
+
+            if user_feedback is not None and interaction_id is not None:
+                # Record feedback as an append-only event; the merged view joins it back
+                record_feedback(interaction_id=interaction_id, user_feedback=user_feedback, user_id=user_id)
+                logger.info("Feedback event queued.", extra={"interaction_id": interaction_id})
+            else:
+                # Queue a new row for initial log or error
+                data = {
+                    "user": user_id,
+                    "time": datetime.utcnow().isoformat(),
+                    "user_query": user_query,
+                    "model_answer": answer,
+                    "status": status,
+                    "error_message": error_message,
+                    "user_feedback": user_feedback, # This will be None for initial logs
+                }
+                if interaction_id: # Add interaction_id to the data if provided
+                    data["interaction_id"] = interaction_id
+
+                log_writer.enqueue(table_full_id, data)
+        except Exception as e:
+            logger.error("Failed to log to BigQuery: %s", e)
+
+
+def markdown_table_to_df(markdown_text: str) -> "pd.DataFrame":
     """Converts a Markdown table string to a pandas DataFrame."""
+    import pandas as pd
+
     lines = [line.strip() for line in markdown_text.splitlines() if line.strip() and line.startswith("|")]
     if len(lines) < 2: # Header and separator are minimum
         raise ValueError("Markdown text does not contain a valid table.")
@@ -138,4 +96,25 @@ def markdown_table_to_df(markdown_text: str) -> pd.DataFrame:
             data_rows.append(cells)
 
     df = pd.DataFrame(data_rows, columns=headers)
-    return df
\ No newline at end of file
+    return df
+
+
+def dataframe_to_csv_bytes(df: "pd.DataFrame") -> bytes:
+    """Renders a DataFrame as UTF-8 CSV without the index."""
+    return df.to_csv(index=False).encode("utf-8")
+
+
+def convert_numeric_columns(df: "pd.DataFrame") -> "pd.DataFrame":
+    """Converts every column after the first to numbers when all of its values are numeric."""
+    import pandas as pd
+
+    if df.shape[1] < 2 or df.empty:
+        return df
+
+    values = df.iloc[:, 1:]
+    converted = values.apply(pd.to_numeric, errors="coerce")
+    numeric_columns = converted.columns[converted.notna().all()]
+
+    df = df.copy()
+    df[numeric_columns] = converted[numeric_columns]
+    return df